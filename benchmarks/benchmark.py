@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+    Benchmark the request pipeline of the dataset hoster with synthetic queries.
+
+    Each combination of input batch size and result size is sent through the web, JSON GET and JSON POST
+    endpoints of an app created with create_app, and the stages of the pipeline are also timed on their own.
+    Only request arguments and helpers that every commit supports are used, so that the results can be
+    compared to the results of another commit:
+
+        python benchmarks/benchmark.py --output before.json
+        git checkout my-branch
+        python benchmarks/benchmark.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from pydantic import BaseModel
+from werkzeug.datastructures import MultiDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from datasethoster import Query, RequestSource  # noqa: E402
+from datasethoster.main import create_app, register_query, convert_args_to_input, group_results, \
+    convert_result_group_to_output  # noqa: E402
+
+
+class BenchInput(BaseModel):
+    number: int
+    num_lines: int
+
+
+class BenchOutput(BaseModel):
+    number: int
+    multiplied: int
+
+
+class BenchListInput(BaseModel):
+    number: list[int]
+    multiplied: int
+
+
+class BenchListOutput(BaseModel):
+    number: int
+    added: int
+
+
+class BenchQuery(Query[BenchInput, BenchOutput]):
+    """ Like ExampleQuery: returns num_lines rows for each input. """
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "bench", "Benchmark multiplication table"
+
+    def introduction(self):
+        return "Synthetic query used by the benchmarks."
+
+    def inputs(self):
+        return BenchInput
+
+    def outputs(self):
+        return BenchOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        return [BenchOutput(number=i, multiplied=i * param.number)
+                for param in params for i in range(1, param.num_lines + 1)]
+
+
+class BenchListQuery(Query[BenchListInput, BenchListOutput]):
+    """ Like ExampleQuery2, its inputs match the outputs of BenchQuery so that links are generated. """
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "bench-list", "Benchmark addition table"
+
+    def introduction(self):
+        return "Synthetic query used by the benchmarks."
+
+    def inputs(self):
+        return BenchListInput
+
+    def outputs(self):
+        return BenchListOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        return [BenchListOutput(number=i, added=i + number)
+                for param in params for number in param.number for i in range(1, param.multiplied + 1)]
+
+
+def serialize_rows(rows):
+    """ Serialize the rows to a JSON array. The hoster's own serializer is timed through the endpoints, this one
+        is the same on every commit and serves as the reference for the cost of serializing the rows. """
+    return json.dumps([row.dict() for row in rows]).encode("utf-8")
+
+
+def summarize(durations, items=1):
+    """ Return the latency percentiles in milliseconds and the throughput of the timed calls. """
+    durations = sorted(durations)
+    total = sum(durations)
+
+    def percentile(p):
+        return durations[min(len(durations) - 1, int(round(p / 100 * (len(durations) - 1))))] * 1000
+
+    return {
+        "calls": len(durations),
+        "mean_ms": statistics.mean(durations) * 1000,
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": durations[-1] * 1000,
+        "per_second": len(durations) / total if total else None,
+        "items_per_second": len(durations) * items / total if total else None,
+    }
+
+
+def measure(func, iterations, warmup, items=1):
+    """ Time func over the given number of iterations, then run it once more to measure its peak memory. """
+    for _ in range(warmup):
+        func()
+
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+
+    result = summarize(durations, items)
+    # tracemalloc slows everything down, so memory is measured in a separate run
+    tracemalloc.start()
+    try:
+        func()
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+def make_inputs(batch_size, result_size):
+    num_lines = max(1, result_size // batch_size)
+    return [{"number": n, "num_lines": num_lines} for n in range(1, batch_size + 1)]
+
+
+def bench_endpoints(client, batch_size, result_size, iterations, warmup):
+    """ Send requests to the web, JSON GET and JSON POST endpoints of the bench query. """
+    # the web and GET endpoints take a single input, so the whole result comes from one item. They return all
+    # rows of the bench query without a count, which older commits don't accept for these endpoints.
+    get_args = "number=3&num_lines=%d" % result_size
+    inputs = make_inputs(batch_size, result_size)
+
+    def check(resp):
+        # read the whole (possibly streamed) body, as a client would
+        resp.get_data()
+        if resp.status_code != 200:
+            raise RuntimeError("Request failed with status %d: %s" % (resp.status_code, resp.get_data()[:200]))
+        resp.close()
+
+    return {
+        "web": measure(lambda: check(client.get("/bench?" + get_args)), iterations, warmup),
+        "json_get": measure(lambda: check(client.get("/bench/json?" + get_args)), iterations, warmup),
+        "json_post": measure(lambda: check(client.post("/bench/json?count=%d" % result_size, json=inputs)),
+                             iterations, warmup, items=batch_size),
+    }
+
+
+def bench_stages(batch_size, result_size, iterations, warmup):
+    """ Time the stages of the pipeline on their own, with the same inputs as the requests. """
+    query = BenchQuery()
+    input_model = query.inputs()
+    arguments = MultiDict({"number": "3", "num_lines": str(result_size)})
+    inputs = [input_model(**item) for item in make_inputs(batch_size, result_size)]
+    results = query.fetch(inputs, RequestSource.json_post)
+    groups = group_results(results)
+
+    return {
+        "convert_args_to_input": measure(lambda: input_model(**convert_args_to_input(input_model, arguments)),
+                                         iterations, warmup),
+        "group_results": measure(lambda: group_results(results), iterations, warmup),
+        # includes generating the links to the other queries
+        "convert_result_group_to_output": measure(lambda: convert_result_group_to_output(groups),
+                                                  iterations, warmup),
+        "json_serialization": measure(lambda: serialize_rows(results), iterations, warmup, items=len(results)),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.realpath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, previous):
+    """ Print the change in median latency and peak memory of each benchmark relative to a previous run. """
+    previous_cases = {(case["batch_size"], case["result_size"]): case for case in previous["cases"]}
+    print("Compared to %s:" % (previous.get("commit") or "previous run"))
+    for case in current["cases"]:
+        old_case = previous_cases.get((case["batch_size"], case["result_size"]))
+        if old_case is None:
+            continue
+        for group in ("endpoints", "stages"):
+            for name, result in case[group].items():
+                old = old_case[group].get(name)
+                if old is None:
+                    continue
+                print("  batch %5d, rows %7d, %-32s p50 %+7.1f%%  peak memory %+7.1f%%" % (
+                    case["batch_size"], case["result_size"], name,
+                    change(old["p50_ms"], result["p50_ms"]),
+                    change(old["peak_memory_bytes"], result["peak_memory_bytes"])))
+
+
+def change(old, new):
+    return (new - old) / old * 100 if old else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dataset hoster request pipeline")
+    parser.add_argument("--batch-sizes", default="1,10,100",
+                        help="comma separated numbers of input items per POST request")
+    parser.add_argument("--result-sizes", default="10,1000,10000",
+                        help="comma separated numbers of result rows per request")
+    parser.add_argument("--iterations", type=int, default=50, help="timed runs per benchmark")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed runs before each benchmark")
+    parser.add_argument("--output", default="benchmark-results.json", help="file to write the results to")
+    parser.add_argument("--compare", help="results file of a previous run to compare to")
+    args = parser.parse_args()
+
+    register_query(BenchQuery())
+    register_query(BenchListQuery())
+    app = create_app()
+    client = app.test_client()
+
+    cases = []
+    for batch_size in [int(x) for x in args.batch_sizes.split(",")]:
+        for result_size in [int(x) for x in args.result_sizes.split(",")]:
+            print("Running batch size %d, result size %d" % (batch_size, result_size), file=sys.stderr)
+            cases.append({
+                "batch_size": batch_size,
+                "result_size": result_size,
+                "endpoints": bench_endpoints(client, batch_size, result_size, args.iterations, args.warmup),
+                "stages": bench_stages(batch_size, result_size, args.iterations, args.warmup),
+            })
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "iterations": args.iterations,
+        "cases": cases,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to %s" % args.output, file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
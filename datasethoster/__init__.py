@@ -1,3 +1,5 @@
+import asyncio
+import copy
 from abc import abstractmethod
 from enum import Enum
 from typing import TypeVar, Generic, Type
@@ -8,6 +10,13 @@ QueryInT = TypeVar('QueryInT', bound=BaseModel)
 QueryOutT = TypeVar('QueryOutT', bound=BaseModel)
 
 
+def hashable(value):
+    """ Convert lists, as found in the values of list fields, to tuples so that the value can be used as a key. """
+    if isinstance(value, list):
+        return tuple(hashable(x) for x in value)
+    return value
+
+
 class RequestSource(Enum):
     web = "web"
     json_get = "json_get"
@@ -18,8 +27,133 @@ class QueryOutputLine(BaseModel):
     line: str
 
 
+class ColumnarResult:
+    """ A query result stored column by column: a dict of column name to a sequence of values (a list,
+        tuple, numpy array or anything else with a length that can be iterated). All columns must have
+        the same length. Query.fetch can return this instead of a list of rows so that results computed
+        with bulk operations are served without building an object for each row.
+    """
+
+    def __init__(self, columns: dict):
+        self.columns = dict(columns)
+        lengths = {len(values) for values in self.columns.values()}
+        if len(lengths) > 1:
+            raise ValueError("All columns of a columnar result must have the same length")
+        self.length = lengths.pop() if lengths else 0
+
+    def __len__(self):
+        return self.length
+
+    def column_names(self):
+        return list(self.columns.keys())
+
+    def to_lists(self):
+        """ Return the columns as plain python lists, converting arrays in bulk where possible. """
+        return {name: values.tolist() if hasattr(values, "tolist") else list(values)
+                for name, values in self.columns.items()}
+
+    def iter_rows(self):
+        """ Iterate over the rows as tuples, in the order of column_names(). """
+        return zip(*self.to_lists().values())
+
+    def to_dicts(self):
+        names = self.column_names()
+        return [dict(zip(names, row)) for row in self.iter_rows()]
+
+    def slice(self, start, stop=None):
+        """ Return a new columnar result with only the rows from start up to stop. """
+        return ColumnarResult({name: values[start:stop] for name, values in self.columns.items()})
+
+    @staticmethod
+    def concat(results):
+        """ Return a columnar result with the rows of all the given columnar results, in order. All results
+            must have the same columns. """
+        names = results[0].column_names() if results else []
+        columns = {name: [] for name in names}
+        for result in results:
+            if result.column_names() != names:
+                raise ValueError("Columnar results can only be concatenated if they have the same columns")
+            for name, values in result.to_lists().items():
+                columns[name].extend(values)
+        return ColumnarResult(columns)
+
+
+def merge_results(results):
+    """ Merge the results of several fetch calls in order. Columnar results are concatenated column by column,
+        if any other results are given too all results are merged into a list of rows. """
+    if results and all(isinstance(result, ColumnarResult) for result in results):
+        return ColumnarResult.concat(results)
+    return [row for result in results
+            for row in (result.to_dicts() if isinstance(result, ColumnarResult) else result)]
+
+
+class ResultPage:
+    """ A page of results returned by the fetch function of a query that supports cursors. The cursor is
+        any JSON serializable value that lets the query resume right after the last row of this page,
+        (e.g. the last key of an index scan) or None if this is the last page. The hoster hands the
+        cursor out to clients as an opaque token and passes it back to fetch for the next page.
+    """
+
+    def __init__(self, results, cursor=None):
+        self.results = results
+        self.cursor = cursor
+
+
 class Query(Generic[QueryInT, QueryOutT]):
 
+    # Set to True if fetch ignores offset and count and returns all rows, the hoster then applies offset and count
+    # to the rows fetch returns when the client asks for a page. By default fetch applies them itself.
+    paged_by_hoster = False
+    # Number of seconds the results of this query may be served from the result cache.
+    # None (the default) disables caching for this query.
+    cache_ttl = None
+    # Maximum number of cached results kept for this query, least recently used are evicted first.
+    cache_size = 256
+    # Set to True if the results of fetch are the rows of each input item on its own, in input order, so that
+    # the rows of each item can be cached separately (requires cache_ttl). Batches then only fetch the items
+    # that are missing from the cache, without offset and count. Rows are matched to their input items by
+    # split_results.
+    cache_per_input = False
+    # Set to True if fetch accepts a cursor argument and returns a ResultPage, so that clients can
+    # page through the results with cursors rather than offsets.
+    supports_cursor = False
+    # Number of worker processes to run fetch in, for CPU bound queries. 0 (the default) runs fetch in the
+    # request thread. When set, setup is called once in each worker process instead of at registration, and
+    # the query object, its inputs and its outputs must be picklable.
+    process_workers = 0
+    # Number of seconds after which the stack of a request for this query is sampled, when profiling is
+    # enabled in the app config. None (the default) disables sampling slow requests for this query.
+    profile_threshold = None
+    # Number of seconds clients and proxies may reuse a response without revalidating it. Only used by
+    # queries that return a version, 0 (the default) makes them revalidate the response's ETag every time.
+    http_max_age = 0
+    # Set to True to coalesce identical requests (same inputs, paging and endpoint) that arrive while fetch is
+    # running for one of them: fetch is only run once and all the requests get its results. The results are
+    # then read into a list before they are served. Waiting requests fail after single_flight_timeout seconds.
+    single_flight = False
+    single_flight_timeout = 30
+    # Number of input items per second each client may request from this query, None (the default) uses the
+    # RATE_LIMIT app config and 0 disables rate limiting for this query. Clients can make requests for up to
+    # rate_limit_burst items at once, 10 times rate_limit if not set. Set rate_limit_row_cost to also charge
+    # clients for each row returned, as a fraction of an input item.
+    rate_limit = None
+    rate_limit_burst = None
+    rate_limit_row_cost = 0
+    # Maximum number of fetch calls of this query that run at the same time in each worker process, 0 (the
+    # default) for no limit. Up to max_queued_fetches more requests wait for up to queue_timeout seconds for
+    # a running call to finish, other requests are rejected with a 503 response right away.
+    max_concurrent_fetches = 0
+    max_queued_fetches = 0
+    queue_timeout = 10
+    # Number of seconds fetch may take, including producing the rows of a generator, before the request fails
+    # with a 504 response. None (the default) for no limit. Set supports_deadline to True to have fetch passed
+    # the deadline, as a time.monotonic() value, in a deadline argument so that it can stop early.
+    fetch_timeout = None
+    supports_deadline = False
+    # Maximum number of input items in a POST request, larger requests are rejected with a 413 response. None
+    # (the default) uses the MAX_BATCH_SIZE app config and 0 allows any number of items.
+    max_batch_size = None
+
     def __init__(self):
         """ The constructor, override it if you need to. """
         pass
@@ -56,18 +190,76 @@ class Query(Generic[QueryInT, QueryOutT]):
         pass
 
     @abstractmethod
-    def fetch(self, params: QueryInT, source: RequestSource, offset=-1, limit=-1) -> QueryOutT:
+    def fetch(self, params: QueryInT, source: RequestSource, offset=-1, count=-1) -> QueryOutT:
         """
            Given the passed in parameters, the function should carry out more error checking
            on the arguments and then fetch the data needed. This function should
            return a list of dicts with keys named exactly after each of the
-           outputs. This function should use the Werkzeug exceptions like NotFound, BadRequest
+           outputs. For large results the function may also return an iterator or generator
+           of output models, the JSON endpoints then stream the rows as they are produced.
+           To skip the cost of constructing a model for every row, rows may also be plain
+           dicts or tuples (in the order of the fields of outputs()). These are trusted to
+           match the outputs model and are serialized without validation.
+           Results computed column by column can be returned as a ColumnarResult.
+
+           POST requests pass offset and count, the other endpoints pass them if the client
+           asks for a page, and the function should return at most count rows starting at
+           offset. Queries that set paged_by_hoster may ignore them, the hoster then applies
+           them to the returned rows itself. Queries that set supports_cursor
+           are also passed a cursor argument, None for the first page, and return a ResultPage.
+           This function should use the Werkzeug exceptions like NotFound, BadRequest
            if anything goes wrong in the process of fetching the data. For the web interface
            BadRequest, InternalServerError, ImATeapot, ServiceUnavailable, NotFound are caught
            and the text is correctly displayed as an error on the web page.
         """
         pass
 
+    def split_results(self, params, results):
+        """ Split the rows returned by fetch for the given params into a list of rows for each input item, for
+            queries that set cache_per_input. By default rows are matched to input items by the values of the
+            fields that the inputs and outputs models have in common. Override this if fetch renames or
+            normalizes its inputs, or if rows can be matched to their input items in another way.
+        """
+        input_fields = list(self.inputs().__fields__)
+        output_model = self.outputs()
+        output_fields = list(output_model.__fields__) if output_model is not None else []
+        fields = [name for name in input_fields if name in output_fields]
+        if not fields:
+            raise ValueError("The inputs and outputs of query '%s' have no fields in common, "
+                             "override split_results to match rows to input items" % self.names()[0])
+
+        if isinstance(results, ColumnarResult):
+            results = results.to_dicts()
+        indexes = [output_fields.index(name) for name in fields]
+        groups = {}
+        for row in results:
+            if isinstance(row, BaseModel):
+                values = [getattr(row, name) for name in fields]
+            elif isinstance(row, dict):
+                values = [row[name] for name in fields]
+            else:
+                values = [row[index] for index in indexes]
+            groups.setdefault(hashable(values), []).append(row)
+        return [groups.get(hashable([getattr(param, name) for name in fields]), []) for param in params]
+
+    def version(self):
+        """ Return a string that identifies the version of the loaded data, e.g. the date the dataset was
+            generated, or None if the query doesn't track versions. Responses of queries that return a
+            version carry an ETag, so clients can revalidate them without the query being run again.
+            This is called for each request, so it should be cheap. """
+        return None
+
+    def reload(self):
+        """ Return a new query object with freshly loaded data, which the hoster swaps in for this one once it
+            is ready. Requests that are in progress finish on this object. The default makes a shallow copy
+            of this object and calls setup on it; override this if the data can be refreshed more cheaply.
+        """
+        query = copy.copy(self)
+        # queries that run in a process pool are set up in the new pool's worker processes
+        if not query.process_workers:
+            query.setup()
+        return query
+
     def additional_data(self):
         """ return a dict of data that can provide hints to the dataset hoster.
 
@@ -76,3 +268,43 @@ class Query(Generic[QueryInT, QueryOutT]):
                 playlist_desc: the desc of the playlist, should the user want to save the result data as a playlist.
         """
         return {"name": "Instant Playlist", "desc": "Instant Playlist"}
+
+
+class AsyncQuery(Query[QueryInT, QueryOutT]):
+    """ A query whose fetch function is a coroutine, for queries that spend most of their time waiting on
+        I/O (database lookups, HTTP requests to other services). If fan_out is set, the hoster calls fetch
+        once for each input item, running up to max_concurrency of those calls concurrently, and merges
+        the results in input order.
+    """
+
+    # Call fetch once per input item, concurrently, instead of once with all the inputs
+    fan_out = False
+    # Maximum number of concurrent fetch calls per request when fanning out
+    max_concurrency = 16
+
+    @abstractmethod
+    async def fetch(self, params: QueryInT, source: RequestSource, offset=-1, count=-1) -> QueryOutT:
+        """ The coroutine equivalent of Query.fetch. When fanning out, params holds a single input item
+            and the function should return a list of rows or a ColumnarResult. """
+        pass
+
+    async def fetch_all(self, params, source, offset=-1, count=-1, **kwargs):
+        """ Fetch the results for all params, fanning out to one fetch call per input item if enabled. """
+        if not self.fan_out or len(params) <= 1 or self.supports_cursor:
+            return await self.fetch(params, source, offset=offset, count=count, **kwargs)
+
+        # each call may need to return all rows up to the end of the requested page, the page
+        # itself is cut out of the merged results
+        stop = offset + count if offset >= 0 and count >= 0 else -1
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def fetch_one(param):
+            async with semaphore:
+                result = await self.fetch([param], source, offset=0 if stop >= 0 else -1, count=stop, **kwargs)
+                return result if isinstance(result, ColumnarResult) else list(result)
+
+        rows = merge_results(await asyncio.gather(*(fetch_one(param) for param in params)))
+        # the hoster applies offset and count to the merged rows of queries that it pages
+        if stop < 0 or self.paged_by_hoster:
+            return rows
+        return rows.slice(offset, stop) if isinstance(rows, ColumnarResult) else rows[offset:stop]
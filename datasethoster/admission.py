@@ -0,0 +1,109 @@
+import concurrent.futures
+import contextvars
+import threading
+import time
+
+
+class QueueFull(Exception):
+    """ Raised when a fetch call can't be admitted because too many calls are running and waiting. """
+    pass
+
+
+class AdmissionControl:
+    """
+        Limits the number of fetch calls of a query that run at the same time. Calls beyond the limit wait in a
+        bounded queue until a running call finishes. Calls are rejected right away if the queue is full, and
+        after waiting queue_timeout seconds otherwise.
+    """
+
+    def __init__(self, max_concurrent, max_queued=0, queue_timeout=10):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        self.active = 0
+        self.queued = 0
+
+    def acquire(self):
+        """ Wait for a slot to run a fetch call, raises QueueFull if the call is rejected. """
+        with self.condition:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                return
+
+            if self.queued >= self.max_queued:
+                raise QueueFull("Too many requests are in progress")
+            self.queued += 1
+            try:
+                if not self.condition.wait_for(lambda: self.active < self.max_concurrent, self.queue_timeout):
+                    raise QueueFull("Timed out waiting for other requests to complete")
+                self.active += 1
+            finally:
+                self.queued -= 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+def run_with_timeout(func, timeout):
+    """
+        Run func in a new thread and return its result, raising TimeoutError if it doesn't finish within timeout
+        seconds. A thread can't be stopped, so after a timeout func keeps running until it returns. func runs in
+        a copy of the current context, so that it sees the same flask request.
+    """
+    future = concurrent.futures.Future()
+    context = contextvars.copy_context()
+
+    def run():
+        try:
+            future.set_result(context.run(func))
+        except BaseException as err:
+            future.set_exception(err)
+
+    threading.Thread(target=run, name="fetch", daemon=True).start()
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        if not future.done():
+            raise TimeoutError("The query did not complete within %ss" % timeout)
+        raise
+
+
+class GuardedRows:
+    """
+        Wraps the rows returned by a fetch function that produces them as they are iterated (e.g. a generator),
+        so that iterating them is subject to the fetch deadline and on_done is called once they have been
+        consumed or closed.
+    """
+
+    def __init__(self, rows, deadline=None, on_done=None):
+        self.rows = iter(rows)
+        self.deadline = deadline
+        self.on_done = on_done
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.close()
+            raise TimeoutError("The query did not complete before its deadline")
+        try:
+            return next(self.rows)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        on_done, self.on_done = self.on_done, None
+        try:
+            if hasattr(self.rows, "close"):
+                self.rows.close()
+        finally:
+            if on_done is not None:
+                on_done()
+
+    def __del__(self):
+        self.close()
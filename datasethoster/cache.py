@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from abc import abstractmethod
+from collections import OrderedDict, defaultdict
+
+from pydantic import BaseModel
+
+
+def make_cache_key(slug, inputs, source, offset=None, count=None, cursor=None):
+    """ Build a stable cache key from the query slug, the validated input models, the paging
+        arguments and the request source. The inputs are canonicalised to sorted JSON so that
+        equivalent requests map to the same key regardless of the order of the fields. """
+    canonical = [x.dict() if isinstance(x, BaseModel) else x for x in inputs]
+    payload = json.dumps([slug, canonical, source.value, offset, count, cursor], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """ Base class for result cache backends. Entries are stored per namespace (the query slug)
+        so that each query can have its own TTL and size budget. Hits and misses are counted by the
+        cache_requests_total metric. """
+
+    @abstractmethod
+    def _get(self, namespace, key):
+        """ Return the cached value or None if there is no live entry. """
+        pass
+
+    @abstractmethod
+    def _set(self, namespace, key, value, ttl, max_size):
+        """ Store a value, evicting the least recently used entries beyond max_size. """
+        pass
+
+    @abstractmethod
+    def clear(self, namespace=None):
+        """ Drop all entries of the given namespace, or all entries if no namespace is given. """
+        pass
+
+    def _get_many(self, namespace, keys):
+        """ Return a dict of key to cached value of the keys that have a live entry. Backends override this to
+            look all keys up at once. """
+        values = {}
+        for key in keys:
+            value = self._get(namespace, key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def _set_many(self, namespace, items, ttl, max_size):
+        """ Store a dict of key to value. Backends override this to store all values at once. """
+        for key, value in items.items():
+            self._set(namespace, key, value, ttl, max_size)
+
+    def get(self, namespace, key):
+        return self._get(namespace, key)
+
+    def get_many(self, namespace, keys):
+        """ Look up several keys of a namespace, returns a dict of key to value of the keys that are cached. """
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        return self._get_many(namespace, keys)
+
+    def set(self, namespace, key, value, ttl, max_size):
+        if value is None or not ttl or max_size <= 0:
+            return
+        self._set(namespace, key, value, ttl, max_size)
+
+    def set_many(self, namespace, items, ttl, max_size):
+        """ Store a dict of key to value in a namespace. """
+        items = {key: value for key, value in items.items() if value is not None}
+        if not items or not ttl or max_size <= 0:
+            return
+        self._set_many(namespace, items, ttl, max_size)
+
+
+class MemoryResultCache(ResultCache):
+    """ An in-process LRU cache. Each worker process has its own copy. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = defaultdict(OrderedDict)
+
+    def _get(self, namespace, key):
+        return self._get_many(namespace, [key]).get(key)
+
+    def _get_many(self, namespace, keys):
+        with self.lock:
+            entries = self.entries[namespace]
+            now = time.monotonic()
+            values = {}
+            for key in keys:
+                entry = entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del entries[key]
+                    continue
+                entries.move_to_end(key)
+                values[key] = entry[1]
+            return values
+
+    def _set(self, namespace, key, value, ttl, max_size):
+        self._set_many(namespace, {key: value}, ttl, max_size)
+
+    def _set_many(self, namespace, items, ttl, max_size):
+        with self.lock:
+            entries = self.entries[namespace]
+            expires = time.monotonic() + ttl
+            for key, value in items.items():
+                entries[key] = (expires, value)
+                entries.move_to_end(key)
+            while len(entries) > max_size:
+                entries.popitem(last=False)
+
+    def clear(self, namespace=None):
+        with self.lock:
+            if namespace is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(namespace, None)
+
+
+# Maximum number of keys looked up with a single SQLite statement, below SQLite's limit on bound parameters
+SQLITE_MAX_PARAMS = 900
+
+
+class SQLiteResultCache(ResultCache):
+    """ An LRU cache stored in a local SQLite file, so that all uWSGI workers on a host can share
+        cached results. Values are pickled; results that cannot be pickled are not cached. """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS result_cache (
+                                namespace TEXT NOT NULL,
+                                key       TEXT NOT NULL,
+                                value     BLOB NOT NULL,
+                                expires   REAL NOT NULL,
+                                accessed  REAL NOT NULL,
+                                PRIMARY KEY (namespace, key))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS result_cache_accessed ON result_cache (namespace, accessed)")
+
+    def _connection(self):
+        """ Return a connection for the current thread, reopening it after a fork. """
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    def _get(self, namespace, key):
+        return self._get_many(namespace, [key]).get(key)
+
+    def _get_many(self, namespace, keys):
+        conn = self._connection()
+        rows = []
+        for start in range(0, len(keys), SQLITE_MAX_PARAMS):
+            chunk = keys[start:start + SQLITE_MAX_PARAMS]
+            rows.extend(conn.execute("SELECT key, value, expires FROM result_cache WHERE namespace = ? AND key IN (%s)"
+                                     % ", ".join("?" * len(chunk)), [namespace] + chunk))
+
+        now = time.time()
+        values, expired = {}, []
+        for key, value, expires in rows:
+            if expires < now:
+                expired.append((namespace, key))
+            else:
+                values[key] = value
+        if values or expired:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("DELETE FROM result_cache WHERE namespace = ? AND key = ?", expired)
+                conn.executemany("UPDATE result_cache SET accessed = ? WHERE namespace = ? AND key = ?",
+                                 [(now, namespace, key) for key in values])
+        return {key: pickle.loads(value) for key, value in values.items()}
+
+    def _set(self, namespace, key, value, ttl, max_size):
+        self._set_many(namespace, {key: value}, ttl, max_size)
+
+    def _set_many(self, namespace, items, ttl, max_size):
+        rows = []
+        now = time.time()
+        for key, value in items.items():
+            try:
+                blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, AttributeError, TypeError):
+                continue
+            rows.append((namespace, key, blob, now + ttl, now))
+        if not rows:
+            return
+
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("""INSERT OR REPLACE INTO result_cache (namespace, key, value, expires, accessed)
+                                VALUES (?, ?, ?, ?, ?)""", rows)
+            # the index on accessed lets this skip the max_size most recently used entries without sorting
+            conn.execute("""DELETE FROM result_cache
+                             WHERE namespace = ?
+                               AND key IN (SELECT key FROM result_cache
+                                            WHERE namespace = ?
+                                         ORDER BY accessed DESC
+                                            LIMIT -1 OFFSET ?)""", (namespace, namespace, max_size))
+
+    def clear(self, namespace=None):
+        conn = self._connection()
+        if namespace is None:
+            conn.execute("DELETE FROM result_cache")
+        else:
+            conn.execute("DELETE FROM result_cache WHERE namespace = ?", (namespace,))
+
+
+def create_result_cache(backend="memory", path=None):
+    """ Create a result cache backend by name: "memory" for an in-process cache or "sqlite" for
+        a cache shared across the worker processes on this host. """
+    if backend == "memory":
+        return MemoryResultCache()
+    if backend == "sqlite":
+        if not path:
+            raise ValueError("The sqlite result cache requires a path")
+        return SQLiteResultCache(path)
+    raise ValueError("Unknown result cache backend '%s'" % backend)
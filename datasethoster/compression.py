@@ -0,0 +1,119 @@
+import zlib
+from abc import abstractmethod
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Responses smaller than this many bytes are sent uncompressed
+COMPRESSION_MIN_SIZE = 1024
+# Levels that trade some compression ratio for speed, as responses are compressed on the fly
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+
+class StreamCompressor:
+    """ Compresses a response body one chunk at a time. Each chunk is flushed, so that the client can
+        decompress the data sent so far while the rest of the response is still being produced. """
+
+    name = None
+
+    @abstractmethod
+    def compress(self, data) -> bytes:
+        """ Compress a chunk of data and return all the compressed data that can be sent so far. """
+        pass
+
+    @abstractmethod
+    def finish(self) -> bytes:
+        """ Return the end of the compressed data. """
+        pass
+
+
+class GzipCompressor(StreamCompressor):
+
+    name = "gzip"
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+
+class BrotliCompressor(StreamCompressor):
+
+    name = "br"
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data) -> bytes:
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self) -> bytes:
+        return self.compressor.finish()
+
+
+class ZstdCompressor(StreamCompressor):
+
+    name = "zstd"
+
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+
+def available_encodings():
+    """ Return the names of the content encodings that can be used, most preferred first. zstd and br are
+        only available if the zstandard and brotli packages are installed. """
+    encodings = []
+    if zstandard is not None:
+        encodings.append(ZstdCompressor.name)
+    if brotli is not None:
+        encodings.append(BrotliCompressor.name)
+    encodings.append(GzipCompressor.name)
+    return encodings
+
+
+def negotiate_encoding(accept_encodings, encodings=None):
+    """ Return the best content encoding accepted by the client (werkzeug's request.accept_encodings),
+        or None if the response should not be compressed. """
+    return accept_encodings.best_match(encodings if encodings is not None else available_encodings())
+
+
+def create_compressor(encoding) -> StreamCompressor:
+    for compressor in (GzipCompressor, BrotliCompressor, ZstdCompressor):
+        if compressor.name == encoding:
+            return compressor()
+    raise ValueError("Unknown content encoding '%s'" % encoding)
+
+
+def compress(data, encoding):
+    """ Compress a whole response body. """
+    compressor = create_compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_chunks(chunks, encoding):
+    """ Compress an iterable of response body chunks, yielding the compressed data of each chunk. """
+    compressor = create_compressor(encoding)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
@@ -0,0 +1,121 @@
+import fcntl
+import glob
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+
+class MappedDataset:
+    """ A read-only memory mapping of one version of a dataset file. All processes that map the same
+        file share its pages, so the data is only held in memory once per host. """
+
+    def __init__(self, name, version, path):
+        self.name = name
+        self.version = version
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.buffer = memoryview(self.mmap) if self.mmap is not None else memoryview(b"")
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def array(self, typecode, offset=0, length=None):
+        """ Return a zero-copy view of part of the data as an array of the given struct typecode (e.g. "q"
+            for 64 bit integers), starting at the byte offset and containing length items. """
+        end = None if length is None else offset + length * struct.calcsize(typecode)
+        return self.buffer[offset:end].cast(typecode)
+
+
+class DatasetStore:
+    """
+        Stores datasets as files in a local directory and maps them into memory. The first process to
+        ask for a version of a dataset builds the file, the other processes (e.g. the other uWSGI workers)
+        wait for it and then map the same file read-only. Building a new version replaces the old file,
+        processes that still map the old version keep using it until they switch over.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _dataset_directory(self, name):
+        return os.path.join(self.directory, name)
+
+    def map(self, name, version, build):
+        """
+            Map the given version of the named dataset, calling build(f) with a binary file opened for writing
+            to create the file if no process has done so yet. The version is a string that changes whenever
+            the data changes, e.g. the modification time of the source file the dataset is built from.
+        """
+        directory = self._dataset_directory(name)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "%s.dat" % version)
+        with open(os.path.join(directory, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(path):
+                self._build(directory, path, build)
+
+        return MappedDataset(name, version, path)
+
+    def _build(self, directory, path, build):
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".build-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                build(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        # processes that still map an old version are unaffected by the file being removed
+        for old_path in glob.glob(os.path.join(glob.escape(directory), "*.dat")):
+            if old_path != path:
+                os.unlink(old_path)
+
+    def watch(self, name, source_path, build, check_interval=60):
+        """ Return a WatchedDataset that maps the dataset built from source_path and rebuilds it when the
+            source file changes. """
+        return WatchedDataset(self, name, source_path, build, check_interval)
+
+
+class WatchedDataset:
+    """ A dataset built from a source file, which is rebuilt and swapped for the new version when the source
+        file changes. Call get() for each use of the data; it checks the source file at most once every
+        check_interval seconds. """
+
+    def __init__(self, store, name, source_path, build, check_interval=60):
+        self.store = store
+        self.name = name
+        self.source_path = source_path
+        self.build = build
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.checked = time.monotonic()
+        self.dataset = store.map(name, self.source_version(), build)
+
+    def source_version(self):
+        st = os.stat(self.source_path)
+        return "%d-%d" % (st.st_mtime_ns, st.st_size)
+
+    def get(self) -> MappedDataset:
+        if time.monotonic() - self.checked < self.check_interval:
+            return self.dataset
+
+        with self.lock:
+            if time.monotonic() - self.checked >= self.check_interval:
+                version = self.source_version()
+                if version != self.dataset.version:
+                    # in-flight requests keep the reference to the old mapping they already hold
+                    self.dataset = self.store.map(self.name, version, self.build)
+                self.checked = time.monotonic()
+        return self.dataset
+
+
+dataset_store = DatasetStore(os.environ.get("DATASET_STORE_PATH",
+                                            os.path.join(tempfile.gettempdir(), "datasethoster")))
@@ -0,0 +1,53 @@
+import json
+from abc import abstractmethod
+
+from pydantic.json import pydantic_encoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class OutputEncoder:
+    """ Serializes single output values (dicts, lists, scalars) to JSON bytes. """
+
+    name = None
+
+    @abstractmethod
+    def encode(self, obj) -> bytes:
+        pass
+
+
+class StdlibOutputEncoder(OutputEncoder):
+    """ Encoder based on the json module of the standard library. """
+
+    name = "json"
+
+    def encode(self, obj) -> bytes:
+        return json.dumps(obj, default=pydantic_encoder).encode("utf-8")
+
+
+class OrjsonOutputEncoder(OutputEncoder):
+    """ Encoder based on orjson, which is several times faster than the json module. """
+
+    name = "orjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise ValueError("The orjson output encoder requires the orjson package to be installed")
+
+    def encode(self, obj) -> bytes:
+        return orjson.dumps(obj, default=pydantic_encoder, option=orjson.OPT_NON_STR_KEYS)
+
+
+def create_output_encoder(name=None):
+    """ Create an output encoder by name, "json" or "orjson". If no name is given, orjson is used
+        if it is installed and the standard library json module otherwise. """
+    if name is None:
+        name = "orjson" if orjson is not None else "json"
+    if name == "orjson":
+        return OrjsonOutputEncoder()
+    if name == "json":
+        return StdlibOutputEncoder()
+    raise ValueError("Unknown output encoder '%s'" % name)
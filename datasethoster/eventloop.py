@@ -0,0 +1,60 @@
+import asyncio
+import atexit
+import concurrent.futures
+import os
+import threading
+
+
+class EventLoopThread:
+    """
+        An asyncio event loop that runs in a background thread for the lifetime of the process. The coroutines
+        of async queries all run on this loop, so that clients bound to an event loop (e.g. an aiohttp session
+        or an asyncpg pool) can be created once and reused by all requests. The loop is started on first use,
+        in each (uWSGI) worker process that uses it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.pid = None
+
+    def get_loop(self):
+        """ Return the event loop of this process, starting it if needed. """
+        with self.lock:
+            if self.loop is None or self.pid != os.getpid():
+                # the thread of a loop started before a fork doesn't exist in the child process
+                self.loop = asyncio.new_event_loop()
+                self.pid = os.getpid()
+                threading.Thread(target=self.loop.run_forever, name="async-queries", daemon=True).start()
+            return self.loop
+
+    def run(self, coroutine, timeout=None):
+        """ Run the coroutine on the event loop and return its result. If it doesn't complete within timeout
+            seconds, it is cancelled and TimeoutError is raised. """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.get_loop())
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # concurrent.futures.TimeoutError is only the builtin TimeoutError as of python 3.11
+            future.cancel()
+            raise TimeoutError("The query did not complete within %s seconds" % timeout)
+
+    def stop(self):
+        with self.lock:
+            if self.loop is not None and self.pid == os.getpid():
+                self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+
+
+event_loop = EventLoopThread()
+
+
+def run_coroutine(coroutine, timeout=None):
+    """ Run the coroutine on the event loop that async queries run on and return its result. Use this to
+        create clients bound to the event loop in the setup function of an async query. """
+    return event_loop.run(coroutine, timeout)
+
+
+@atexit.register
+def stop_event_loop():
+    event_loop.stop()
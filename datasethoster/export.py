@@ -0,0 +1,249 @@
+import csv
+import datetime
+import io
+import json
+from abc import abstractmethod
+from itertools import islice
+
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON
+from pydantic.json import pydantic_encoder
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Number of rows written at a time, each batch becomes a record batch of the Arrow formats
+EXPORT_BATCH_SIZE = 10000
+
+
+def encode_json(value):
+    return json.dumps(value, default=pydantic_encoder)
+
+
+class ChunkSink(io.RawIOBase):
+    """ A binary file object that collects the data written to it until it is taken with take(). """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ExportWriter:
+    """ Writes the rows of a result, as dicts, in a file format. The output is produced in chunks of about
+        EXPORT_BATCH_SIZE rows, so that exports of any size can be streamed to the client. """
+
+    name = None
+    mimetype = None
+    extension = None
+
+    def __init__(self, columns, model=None, encode=None):
+        """ columns lists the names of the output columns and model is the query's outputs model, if any.
+            encode serializes a value to JSON bytes, for the formats that write JSON. """
+        self.columns = columns
+        self.model = model
+        self.encode = encode or (lambda value: encode_json(value).encode("utf-8"))
+
+    @abstractmethod
+    def write(self, batches):
+        """ Yield the exported data for an iterator of batches of rows. """
+        pass
+
+    def write_error(self, err) -> bytes:
+        """ Return the data that ends an export that failed part way. The binary formats send nothing, the
+            export then lacks its end of stream marker or footer and can't be read as a whole. """
+        return b""
+
+
+class CSVWriter(ExportWriter):
+    """ Comma separated values with a header line. Lists, dicts and models are written as JSON. """
+
+    name = "csv"
+    mimetype = "text/csv"
+    extension = "csv"
+
+    @staticmethod
+    def format_value(value):
+        if value is None:
+            return ""
+        if isinstance(value, (str, int, float)):
+            return value
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+        if isinstance(value, (list, tuple, dict, BaseModel)):
+            return encode_json(value)
+        return str(value)
+
+    def write(self, batches):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.columns)
+        format_value = self.format_value
+        for batch in batches:
+            writer.writerows([format_value(row.get(column)) for column in self.columns] for row in batch)
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+        data = buffer.getvalue()
+        if data:
+            yield data.encode("utf-8")
+
+    def write_error(self, err):
+        """ End the export with a line that starts with #error and holds the error message. """
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(["#error", str(err)])
+        return buffer.getvalue().encode("utf-8")
+
+
+class NDJSONWriter(ExportWriter):
+    """ Newline delimited JSON, one object per row. """
+
+    name = "ndjson"
+    mimetype = "application/x-ndjson"
+    extension = "ndjson"
+
+    def write(self, batches):
+        encode = self.encode
+        for batch in batches:
+            yield b"".join(encode(row) + b"\n" for row in batch)
+
+    def write_error(self, err):
+        """ End the export with a line that holds an object with an error key. """
+        return self.encode({"error": str(err)}) + b"\n"
+
+
+def arrow_type(field):
+    """ Return the Arrow type of a field of a pydantic model, or None if the values are exported as JSON
+        strings. """
+    types = {int: pyarrow.int64(), float: pyarrow.float64(), str: pyarrow.string(), bool: pyarrow.bool_(),
+             datetime.datetime: pyarrow.timestamp("us"), datetime.date: pyarrow.date32()}
+    type_ = types.get(field.type_)
+    if type_ is None or field.shape not in (SHAPE_SINGLETON, SHAPE_LIST):
+        return None
+    return pyarrow.list_(type_) if field.shape == SHAPE_LIST else type_
+
+
+class ArrowWriter(ExportWriter):
+    """ The Apache Arrow IPC streaming format. The schema is derived from the outputs model of the query, or
+        inferred from the first batch of rows for queries with dynamic outputs. Columns whose types don't
+        map to Arrow types hold JSON strings. """
+
+    name = "arrow"
+    mimetype = "application/vnd.apache.arrow.stream"
+    extension = "arrow"
+
+    def __init__(self, columns, model=None, encode=None):
+        super().__init__(columns, model, encode)
+        self.json_columns = set()
+        self.schema = None
+        if model is not None and all(name in model.__fields__ for name in columns):
+            fields = []
+            for name in columns:
+                type_ = arrow_type(model.__fields__[name])
+                if type_ is None:
+                    self.json_columns.add(name)
+                    type_ = pyarrow.string()
+                fields.append(pyarrow.field(name, type_, nullable=True))
+            self.schema = pyarrow.schema(fields)
+
+    def record_batch(self, batch):
+        values = {name: [row.get(name) for row in batch] for name in self.columns}
+        for name in self.json_columns:
+            values[name] = [value if value is None or isinstance(value, str) else encode_json(value)
+                            for value in values[name]]
+        if self.schema is None:
+            return pyarrow.RecordBatch.from_pydict(values)
+        return pyarrow.RecordBatch.from_pydict(values, schema=self.schema)
+
+    def open_writer(self, sink, schema):
+        return pyarrow.ipc.new_stream(sink, schema)
+
+    def write(self, batches):
+        sink = ChunkSink()
+        writer = None
+        for batch in batches:
+            record_batch = self.record_batch(batch)
+            if writer is None:
+                self.schema = record_batch.schema
+                writer = self.open_writer(sink, self.schema)
+            writer.write_batch(record_batch)
+            data = sink.take()
+            if data:
+                yield data
+
+        if writer is None:
+            writer = self.open_writer(sink, self.schema or pyarrow.schema([]))
+        writer.close()
+        yield sink.take()
+
+
+class ParquetWriter(ArrowWriter):
+    """ Apache Parquet, with a row group for each batch of rows. """
+
+    name = "parquet"
+    mimetype = "application/vnd.apache.parquet"
+    extension = "parquet"
+
+    def open_writer(self, sink, schema):
+        return pyarrow.parquet.ParquetWriter(sink, schema)
+
+
+EXPORT_WRITERS = {writer.name: writer for writer in (CSVWriter, NDJSONWriter, ArrowWriter, ParquetWriter)}
+
+
+def available_formats():
+    """ Return the names of the export formats that can be used with the installed packages. """
+    formats = ["csv", "ndjson"]
+    if pyarrow is not None:
+        formats += ["arrow", "parquet"]
+    return formats
+
+
+def negotiate_format(name, accept_mimetypes, formats):
+    """ Return the export format given by name (the format argument of the request), or the format whose
+        mimetype best matches the Accept header, CSV by default. Returns None if no format is acceptable. """
+    if name:
+        return name if name in formats else None
+    mimetypes = {EXPORT_WRITERS[format_].mimetype: format_ for format_ in formats}
+    if not accept_mimetypes:
+        return formats[0]
+    best = accept_mimetypes.best_match(list(mimetypes))
+    return mimetypes.get(best)
+
+
+def batch_rows(rows, size=EXPORT_BATCH_SIZE):
+    """ Split an iterator of rows into lists of up to size rows. """
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def create_export_writer(name, columns, model=None, encode=None) -> ExportWriter:
+    """ Create the writer of an export format by name. """
+    if name not in available_formats():
+        raise ValueError("Unknown or unavailable export format '%s'" % name)
+    return EXPORT_WRITERS[name](columns, model, encode)
@@ -0,0 +1,183 @@
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+
+import sentry_sdk
+
+from datasethoster.pool import start_process_pool, retire_process_pool
+
+# Number of queries that are set up at the same time in the background
+SETUP_THREADS = 4
+
+
+class SetupMode(Enum):
+    blocking = "blocking"
+    background = "background"
+    lazy = "lazy"
+
+
+class SetupStatus(Enum):
+    pending = "pending"
+    loading = "loading"
+    ready = "ready"
+    failed = "failed"
+
+
+class QuerySetup:
+    """ Runs the setup of a query at most once and tracks its progress, so that requests can be
+        served or turned away depending on whether the query is ready. """
+
+    def __init__(self, query, mode=SetupMode.blocking, reloads=0):
+        self.query = query
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.status = SetupStatus.pending
+        self.error = None
+        self.duration = None
+        self.reloads = reloads
+        self.reloading = False
+        self.reload_error = None
+
+    @property
+    def ready(self):
+        return self.status == SetupStatus.ready
+
+    def run(self):
+        """ Run the query's setup unless it has completed already. If another thread is running
+            the setup, wait for it to finish. Raises the exception of a failed setup. """
+        with self.lock:
+            if self.status == SetupStatus.ready:
+                return
+
+            self.status, self.error = SetupStatus.loading, None
+            start = time.monotonic()
+            try:
+                # queries that run in a process pool are set up in each of the pool's worker processes instead
+                if self.query.process_workers:
+                    start_process_pool(self.query)
+                else:
+                    self.query.setup()
+            except Exception as err:
+                self.status, self.error = SetupStatus.failed, str(err)
+                raise
+            finally:
+                self.duration = time.monotonic() - start
+            self.status = SetupStatus.ready
+
+    def run_in_background(self):
+        """ Run the setup in the background setup thread pool, reporting failures to sentry. """
+
+        def run():
+            try:
+                self.run()
+            except Exception as err:
+                sentry_sdk.capture_exception(err)
+                print(traceback.format_exc())
+
+        get_setup_executor().submit(run)
+
+    def reload(self, swap):
+        """
+            Reload the query's data in the background with its reload hook and pass the QuerySetup of the new query
+            object to swap, which makes it live. Returns False if the query is not ready or is already reloading.
+        """
+        with self.lock:
+            if self.status != SetupStatus.ready or self.reloading:
+                return False
+            self.reloading, self.reload_error = True, None
+
+        def run():
+            start = time.monotonic()
+            try:
+                query = self.query.reload()
+                if query.process_workers:
+                    start_process_pool(query)
+                new_setup = QuerySetup(query, self.mode, self.reloads + 1)
+                new_setup.status, new_setup.duration = SetupStatus.ready, time.monotonic() - start
+                swap(new_setup)
+                if query.process_workers:
+                    # requests in progress on the old query object finish in its pool
+                    retire_process_pool(self.query)
+            except Exception as err:
+                self.reload_error = str(err)
+                sentry_sdk.capture_exception(err)
+                print(traceback.format_exc())
+            finally:
+                self.reloading = False
+
+        get_setup_executor().submit(run)
+        return True
+
+    def to_dict(self):
+        return {
+            "status": self.status.value,
+            "mode": self.mode.value,
+            "error": self.error,
+            "duration": self.duration,
+            "version": self.query.version() if self.ready else None,
+            "reloads": self.reloads,
+            "reloading": self.reloading,
+            "reload_error": self.reload_error,
+        }
+
+
+setup_executor = None
+
+
+def get_setup_executor():
+    global setup_executor
+    if setup_executor is None:
+        setup_executor = ThreadPoolExecutor(max_workers=SETUP_THREADS, thread_name_prefix="query-setup")
+    return setup_executor
+
+
+class ReloadMarkers:
+    """
+        Marker files in a directory shared by the worker processes of the app, one for each query that was
+        asked to reload, so that a reload requested from one worker reaches all of them. Each marker holds a
+        token that changes with every request. The markers that exist when this object is created, before the
+        workers are forked, are taken as handled.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.seen = self.read()
+
+    def read(self):
+        """ Return a dict of query slug to the token of its marker. """
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return {}
+
+        markers = {}
+        for name in names:
+            if name.startswith("."):
+                continue
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    markers[name] = f.read()
+            except OSError:
+                continue
+        return markers
+
+    def request(self, slug):
+        """ Ask all worker processes to reload the query, except this one which reloads it itself. """
+        token = uuid.uuid4().hex
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, ".%s.%s" % (slug, token))
+        with open(tmp_path, "w") as f:
+            f.write(token)
+        os.replace(tmp_path, os.path.join(self.path, slug))
+        self.seen[slug] = token
+
+    def pending(self):
+        """ Return a list of (slug, token) of the markers written since this process last handled them. """
+        return [(slug, token) for slug, token in self.read().items() if self.seen.get(slug) != token]
+
+    def handled(self, slug, token):
+        self.seen[slug] = token
@@ -1,20 +1,51 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import json
 import os
+import signal
+import tempfile
+import time
 import traceback
 from collections import defaultdict
+from itertools import chain, islice
 from datetime import datetime
 from enum import Enum
+from functools import wraps
 from urllib.parse import urlencode
 
 import sentry_sdk
-from flask import Blueprint, Flask, render_template, request, jsonify, redirect, Response
+from flask import Blueprint, Flask, render_template, request, jsonify, redirect, Response, stream_with_context, \
+    current_app, g, make_response, url_for
 from pydantic import BaseModel
 from pydantic.fields import ModelField, SHAPE_NAME_LOOKUP
 from sentry_sdk.integrations.flask import FlaskIntegration
 from werkzeug.datastructures import MultiDict
-from werkzeug.exceptions import BadRequest, MethodNotAllowed
-
-from datasethoster import RequestSource, QueryOutputLine
+from werkzeug.exceptions import BadRequest, MethodNotAllowed, NotFound, ServiceUnavailable, Forbidden, Conflict, \
+    TooManyRequests, GatewayTimeout, RequestEntityTooLarge, NotAcceptable, InternalServerError
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+from datasethoster import RequestSource, QueryOutputLine, ColumnarResult, ResultPage, AsyncQuery
+from datasethoster.admission import AdmissionControl, QueueFull, GuardedRows, run_with_timeout
+from datasethoster.cache import create_result_cache, make_cache_key
+from datasethoster.compression import COMPRESSION_MIN_SIZE, available_encodings, negotiate_encoding, compress, \
+    compress_chunks
 from datasethoster.decorators import crossdomain
+from datasethoster.encoders import create_output_encoder
+from datasethoster.eventloop import run_coroutine
+from datasethoster.export import available_formats, batch_rows, create_export_writer, negotiate_format
+from datasethoster.lifecycle import QuerySetup, ReloadMarkers, SetupMode
+from datasethoster.metrics import create_metrics_registry
+from datasethoster.pool import get_process_pool
+from datasethoster.profiling import ProfileStore, SlowRequestWatchdog, run_with_profiler
+from datasethoster.ratelimit import create_rate_limiter, format_retry_after
+from datasethoster.singleflight import SingleFlight
+from datasethoster.validation import get_batch_validator, parse_json
 from datasethoster.exceptions import RedirectError
 
 
@@ -22,11 +53,50 @@ class QueryOutputWrapperModel(BaseModel):
     __root__: list[BaseModel]
 
 
+# Number of rows fetch is passed as count for POST requests and pages that the client doesn't give a count for
 DEFAULT_QUERY_RESULT_SIZE = 100
+# Request arguments that page through the results
+PAGING_ARGUMENTS = ("offset", "count", "cursor")
+# Request arguments that control the hoster rather than being inputs of the query
+RESERVED_ARGUMENTS = PAGING_ARGUMENTS + ("orient", "format", "profile", "dryrun")
+# The web page shows at most this many rows, unless the HTML_MAX_ROWS config sets another limit
+DEFAULT_HTML_MAX_ROWS = 1000
+# Number of rows exported when the request doesn't give a count
+DEFAULT_EXPORT_SIZE = 1000000
+# Streamed JSON responses are sent in chunks of about this many characters
+STREAM_CHUNK_SIZE = 64 * 1024
+JSON_MIMETYPE = "application/json"
+NDJSON_MIMETYPE = "application/x-ndjson"
+COMPRESSIBLE_MIMETYPES = {JSON_MIMETYPE, NDJSON_MIMETYPE, "text/html", "text/csv"}
+# Compressed responses larger than this are not stored in the result cache
+MAX_CACHED_RESPONSE_SIZE = 10 * 1024 * 1024
+# Number of seconds between the checks of each worker for reloads requested through other workers
+RELOAD_CHECK_INTERVAL = 1
 TEMPLATE_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "template")
 
 
 registered_queries = {}
+# slug -> QuerySetup that tracks whether the query has been set up
+query_setups = {}
+# input field name -> list of (slug, name, input field names) of the queries that take that input
+query_input_index = defaultdict(list)
+result_cache = create_result_cache()
+rate_limiter = create_rate_limiter()
+output_encoder = create_output_encoder()
+metrics = create_metrics_registry()
+# Set by init_profiling if profiling is enabled in the app config
+profile_store = None
+slow_request_watchdog = SlowRequestWatchdog()
+# Content encodings responses may be compressed with, most preferred first
+compression_encodings = available_encodings()
+compression_min_size = COMPRESSION_MIN_SIZE
+# slug -> AdmissionControl of the queries that limit their concurrent fetches
+admission_controls = {}
+# Coalesces identical concurrent fetches of queries that enable single_flight
+fetch_flights = SingleFlight()
+# Set by init_reload_markers, tells all worker processes which queries to reload
+reload_markers = None
+last_reload_check = 0.0
 
 
 dataset_bp = Blueprint('dataset_hoster', __name__, template_folder=TEMPLATE_FOLDER)
@@ -42,9 +112,23 @@ def create_app(config_file=None):
     if config_file:
         app.config.from_object(config_file)
     init_sentry(app)
+    init_cache(app)
+    init_rate_limiter(app)
+    init_output_encoder(app)
+    init_metrics(app)
+    init_profiling(app)
+    init_compression(app)
+    init_reload_markers(app)
     return app
 
 
+def create_asgi_app(config_file=None):
+    """Create the flask app wrapped as an ASGI application, to serve it with an ASGI server like uvicorn"""
+    if WsgiToAsgi is None:
+        raise RuntimeError("Serving the app over ASGI requires the asgiref package to be installed")
+    return WsgiToAsgi(create_app(config_file))
+
+
 def init_sentry(app, dsn_config='SENTRY_DSN'):
     """Register sentry on the given app"""
     if dsn_config in app.config and app.config[dsn_config]:
@@ -56,23 +140,401 @@ def init_sentry(app, dsn_config='SENTRY_DSN'):
     return app
 
 
-def register_query(query):
+def init_cache(app, backend_config='RESULT_CACHE_BACKEND', path_config='RESULT_CACHE_PATH'):
+    """Configure the result cache backend used by queries that enable caching"""
+    global result_cache
+    if app.config.get(backend_config):
+        result_cache = create_result_cache(app.config[backend_config], app.config.get(path_config))
+
+    return app
+
+
+def init_rate_limiter(app, backend_config='RATE_LIMIT_BACKEND', path_config='RATE_LIMIT_PATH'):
+    """Configure the backend that keeps the rate limits of the clients"""
+    global rate_limiter
+    if app.config.get(backend_config):
+        rate_limiter = create_rate_limiter(app.config[backend_config], app.config.get(path_config))
+
+    return app
+
+
+def init_output_encoder(app, encoder_config='OUTPUT_ENCODER'):
+    """Select the encoder used to serialize JSON output, "json" or "orjson" """
+    global output_encoder
+    if app.config.get(encoder_config):
+        output_encoder = create_output_encoder(app.config[encoder_config])
+
+    return app
+
+
+def init_metrics(app, path_config='METRICS_PATH'):
+    """Set the directory where the worker processes share their metrics, so /metrics reports all workers"""
+    global metrics
+    if app.config.get(path_config):
+        metrics = create_metrics_registry(app.config[path_config])
+
+    return app
+
+
+def init_profiling(app, enabled_config='PROFILING_ENABLED', path_config='PROFILE_PATH'):
+    """Enable request profiling and set the directory the profiles are stored in"""
+    global profile_store
+    if app.config.get(enabled_config):
+        path = app.config.get(path_config) or os.path.join(tempfile.gettempdir(), "datasethoster-profiles")
+        profile_store = ProfileStore(path)
+
+    return app
+
+
+def init_reload_markers(app, path_config='RELOAD_MARKER_PATH'):
+    """Set the directory where the worker processes share which queries to reload. The default directory is
+       named after the process that creates the app, so it is shared by the workers that are forked from it"""
+    global reload_markers
+    path = app.config.get(path_config) or os.path.join(tempfile.gettempdir(),
+                                                        "datasethoster-reload-%d" % os.getpid())
+    reload_markers = ReloadMarkers(path)
+
+    return app
+
+
+def init_compression(app, encodings_config='COMPRESSION_ENCODINGS', min_size_config='COMPRESSION_MIN_SIZE'):
+    """Set the content encodings used to compress responses, e.g. ["gzip"] or [] to disable compression,
+       and the minimum size of the responses that are compressed"""
+    global compression_encodings, compression_min_size
+    if app.config.get(encodings_config) is not None:
+        unavailable = set(app.config[encodings_config]) - set(available_encodings())
+        if unavailable:
+            raise ValueError("Content encodings %s are not available" % ", ".join(sorted(unavailable)))
+        compression_encodings = list(app.config[encodings_config])
+    if app.config.get(min_size_config) is not None:
+        compression_min_size = app.config[min_size_config]
+
+    return app
+
+
+def register_query(query, setup_mode=SetupMode.blocking):
     """
         Applications that use this library must call this function for each query it wishes to host,
         providing a completed Query object that gives all the relevant information about the query.
+
+        The setup_mode controls when the query's setup function is called: blocking calls it right away,
+        background calls it in a background thread so that several queries can load in parallel while
+        the app already serves the queries that are ready, and lazy calls it on the first request.
     """
 
-    query.setup()
+    query_setup = QuerySetup(query, setup_mode)
+    if setup_mode == SetupMode.blocking:
+        query_setup.run()
+    elif setup_mode == SetupMode.background:
+        query_setup.run_in_background()
+
     slug, name = query.names()
     registered_queries[slug] = query
+    query_setups[slug] = query_setup
+    index_query_inputs(query)
     dataset_bp.add_url_rule('/%s' % slug, slug, web_query_handler)
     dataset_bp.add_url_rule('/%s/json' % slug, slug + "_json", json_query_handler, methods=['GET', 'POST', 'OPTIONS'])
+    dataset_bp.add_url_rule('/%s/export' % slug, slug + "_export", export_query_handler,
+                            methods=['GET', 'POST', 'OPTIONS'])
+
+
+def index_query_inputs(query):
+    """ Add the query's input fields to the index used to link query outputs to other queries. """
+    slug, name = query.names()
+    for field, entries in query_input_index.items():
+        entries[:] = [entry for entry in entries if entry[0] != slug]
+
+    inputs = list(query.inputs().__fields__.keys())
+    for field in inputs:
+        query_input_index[field].append((slug, name, inputs))
 
 
 @dataset_bp.route('/')
 def index():
     """ The home page that shows all of the available queries."""
-    return render_template("index.html", queries=registered_queries)
+    return render_template("index.html", queries=registered_queries, setups=query_setups)
+
+
+@dataset_bp.route('/health')
+@dataset_bp.route('/health/<slug>')
+def health(slug=None):
+    """ Report the setup status of all queries, or of a single query. Returns 503 if any is not ready. """
+    if slug is None:
+        setups = query_setups
+    elif slug in query_setups:
+        setups = {slug: query_setups[slug]}
+    else:
+        raise NotFound("Requested query '%s' not hosted on this site." % slug)
+
+    status = {name: query_setup.to_dict() for name, query_setup in setups.items()}
+    ready = all(query_setup.ready for query_setup in setups.values())
+    return jsonify(status), 200 if ready else 503
+
+
+def is_admin_request():
+    """ Check that the request carries the admin token set in the ADMIN_TOKEN config, as "Authorization: Token <token>" """
+    admin_token = current_app.config.get("ADMIN_TOKEN")
+    if not admin_token:
+        return False
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    return scheme.lower() == "token" and hmac.compare_digest(token.strip(), admin_token)
+
+
+def get_client_id():
+    """ Identify the client that made the request: by the name of its API key for clients that send one of the keys
+        in the API_KEYS config (a dict of key to client name) as "Authorization: Token <key>", and by IP otherwise """
+    api_keys = current_app.config.get("API_KEYS")
+    if api_keys:
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "token" and token.strip() in api_keys:
+            return "key:%s" % api_keys[token.strip()]
+    return "ip:%s" % request.remote_addr
+
+
+def is_trusted_client():
+    """ Check if the request was made by an admin or by a client whose API key name is in the TRUSTED_CLIENTS config.
+        The input items of trusted clients are not validated. """
+    if is_admin_request():
+        return True
+    trusted_clients = current_app.config.get("TRUSTED_CLIENTS")
+    if not trusted_clients:
+        return False
+    client_id = get_client_id()
+    return client_id.startswith("key:") and client_id[4:] in trusted_clients
+
+
+def get_batch_items(query):
+    """
+        Parse the JSON body of a POST request, which must be a list of input items. Raises RequestEntityTooLarge
+        if the list holds more items than the query's max_batch_size, or the MAX_BATCH_SIZE config if the query
+        doesn't set it.
+    """
+    try:
+        items = parse_json(request.get_data())
+    except ValueError as err:
+        raise BadRequest("Invalid JSON request body: %s" % err)
+    if not isinstance(items, list):
+        raise BadRequest("The request body must be a JSON list of input items")
+
+    max_batch_size = query.max_batch_size if query.max_batch_size is not None \
+        else current_app.config.get("MAX_BATCH_SIZE")
+    if max_batch_size and len(items) > max_batch_size:
+        raise RequestEntityTooLarge("The request has %d input items, at most %d are allowed per request."
+                                    % (len(items), max_batch_size))
+    return items
+
+
+def get_rate_limit(query):
+    """ Return the rate and burst of the query's rate limit, or None if the query is not rate limited. """
+    rate = query.rate_limit if query.rate_limit is not None else current_app.config.get("RATE_LIMIT")
+    if not rate:
+        return None
+    burst = query.rate_limit_burst or current_app.config.get("RATE_LIMIT_BURST") or rate * 10
+    return rate, burst
+
+
+def check_rate_limit(query, cost):
+    """
+        Take cost tokens (the number of input items of the request) from the client's token bucket for the
+        query. Raises TooManyRequests, with the number of seconds to wait in its Retry-After header, if the
+        client has made too many requests. Admin requests are not rate limited.
+    """
+    limit = get_rate_limit(query)
+    if limit is None or is_admin_request():
+        return
+
+    g.rate_limit_key = "%s:%s" % (query.names()[0], get_client_id())
+    retry_after = rate_limiter.acquire(g.rate_limit_key, cost, *limit)
+    if retry_after:
+        raise TooManyRequests("Rate limit exceeded, please slow down.", retry_after=format_retry_after(retry_after))
+
+
+def charge_rows(query, rows):
+    """ Charge the client for the rows returned by the query, for queries that set rate_limit_row_cost. """
+    key = g.get("rate_limit_key")
+    if key is None or not query.rate_limit_row_cost:
+        return
+    rate_limiter.charge(key, rows * query.rate_limit_row_cost, *get_rate_limit(query))
+
+
+def reload_query(slug):
+    """
+        Reload the data of a registered query in the background. Once the new data is loaded, the new query
+        object replaces the old one: new requests are served by it and requests in progress finish on the old
+        one. Returns False if the query is not ready to be reloaded.
+    """
+    query_setup = query_setups[slug]
+
+    def swap(new_setup):
+        registered_queries[slug] = new_setup.query
+        query_setups[slug] = new_setup
+        index_query_inputs(new_setup.query)
+        result_cache.clear(slug)
+
+    return query_setup.reload(swap)
+
+
+@dataset_bp.before_request
+def check_reload_markers():
+    """ Reload the queries that were asked to reload through another worker process since the last check. """
+    global last_reload_check
+    now = time.monotonic()
+    if reload_markers is None or now - last_reload_check < RELOAD_CHECK_INTERVAL:
+        return
+    last_reload_check = now
+
+    for slug, token in reload_markers.pending():
+        if slug not in query_setups:
+            continue
+        # queries that are still loading load the new data anyway, those that are reloading are retried later
+        if reload_query(slug) or not query_setups[slug].ready:
+            reload_markers.handled(slug, token)
+
+
+def reload_on_signal(signum=signal.SIGUSR2):
+    """ Install a handler that reloads the data of all registered queries when the process receives the signal.
+        Only the process that receives the signal reloads, so it must be sent to every worker process. """
+
+    def handler(signum, frame):
+        for slug in list(query_setups):
+            reload_query(slug)
+
+    signal.signal(signum, handler)
+
+
+@dataset_bp.route('/reload/<slug>', methods=['POST'])
+def reload_query_handler(slug):
+    """ Admin endpoint to reload the data of a query in all worker processes. The worker that handles the request
+        reloads the query right away, the others when they next check the reload markers. """
+    if not is_admin_request():
+        raise Forbidden("Reloading queries requires a valid admin token.")
+    if slug not in query_setups:
+        raise NotFound("Requested query '%s' not hosted on this site." % slug)
+    if not reload_query(slug):
+        raise Conflict("Query '%s' is not ready or is already reloading." % slug)
+    reload_markers.request(slug)
+    return jsonify({slug: query_setups[slug].to_dict()}), 202
+
+
+def check_query_ready(query):
+    """
+        Make sure that the query has been set up before it is used. Lazily set up queries are set up
+        by the first request, for queries that are not set up yet otherwise ServiceUnavailable is raised.
+    """
+    slug = query.names()[0]
+    query_setup = query_setups[slug]
+    if query_setup.ready:
+        return
+
+    if query_setup.mode == SetupMode.lazy:
+        try:
+            query_setup.run()
+        except Exception as err:
+            sentry_sdk.capture_exception(err)
+            print(traceback.format_exc())
+            raise ServiceUnavailable("Query '%s' failed to load: %s" % (slug, query_setup.error))
+        return
+
+    raise ServiceUnavailable("Query '%s' is %s, please try again later." % (slug, query_setup.status.value))
+
+
+@dataset_bp.route('/metrics')
+def metrics_handler():
+    """ Report the request metrics of all queries in the Prometheus text format. """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@dataset_bp.route('/profiles/<profile_id>')
+def profile_handler(profile_id):
+    """ Admin endpoint that returns the report of a profiled request. """
+    if profile_store is None:
+        raise NotFound("Profiling is not enabled.")
+    if not is_admin_request():
+        raise Forbidden("Viewing profiles requires a valid admin token.")
+    report = profile_store.load(profile_id)
+    if report is None:
+        raise NotFound("Profile '%s' not found." % profile_id)
+    return Response(report, mimetype="text/plain")
+
+
+def profiled(handler):
+    """
+        Profile the requests handled by a query view handler, when profiling is enabled in the app config.
+        Admins can profile a single request by passing the profile=1 argument or an X-Profile header: the
+        whole request, including streaming the response, is run under the deterministic profiler and the
+        URL of the report is returned in the X-Profile-URL header. For queries that set profile_threshold,
+        the stacks of requests that take longer than the threshold are sampled, and the report of the
+        samples is saved and reported to sentry.
+    """
+
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        if profile_store is None:
+            return handler(*args, **kwargs)
+
+        if request.args.get("profile") or request.headers.get("X-Profile"):
+            if not is_admin_request():
+                raise Forbidden("Profiling requests requires a valid admin token.")
+
+            def run():
+                response = make_response(handler(*args, **kwargs))
+                response.make_sequence()
+                return response
+
+            profile_id = profile_store.new_id()
+            response, report = run_with_profiler(run)
+            profile_store.save(profile_id, report)
+            response.headers["X-Profile-URL"] = url_for("dataset_hoster.profile_handler", profile_id=profile_id)
+            return response
+
+        query, _ = fetch_query(request.path)
+        if query is None or not query.profile_threshold:
+            return handler(*args, **kwargs)
+
+        profile_id = profile_store.new_id()
+        profile_url = url_for("dataset_hoster.profile_handler", profile_id=profile_id)
+        request_url = request.url
+        token = slow_request_watchdog.start_request(query.profile_threshold)
+        try:
+            response = make_response(handler(*args, **kwargs))
+        except BaseException:
+            save_slow_request_profile(token, profile_id, profile_url, request_url)
+            raise
+        # streamed responses are only done once the response is closed
+        response.call_on_close(lambda: save_slow_request_profile(token, profile_id, profile_url, request_url))
+        return response
+
+    return wrapper
+
+
+def save_slow_request_profile(token, profile_id, profile_url, request_url):
+    """ Stop sampling the request and save its samples if it was slower than the query's threshold. """
+    result = slow_request_watchdog.end_request(token)
+    if result is None:
+        return
+
+    duration, report = result
+    profile_store.save(profile_id, "Slow request %s took %.3fs\n\n%s\n" % (request_url, duration, report))
+    with sentry_sdk.push_scope() as scope:
+        scope.set_extra("profile_url", profile_url)
+        scope.set_extra("duration", duration)
+        sentry_sdk.capture_message("Slow request %s took %.3fs" % (request_url, duration), level="warning")
+
+
+@dataset_bp.after_request
+def count_request(response):
+    """ Count the requests handled for each query, by response status. """
+    labels = g.get("metrics_labels")
+    if labels:
+        metrics.inc("requests_total", labels + (str(response.status_code),))
+    return response
+
+
+def set_metrics_labels(query, source):
+    """ Set the labels of the metrics recorded for the current request and return them. """
+    g.metrics_labels = (query.names()[0], source.value)
+    return g.metrics_labels
 
 
 @dataset_bp.errorhandler(404)
@@ -96,33 +558,46 @@ def fetch_query(url):
 
 
 def fetch_matching_queries(columns: list[str]):
-    """ Retrieve queries one of whose input names matches the given column name """
-    columns = set(columns)
-    matches = []
-    for query in registered_queries.values():
-        input_model = query.inputs()
-        inputs = set(input_model.__fields__.keys())
-        matching_columns = columns.intersection(inputs)
-        if matching_columns:
-            matches.append((query, matching_columns))
-    return matches
-
-
-def get_links_for_output(columns, data):
-    """ Generate links to launch other queries for each output item in the data """
-    matches = fetch_matching_queries(columns)
-    urls = []
-    for row in data:
-        row_urls = defaultdict(list)
-        for (query, columns) in matches:
-            slug, name = query.names()
-            params = {column: row[column] for column in columns}
-            params["dryrun"] = True
-            url = f"{slug}?{urlencode(params)}"
-            for column in columns:
-                row_urls[column].append((name, url))
-        urls.append(row_urls)
-    return urls
+    """ Retrieve the slug, name and matching columns of queries one of whose input names matches the given column names """
+    matches = {}
+    for column in columns:
+        for slug, name, inputs in query_input_index.get(column, []):
+            if slug not in matches:
+                matches[slug] = (slug, name, [x for x in inputs if x in columns])
+    return list(matches.values())
+
+
+def get_links_for_output(columns):
+    """
+        Generate the templates of links to launch other queries from the output columns. For each column
+        there is a list of the other queries taking it as input, with the columns whose row values form the
+        query arguments. The links for each row are built in the browser, when the link dropdown is opened.
+    """
+    links = defaultdict(list)
+    for slug, name, matching_columns in fetch_matching_queries(columns):
+        for column in matching_columns:
+            links[column].append({"name": name, "slug": slug, "columns": matching_columns})
+    return dict(links)
+
+
+def get_output_columns(query):
+    """ Return the names of the output columns of the query, used to map tuple rows to columns. """
+    outputs = query.outputs()
+    if isinstance(outputs, type) and issubclass(outputs, BaseModel):
+        return list(outputs.__fields__.keys())
+    return list(outputs or [])
+
+
+def output_row_to_dict(row, columns):
+    """
+        Convert an output row to a dict. Queries may return pydantic models, or plain dicts and tuples
+        that are trusted to match the query's outputs, in which case no validation is carried out.
+    """
+    if isinstance(row, BaseModel):
+        return row.dict()
+    if isinstance(row, dict):
+        return row
+    return dict(zip(columns, row))
 
 
 def convert_result_group_to_output(groups: list[tuple[list[str], list[BaseModel]]]):
@@ -131,24 +606,32 @@ def convert_result_group_to_output(groups: list[tuple[list[str], list[BaseModel]
     for columns, values in groups:
         output = {
             "columns": columns,
-            "data": [x.dict() for x in values],
+            "data": [x.dict() if isinstance(x, BaseModel) else x for x in values],
             "no_table": isinstance(values[0], QueryOutputLine)
         }
         if not output["no_table"]:
-            output["links"] = get_links_for_output(output["columns"], output["data"])
+            output["links"] = get_links_for_output(output["columns"])
+            output["link_columns"] = {column for link in chain(*output["links"].values()) for column in link["columns"]}
         outputs.append(output)
     return outputs
 
 
+def get_row_keys(row):
+    """ Return the column names of a pydantic model or dict output row """
+    if isinstance(row, BaseModel):
+        return row.__fields__.keys()
+    return row.keys()
+
+
 def group_results(results):
     """ Create groups, consecutive outputs till their column list doesn't change, from results """
     if not results:
         return []
 
     groups = []
-    last_result, last_keys, last_group = results[0], results[0].__fields__.keys(), []
+    last_result, last_keys, last_group = results[0], get_row_keys(results[0]), []
     for result in results:
-        current_keys = result.__fields__.keys()
+        current_keys = get_row_keys(result)
         if current_keys != last_keys:
             groups.append((last_keys, last_group))
             last_keys, last_group = current_keys, []
@@ -161,10 +644,430 @@ def group_results(results):
     return groups
 
 
+def dispatch_fetch(query, inputs, source, **kwargs):
+    """
+        Call the query's fetch function, in the query's process pool if it has one, running it to
+        completion on the shared event loop for async queries.
+    """
+    if query.process_workers:
+        return get_process_pool(query).fetch(inputs, source, **kwargs)
+    if isinstance(query, AsyncQuery):
+        return run_coroutine(query.fetch_all(inputs, source, **kwargs), query.fetch_timeout)
+    return query.fetch(inputs, source, **kwargs)
+
+
+def get_admission_control(query):
+    """ Return the admission control of the query, or None if the query doesn't limit its concurrent fetches. """
+    if not query.max_concurrent_fetches:
+        return None
+
+    slug = query.names()[0]
+    control = admission_controls.get(slug)
+    if control is None:
+        control = admission_controls.setdefault(slug, AdmissionControl(query.max_concurrent_fetches,
+                                                                       query.max_queued_fetches,
+                                                                       query.queue_timeout))
+    return control
+
+
+def guard_results(results, deadline, release):
+    """ Apply the deadline to the rows of results that are produced as they are iterated, and call release once
+        they have been produced, or right away for results that are complete already. """
+    if isinstance(results, ResultPage) and not isinstance(results.results, (list, ColumnarResult)):
+        return ResultPage(GuardedRows(results.results, deadline, release), results.cursor)
+    if not isinstance(results, (list, ColumnarResult, ResultPage)):
+        return GuardedRows(results, deadline, release)
+    release()
+    return results
+
+
+def call_fetch(query, inputs, source, **kwargs):
+    """
+        Call the query's fetch function. For queries that limit their concurrent fetches, the call waits for
+        a slot first and ServiceUnavailable is raised if it is rejected. For queries with a fetch_timeout,
+        TimeoutError is raised if fetch doesn't complete in time. Sync fetch functions are then run in a
+        separate thread, so that the request can fail while they keep running; their slot is only released
+        once they return.
+    """
+    control = get_admission_control(query)
+    if control is None and not query.fetch_timeout:
+        return dispatch_fetch(query, inputs, source, **kwargs)
+
+    if control is not None:
+        try:
+            control.acquire()
+        except QueueFull as err:
+            raise ServiceUnavailable("Query '%s' is overloaded: %s" % (query.names()[0], err), retry_after=1)
+    release = control.release if control is not None else (lambda: None)
+
+    deadline = None
+    if query.fetch_timeout:
+        deadline = time.monotonic() + query.fetch_timeout
+        if query.supports_deadline:
+            kwargs["deadline"] = deadline
+
+    def run():
+        try:
+            results = dispatch_fetch(query, inputs, source, **kwargs)
+        except BaseException:
+            release()
+            raise
+        return guard_results(results, deadline, release)
+
+    # async queries are cancelled by the event loop when they time out
+    if deadline is None or (isinstance(query, AsyncQuery) and not query.process_workers):
+        return run()
+    return run_with_timeout(run, query.fetch_timeout)
+
+
+def materialize_results(results):
+    """ Read the results of a fetch call into a list, unless they are a list or columnar result already. """
+    if isinstance(results, ResultPage):
+        if not isinstance(results.results, (list, ColumnarResult)):
+            results = ResultPage(list(results.results), results.cursor)
+    elif not isinstance(results, (list, ColumnarResult)):
+        results = list(results)
+    return results
+
+
+def uses_per_input_cache(query):
+    """ Return whether the rows of each input item of the query are cached separately. """
+    return query.cache_per_input and query.cache_ttl and not query.supports_cursor
+
+
+def fetch_per_input(query, inputs, source):
+    """
+        Fetch the results of a query that caches the rows of each input item separately. Only the input items
+        that are missing from the cache are passed to fetch, all their rows are cached and the rows of all items
+        are merged in input order, paginate_results then applies offset and count. Returns the rows and whether
+        all of them came from the cache.
+    """
+    slug = query.names()[0]
+    keys = [make_cache_key(slug, [item], source) for item in inputs]
+    rows = result_cache.get_many(slug, keys)
+    missing = {}
+    for key, item in dict(zip(keys, inputs)).items():
+        if key not in rows:
+            missing[key] = item
+        metrics.inc("cache_requests_total", (slug, "hit" if key in rows else "miss"))
+
+    def fetch():
+        items = list(missing.values())
+        results = materialize_results(call_fetch(query, items, source))
+        fetched = dict(zip(missing, query.split_results(items, results)))
+        result_cache.set_many(slug, fetched, query.cache_ttl, query.cache_size)
+        return fetched
+
+    if missing:
+        if query.single_flight:
+            fetched, shared = fetch_flights.do((id(query), tuple(missing)), fetch, query.single_flight_timeout)
+            if shared:
+                metrics.inc("coalesced_requests_total", (slug,))
+        else:
+            fetched = fetch()
+        rows.update(fetched)
+
+    return [row for key in keys for row in rows[key]], not missing
+
+
+def fetch_results(query, inputs, source, **kwargs):
+    """
+        Run the query's fetch function, serving the results from the result cache if the query
+        has a cache_ttl set. The keyword arguments (offset/count) are passed through to fetch and
+        are part of the cache key. For queries that enable single_flight, identical concurrent calls
+        share a single fetch call and its results, or its exception. Returns the results and whether
+        they came from the cache.
+    """
+    if uses_per_input_cache(query):
+        return fetch_per_input(query, inputs, source)
+
+    if not query.cache_ttl and not query.single_flight:
+        return call_fetch(query, inputs, source, **kwargs), False
+
+    slug = query.names()[0]
+    key = make_cache_key(slug, inputs, source, kwargs.get("offset"), kwargs.get("count"), kwargs.get("cursor"))
+    if query.cache_ttl:
+        results = result_cache.get(slug, key)
+        metrics.inc("cache_requests_total", (slug, "miss" if results is None else "hit"))
+        if results is not None:
+            return results, True
+
+    def fetch():
+        results = materialize_results(call_fetch(query, inputs, source, **kwargs))
+        if query.cache_ttl:
+            result_cache.set(slug, key, results, query.cache_ttl, query.cache_size)
+        return results
+
+    if not query.single_flight:
+        return fetch(), False
+
+    # the query object is part of the key, so that requests don't share the results of a query that was reloaded
+    results, shared = fetch_flights.do((id(query), key), fetch, query.single_flight_timeout)
+    if shared:
+        metrics.inc("coalesced_requests_total", (slug,))
+    return results, False
+
+
+def encode_cursor(slug, cursor):
+    """ Encode the cursor returned by a query as an opaque token to hand out to clients. """
+    data = json.dumps([slug, cursor], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(slug, token):
+    """ Decode a cursor token handed out by encode_cursor, checking that it belongs to the given query. """
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        cursor_slug, cursor = json.loads(data)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise BadRequest("Invalid cursor")
+
+    if cursor_slug != slug:
+        raise BadRequest("Invalid cursor")
+    return cursor
+
+
+def is_paging_requested(arguments):
+    """ Return whether the client asks for a page of the results with the offset, count or cursor arguments. """
+    return any(name in arguments for name in PAGING_ARGUMENTS)
+
+
+def get_paging_arguments(query, arguments, default_count=None):
+    """
+        Parse the offset, count and cursor request arguments into the keyword arguments passed to
+        the query's fetch function. If the client doesn't ask for a page, fetch is passed an offset of
+        0 and default_count, or -1 for both (all rows) if default_count is None. Queries that support
+        cursors always get a count. Raises BadRequest if the arguments are invalid.
+    """
+    requested = is_paging_requested(arguments)
+    if requested or default_count is not None or query.supports_cursor:
+        default_offset, default_count = 0, default_count or DEFAULT_QUERY_RESULT_SIZE
+    else:
+        default_offset, default_count = -1, -1
+    try:
+        offset = int(arguments.get("offset", default_offset))
+        count = int(arguments.get("count", default_count))
+    except ValueError:
+        raise BadRequest("offset and count arguments must be integers")
+    if offset < 0 and "offset" in arguments or count < 0 and "count" in arguments:
+        raise BadRequest("offset and count arguments must not be negative")
+
+    paging = {"offset": offset, "count": count}
+    if query.supports_cursor:
+        token = arguments.get("cursor")
+        paging["cursor"] = decode_cursor(query.names()[0], token) if token else None
+    elif "cursor" in arguments:
+        raise BadRequest("This query does not support cursors")
+    return paging
+
+
+def slice_rows(rows, start, stop):
+    """ Yield the rows from start up to stop of rows that are produced as they are iterated, closing them
+        once the slice has been produced. """
+    try:
+        yield from islice(rows, start, stop)
+    finally:
+        if hasattr(rows, "close"):
+            rows.close()
+
+
+def paginate_results(query, results, paging, requested):
+    """
+        Apply the paging arguments to the results of a fetch call. Unwraps a ResultPage returned by queries
+        that support cursors. If the client asked for a page (requested), the hoster applies offset and count
+        to the results of queries that set paged_by_hoster or cache the rows of each input item, the results
+        of other queries are paged by fetch. Returns the results, the cursor for the next page, if any, and
+        whether there are more rows after this page, or None if that is up to the query.
+    """
+    if isinstance(results, ResultPage):
+        return results.results, results.cursor, None
+    if not requested:
+        return results, None, False
+    if not query.paged_by_hoster and not uses_per_input_cache(query):
+        return results, None, None
+
+    offset = paging["offset"]
+    stop = offset + paging["count"]
+    if isinstance(results, ColumnarResult):
+        return results.slice(offset, stop), None, len(results) > stop
+    if isinstance(results, list):
+        return results[offset:stop], None, len(results) > stop
+    # rows that are streamed are not counted ahead, so they don't get a link to the next page
+    return slice_rows(results, offset, stop), None, False
+
+
+def get_next_page_arguments(query, results, paging, cursor, more=None):
+    """
+        Return the request arguments to fetch the page after the given results, or None if this is the last
+        page. more tells whether the hoster found more rows after this page when it applied offset and count,
+        for queries that apply them themselves (more is None) a full page may be followed by another.
+    """
+    if "cursor" in paging:
+        if cursor is None:
+            return None
+        return {"cursor": encode_cursor(query.names()[0], cursor), "count": paging["count"]}
+
+    if more is None:
+        more = isinstance(results, (list, ColumnarResult)) and 0 < paging["count"] <= len(results)
+    if more:
+        return {"offset": paging["offset"] + paging["count"], "count": paging["count"]}
+    return None
+
+
+def get_page_url(page_arguments):
+    """ Return the URL of the current request with the paging arguments replaced by the given arguments. """
+    arguments = request.args.copy()
+    for name in ("offset", "count", "cursor"):
+        arguments.pop(name, None)
+    arguments.update(page_arguments)
+    return "%s?%s" % (request.path, urlencode(list(arguments.items(multi=True))))
+
+
+def get_response_key(query, inputs, source, paging, representation):
+    """
+        Return a key that identifies the body of a response: the query, the canonical inputs, the paging
+        arguments and the representation of the response (e.g. the mimetype and content encoding).
+    """
+    key = make_cache_key(query.names()[0], inputs, source, paging.get("offset"), paging.get("count"),
+                         paging.get("cursor"))
+    return hashlib.sha256(("%s\0%s" % (key, representation)).encode("utf-8")).hexdigest()
+
+
+def get_etag(query, response_key):
+    """
+        Return the strong ETag of a response, derived from the version of the query's data and the key
+        of the response. Returns None for queries that don't report a version.
+    """
+    version = query.version()
+    if version is None:
+        return None
+    return hashlib.sha256(("%s\0%s" % (version, response_key)).encode("utf-8")).hexdigest()
+
+
+def set_cache_headers(response, query, etag):
+    """ Set the ETag and Cache-Control headers of a response of a query that reports its version. """
+    if etag is None:
+        return response
+
+    response.set_etag(etag)
+    if query.http_max_age:
+        response.headers["Cache-Control"] = "public, max-age=%d" % query.http_max_age
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def not_modified_response(query, etag):
+    """ Return a 304 response if the client already has the current version of the response, otherwise None.
+        Only GET requests are conditional, the responses of POST requests carry an ETag for information. """
+    if etag is None or request.method not in ("GET", "HEAD") or not request.if_none_match.contains_weak(etag):
+        return None
+    return set_cache_headers(Response(status=304), query, etag)
+
+
+def get_content_encoding():
+    """ Return the content encoding to compress the response with, or None if it is not to be compressed. """
+    if not compression_encodings:
+        return None
+    return negotiate_encoding(request.accept_encodings, compression_encodings)
+
+
+def get_cached_response(query, response_key):
+    """ Return the response with the given key from the result cache, for queries that cache their results. """
+    if not query.cache_ttl or response_key is None:
+        return None
+
+    slug = query.names()[0]
+    cached = result_cache.get(slug, response_key)
+    if cached is None:
+        return None
+
+    metrics.inc("cache_requests_total", (slug, "hit"))
+    body, headers = cached
+    response = Response(body, headers=headers)
+    response.headers["X-Cache"] = "HIT"
+    return response
+
+
+@dataset_bp.after_request
+def compress_response(response):
+    """
+        Compress JSON and HTML responses with the best content encoding accepted by the client. Streamed
+        responses are compressed chunk by chunk as they are sent, responses smaller than the minimum size
+        are sent as they are. If the handler set g.response_cache, the compressed body is stored in the
+        result cache once it is complete, so that it is only compressed once.
+    """
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or not compression_encodings:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = get_content_encoding()
+    if encoding is None or response.status_code != 200 or "Content-Encoding" in response.headers:
+        return response
+
+    cache_entry = g.get("response_cache")
+    if not response.is_streamed:
+        data = response.get_data()
+        if len(data) < compression_min_size:
+            return response
+        response.set_data(compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+        if cache_entry is not None and cache_entry["complete"]:
+            store_cached_response(cache_entry, response, [response.get_data()])
+        return response
+
+    # read the start of the body to find out whether the response is large enough to be compressed
+    original, chunks = response.response, response.iter_encoded()
+    head, size = [], 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= compression_min_size:
+            break
+    else:
+        response.set_data(b"".join(head))
+        return response
+
+    response.headers["Content-Encoding"] = encoding
+    response.headers.pop("Content-Length", None)
+    response.response = stream_compressed(chain(head, chunks), encoding, original, response, cache_entry)
+    return response
+
+
+def stream_compressed(chunks, encoding, original, response, cache_entry):
+    """ Compress the chunks of a streamed response, storing the compressed body in the result cache if the
+        whole body was produced and is no larger than MAX_CACHED_RESPONSE_SIZE. """
+    body, size = [] if cache_entry is not None else None, 0
+    try:
+        for data in compress_chunks(chunks, encoding):
+            if body is not None:
+                size += len(data)
+                if size > MAX_CACHED_RESPONSE_SIZE:
+                    body = None
+                else:
+                    body.append(data)
+            yield data
+
+        if body is not None and cache_entry["complete"]:
+            store_cached_response(cache_entry, response, body)
+    finally:
+        if hasattr(original, "close"):
+            original.close()
+
+
+def store_cached_response(cache_entry, response, body):
+    headers = [(name, value) for name, value in response.headers.items()
+               if name not in ("Content-Length", "X-Cache")]
+    result_cache.set(cache_entry["slug"], cache_entry["key"], (b"".join(body), headers),
+                     cache_entry["ttl"], cache_entry["size"])
+
+
 def convert_args_to_input(input_model: BaseModel, arguments: MultiDict):
-    """ Convert the request arguments (query parameters) to input for passing to query. """
+    """ Convert the request arguments (query parameters) to input for passing to query. The reserved arguments
+        that control the hoster are left out, unless the input model has a field of that name. """
     params = {}
     for key, values in arguments.lists():
+        if key in RESERVED_ARGUMENTS and key not in input_model.__fields__:
+            continue
         # user submitted multiple values for query parameter pass all to field in all cases, model will raise
         # a ValidationError in case of mismatch
         if len(values) > 1:
@@ -182,6 +1085,45 @@ def convert_args_to_input(input_model: BaseModel, arguments: MultiDict):
     return params
 
 
+def render_page_stream(template_name, labels, **context):
+    """
+        Render a template as a stream of chunks of about STREAM_CHUNK_SIZE bytes, so that a large page doesn't
+        have to be built in memory before it is sent and the browser can start to display it right away. The
+        template is rendered with the given context only, it can't use the request once the stream has started.
+    """
+    app = current_app._get_current_object()
+    template = app.jinja_env.get_or_select_template(template_name)
+    app.update_template_context(context)
+
+    def generate():
+        chunk, size = [], 0
+        total_size, elapsed = 0, 0.0
+        start = time.perf_counter()
+        try:
+            for text in template.generate(context):
+                chunk.append(text)
+                size += len(text)
+                if size >= STREAM_CHUNK_SIZE:
+                    data = "".join(chunk).encode("utf-8")
+                    chunk, size = [], 0
+                    total_size += len(data)
+                    elapsed += time.perf_counter() - start
+                    yield data
+                    start = time.perf_counter()
+
+            data = "".join(chunk).encode("utf-8")
+            total_size += len(data)
+            elapsed += time.perf_counter() - start
+            if data:
+                yield data
+        finally:
+            metrics.observe("stage_duration_seconds", labels + ("serialization",), elapsed)
+            metrics.observe("response_bytes", labels, total_size)
+
+    return Response(generate(), mimetype="text/html")
+
+
+@profiled
 def web_query_handler():
     """
         This is the view handler for the web page. It is more complex because of all
@@ -191,12 +1133,26 @@ def web_query_handler():
     if error:
         return render_template("error.html", error=error)
 
-    offset = int(request.args.get('offset', "-1"))
-    count = int(request.args.get('count', "-1"))
-    if offset >= 0 or count >= 0:
-        return render_template("error.html", error="offset and count arguments are only supported for the POST method")
+    try:
+        check_query_ready(query)
+    except ServiceUnavailable as err:
+        return render_template("error.html", error=err.description), 503
+
+    try:
+        paging = get_paging_arguments(query, request.args)
+    except BadRequest as err:
+        return render_template("error.html", error=err.description)
     dryrun = request.args.get("dryrun", None)
 
+    # larger results are paged, or downloaded from the JSON endpoint, the page says so if the limit is reached
+    requested = is_paging_requested(request.args)
+    max_rows = current_app.config.get("HTML_MAX_ROWS", DEFAULT_HTML_MAX_ROWS)
+    row_limit = None
+    if max_rows and (paging["count"] < 0 or paging["count"] > max_rows):
+        paging["offset"] = max(paging["offset"], 0)
+        paging["count"] = row_limit = max_rows
+        requested = True
+
     slug, desc = query.names()
     introduction = query.introduction()
     input_model = query.inputs()
@@ -204,25 +1160,66 @@ def web_query_handler():
 
     outputs = []
     json_post = ""
+    prev_url, next_url = None, None
+    etag = None
+    labels = set_metrics_labels(query, RequestSource.web)
     if request.args and not dryrun:
         try:
-            params = convert_args_to_input(input_model, request.args)
-            inputs = [input_model(**params)]
-            results = query.fetch(inputs, RequestSource.web)
+            check_rate_limit(query, 1)
+        except TooManyRequests as err:
+            return render_template("error.html", error=err.description), 429, {"Retry-After": str(err.retry_after)}
+
+        try:
+            with metrics.timer("stage_duration_seconds", labels + ("validation",)):
+                params = convert_args_to_input(input_model, request.args)
+                inputs = [input_model(**params)]
+            # the page shows the arguments in the form, so they are all part of the representation
+            representation = "html?%s;%s" % (urlencode(sorted(request.args.items(multi=True))),
+                                             get_content_encoding())
+            etag = get_etag(query, get_response_key(query, inputs, RequestSource.web, paging, representation))
+            response = not_modified_response(query, etag)
+            if response is not None:
+                return response
+            with metrics.timer("stage_duration_seconds", labels + ("fetch",)):
+                results, _ = fetch_results(query, inputs, RequestSource.web, **paging)
+                results, cursor, more = paginate_results(query, results, paging, requested)
+                if isinstance(results, ColumnarResult):
+                    results = results.to_dicts()
+                else:
+                    columns = get_output_columns(query)
+                    results = [row if isinstance(row, (BaseModel, dict)) else output_row_to_dict(row, columns)
+                               for row in results]
+                if row_limit and len(results) > row_limit:
+                    results, more = results[:row_limit], True
         except RedirectError as red:
             return redirect(red.url)
+        except (ServiceUnavailable, TimeoutError) as err:
+            err = err if isinstance(err, ServiceUnavailable) else GatewayTimeout(str(err))
+            return render_template("error.html", error=err.description), err.code
         except Exception as err:
             error = traceback.format_exc()
             sentry_sdk.capture_exception(err)
             return render_template("error.html", error=error)
 
-        groups = group_results(results)
-        outputs = convert_result_group_to_output(groups)
+        with metrics.timer("stage_duration_seconds", labels + ("links",)):
+            groups = group_results(results)
+            outputs = convert_result_group_to_output(groups)
+        metrics.observe("result_rows", labels, len(results))
+        charge_rows(query, len(results))
+        if row_limit and len(results) < row_limit:
+            row_limit = None
+
+        next_page = get_next_page_arguments(query, results, paging, cursor, more)
+        if next_page:
+            next_url = get_page_url(next_page)
+        if "cursor" not in paging and paging["offset"] > 0:
+            prev_url = get_page_url({"offset": max(paging["offset"] - paging["count"], 0), "count": paging["count"]})
 
         json_post = QueryOutputWrapperModel(__root__=inputs).json(indent=4)
 
-    return render_template(
+    response = render_page_stream(
         "query.html",
+        labels,
         error=error,
         fields=input_model.__fields__.values(),
         results=outputs,
@@ -232,10 +1229,188 @@ def web_query_handler():
         slug=slug,
         json_url=json_url,
         json_post=json_post,
+        prev_url=prev_url,
+        next_url=next_url,
+        offset=paging["offset"],
+        row_limit=row_limit if outputs else None,
         additional_data=query.additional_data()
     )
+    return set_cache_headers(response, query, etag)
+
+
+def start_results(results):
+    """
+        Fetch the first row of the results, so that errors raised by a fetch function that returns
+        a generator are raised before the response is started. Returns an iterator over all rows.
+    """
+    if isinstance(results, ColumnarResult):
+        return results
+
+    rows = iter(results)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return iter(())
+    return chain((first,), rows)
+
+
+def raise_fetch_error(err):
+    """ Raise the error response for an error raised while the results were fetched or read: 504 if the query
+        timed out, 500 otherwise. """
+    if isinstance(err, ServiceUnavailable):
+        raise err
+    if isinstance(err, TimeoutError):
+        raise GatewayTimeout(str(err))
+    sentry_sdk.capture_exception(err)
+    print(traceback.format_exc())
+    raise InternalServerError(str(err))
 
 
+def start_stream(chunks, error_marker):
+    """
+        Read the first STREAM_CHUNK_SIZE bytes of a streamed response body before the response is started, so
+        that a fetch function that fails or times out while producing a small result still gets an error status.
+        Errors raised once the response has started can only be reported in the body: the data returned by
+        error_marker(err) is sent as the end of the body instead. Returns an iterator over the whole body.
+    """
+    head, size = [], 0
+    try:
+        for data in chunks:
+            head.append(data)
+            size += len(data)
+            if size >= STREAM_CHUNK_SIZE:
+                break
+    except Exception as err:
+        raise_fetch_error(err)
+    return finish_stream(head, chunks, error_marker)
+
+
+def finish_stream(head, chunks, error_marker):
+    yield from head
+    try:
+        yield from chunks
+    except Exception as err:
+        sentry_sdk.capture_exception(err)
+        print(traceback.format_exc())
+        yield error_marker(err)
+
+
+def serialize_error(err, mimetype):
+    """ Serialize the error that ended a streamed JSON response part way, as a last line with an object that has
+        an error key. JSON arrays are left unterminated, so that the rows sent can't be taken for the whole
+        result. """
+    line = output_encoder.encode({"error": str(err)})
+    return line + b"\n" if mimetype == NDJSON_MIMETYPE else b"\n" + line
+
+
+def serialize_rows(rows, columns, mimetype, labels, on_complete=None):
+    """
+        Serialize the output rows one at a time with the output encoder, either as a JSON array or
+        as newline delimited JSON, and yield the serialized data in chunks of about STREAM_CHUNK_SIZE bytes.
+        The time spent serializing, excluding the time spent sending the chunks, is recorded in the metrics.
+        on_complete is called once all rows have been serialized without errors, errors are left to start_stream.
+    """
+    ndjson = mimetype == NDJSON_MIMETYPE
+    encode = output_encoder.encode
+    chunk, size = [] if ndjson else [b"["], 0
+    row_count, total_size, elapsed = 0, 0, 0.0
+    start = time.perf_counter()
+    try:
+        for row_count, row in enumerate(rows, 1):
+            line = encode(output_row_to_dict(row, columns))
+            if ndjson:
+                chunk.append(line + b"\n")
+            else:
+                chunk.append(line if row_count == 1 else b", " + line)
+            size += len(line)
+            if size >= STREAM_CHUNK_SIZE:
+                data = b"".join(chunk)
+                chunk, size = [], 0
+                total_size += len(data)
+                elapsed += time.perf_counter() - start
+                yield data
+                start = time.perf_counter()
+
+        if not ndjson:
+            chunk.append(b"]")
+        data = b"".join(chunk)
+        total_size += len(data)
+        elapsed += time.perf_counter() - start
+        if on_complete is not None:
+            on_complete()
+        if data:
+            yield data
+    finally:
+        metrics.observe("stage_duration_seconds", labels + ("serialization",), elapsed)
+        metrics.observe("result_rows", labels, row_count)
+        metrics.observe("response_bytes", labels, total_size)
+
+
+def convert_rows_to_columnar(rows, columns):
+    """ Convert output rows to a columnar result, with the columns in the order they first appear. """
+    rows = [output_row_to_dict(row, columns) for row in rows]
+    names = dict.fromkeys(key for row in rows for key in row) if rows else columns
+    return ColumnarResult({name: [row.get(name) for row in rows] for name in names})
+
+
+def get_json_representation():
+    """ Return the orient argument and the negotiated mimetype of a JSON response. """
+    orient = request.args.get("orient", "rows")
+    if orient not in ("rows", "columns"):
+        raise BadRequest("orient must be either 'rows' or 'columns'")
+    if orient == "columns":
+        return orient, JSON_MIMETYPE
+    return orient, request.accept_mimetypes.best_match([JSON_MIMETYPE, NDJSON_MIMETYPE], JSON_MIMETYPE)
+
+
+def json_response(data, query, cached, labels, next_page=None, etag=None, response_key=None):
+    """
+        Build a streaming JSON response for the results, as NDJSON if the client asked for it, and
+        report whether the result cache was used for this query. If there is a next page, a Link
+        header to it is added, along with an X-Next-Cursor header for queries that support cursors.
+        If the orient=columns argument is given, the results are returned as a single object of
+        column name to list of values instead. For queries that cache their results, the response
+        is stored in the result cache under the response_key once it has been compressed.
+    """
+    orient, mimetype = get_json_representation()
+    columns = get_output_columns(query)
+    cache_entry = None
+    if query.cache_ttl and response_key:
+        cache_entry = {"slug": query.names()[0], "key": response_key, "ttl": query.cache_ttl,
+                       "size": query.cache_size, "complete": orient == "columns"}
+        g.response_cache = cache_entry
+
+    if orient == "columns":
+        with metrics.timer("stage_duration_seconds", labels + ("serialization",)):
+            if not isinstance(data, ColumnarResult):
+                try:
+                    data = convert_rows_to_columnar(data, columns)
+                except Exception as err:
+                    raise_fetch_error(err)
+            body = output_encoder.encode(data.to_lists())
+        metrics.observe("result_rows", labels, len(data))
+        metrics.observe("response_bytes", labels, len(body))
+    else:
+        if isinstance(data, ColumnarResult):
+            data, columns = data.iter_rows(), data.column_names()
+        on_complete = (lambda: cache_entry.update(complete=True)) if cache_entry is not None else None
+        body = start_stream(serialize_rows(data, columns, mimetype, labels, on_complete),
+                            lambda err: serialize_error(err, mimetype))
+        body = stream_with_context(body)
+
+    response = Response(body, mimetype=mimetype)
+    response.vary.add("Accept")
+    set_cache_headers(response, query, etag)
+    if query.cache_ttl:
+        response.headers["X-Cache"] = "HIT" if cached else "MISS"
+    if next_page:
+        response.headers["Link"] = '<%s>; rel="next"' % get_page_url(next_page)
+        if "cursor" in next_page:
+            response.headers["X-Next-Cursor"] = next_page["cursor"]
+    return response
+
+
+@profiled
 @crossdomain(headers=["Content-Type"])
 def json_query_handler():
     """
@@ -261,29 +1436,51 @@ def json_query_handler_get():
     query, error = fetch_query(request.path)
     if error:
         raise BadRequest(error)
+    check_query_ready(query)
 
-    offset = int(request.args.get('offset', "-1"))
-    count = int(request.args.get('count', "-1"))
-    if offset >= 0 or count >= 0:
-        raise BadRequest("offset and count arguments are only supported for the POST method")
-
+    paging = get_paging_arguments(query, request.args)
     input_model = query.inputs()
+    labels = set_metrics_labels(query, RequestSource.json_get)
+    check_rate_limit(query, 1)
 
     try:
-        params = convert_args_to_input(input_model, request.args)
-        inputs = [input_model(**params)]
+        with metrics.timer("stage_duration_seconds", labels + ("validation",)):
+            params = convert_args_to_input(input_model, request.args)
+            inputs = [input_model(**params)]
     except Exception as e:
         raise BadRequest(str(e))
 
+    encoding = get_content_encoding()
+    representation = "%s;%s;%s" % (get_json_representation() + (encoding,))
+    response_key = get_response_key(query, inputs, RequestSource.json_get, paging, representation)
+    etag = get_etag(query, response_key)
+    response = not_modified_response(query, etag)
+    if response is not None:
+        return response
+    # only compressed responses are cached
+    response_key = response_key if encoding else None
+    response = get_cached_response(query, response_key)
+    if response is not None:
+        return response
+
     try:
-        data = query.fetch(inputs, RequestSource.json_get)
-        result = QueryOutputWrapperModel(__root__=data)
+        with metrics.timer("stage_duration_seconds", labels + ("fetch",)):
+            data, cached = fetch_results(query, inputs, RequestSource.json_get, **paging)
+            data, cursor, more = paginate_results(query, data, paging, is_paging_requested(request.args))
+            if isinstance(data, (list, ColumnarResult)):
+                charge_rows(query, len(data))
+            next_page = get_next_page_arguments(query, data, paging, cursor, more)
+            data = start_results(data)
+    except ServiceUnavailable:
+        raise
+    except TimeoutError as err:
+        raise GatewayTimeout(str(err))
     except Exception as err:
         sentry_sdk.capture_exception(err)
         print(traceback.format_exc())
         return jsonify({}), 500
 
-    return Response(result.json(), mimetype="application/json")
+    return json_response(data, query, cached, labels, next_page, etag, response_key)
 
 
 def json_query_handler_post():
@@ -294,25 +1491,155 @@ def json_query_handler_post():
     query, error = fetch_query(request.path)
     if error:
         raise BadRequest(error)
+    check_query_ready(query)
 
-    input_model = query.inputs()
+    labels = set_metrics_labels(query, RequestSource.json_post)
+    items = get_batch_items(query)
+    # the request is charged before its items are validated, validating a large batch is expensive too
+    check_rate_limit(query, len(items))
 
-    inputs = []
+    validator = get_batch_validator(query.inputs())
     try:
-        for item in request.json:
-            inputs.append(input_model(**item))
+        with metrics.timer("stage_duration_seconds", labels + ("validation",)):
+            inputs = validator.validate(items, trusted=is_trusted_client())
     except Exception as e:
         raise BadRequest(str(e))
 
-    offset = int(request.args.get('offset', "0"))
-    count = int(request.args.get('count', str(DEFAULT_QUERY_RESULT_SIZE)))
+    paging = get_paging_arguments(query, request.args, DEFAULT_QUERY_RESULT_SIZE)
+    encoding = get_content_encoding()
+    representation = "%s;%s;%s" % (get_json_representation() + (encoding,))
+    response_key = get_response_key(query, inputs, RequestSource.json_post, paging, representation)
+    etag = get_etag(query, response_key)
+    # only compressed responses are cached
+    response_key = response_key if encoding else None
+    response = get_cached_response(query, response_key)
+    if response is not None:
+        return response
 
     try:
-        data = query.fetch(inputs, RequestSource.json_post, offset=offset, count=count)
-        result = QueryOutputWrapperModel(__root__=data)
+        with metrics.timer("stage_duration_seconds", labels + ("fetch",)):
+            data, cached = fetch_results(query, inputs, RequestSource.json_post, **paging)
+            data, cursor, more = paginate_results(query, data, paging, is_paging_requested(request.args))
+            if isinstance(data, (list, ColumnarResult)):
+                charge_rows(query, len(data))
+            next_page = get_next_page_arguments(query, data, paging, cursor, more)
+            data = start_results(data)
+    except ServiceUnavailable:
+        raise
+    except TimeoutError as err:
+        raise GatewayTimeout(str(err))
     except Exception as err:
         sentry_sdk.capture_exception(err)
         print(traceback.format_exc())
         return jsonify({"error": err}), 400
 
-    return Response(result.json(), mimetype="application/json")
+    return json_response(data, query, cached, labels, next_page, etag, response_key)
+
+
+def export_rows(writer, rows, labels):
+    """
+        Write the output rows with the export writer, yielding the exported data as it is produced. The time
+        spent writing, excluding the time spent sending the data, is recorded in the metrics.
+    """
+    row_count, total_size, elapsed = 0, 0, 0.0
+    start = time.perf_counter()
+
+    def count_rows(batches):
+        nonlocal row_count
+        for batch in batches:
+            row_count += len(batch)
+            yield batch
+
+    try:
+        for data in writer.write(count_rows(batch_rows(rows))):
+            total_size += len(data)
+            elapsed += time.perf_counter() - start
+            yield data
+            start = time.perf_counter()
+        elapsed += time.perf_counter() - start
+    finally:
+        metrics.observe("stage_duration_seconds", labels + ("serialization",), elapsed)
+        metrics.observe("result_rows", labels, row_count)
+        metrics.observe("response_bytes", labels, total_size)
+
+
+@profiled
+@crossdomain(headers=["Content-Type"])
+def export_query_handler():
+    """
+        Export the results of a query as CSV, NDJSON, Arrow or Parquet, chosen with the format argument or
+        the Accept header. GET requests take the inputs from the query parameters like the JSON endpoint,
+        POST requests take a JSON list of input items. Unless a count is given, up to DEFAULT_EXPORT_SIZE rows
+        are exported.
+    """
+    query, error = fetch_query(request.path)
+    if error:
+        raise BadRequest(error)
+    check_query_ready(query)
+
+    formats = available_formats()
+    export_format = negotiate_format(request.args.get("format"), request.accept_mimetypes, formats)
+    if export_format is None:
+        raise NotAcceptable("The supported export formats are %s." % ", ".join(formats))
+
+    paging = get_paging_arguments(query, request.args, DEFAULT_EXPORT_SIZE)
+    input_model = query.inputs()
+    source = RequestSource.json_post if request.method == "POST" else RequestSource.json_get
+    labels = set_metrics_labels(query, source)
+    if source == RequestSource.json_post:
+        items = get_batch_items(query)
+        check_rate_limit(query, len(items))
+        validator = get_batch_validator(input_model)
+        try:
+            with metrics.timer("stage_duration_seconds", labels + ("validation",)):
+                inputs = validator.validate(items, trusted=is_trusted_client())
+        except Exception as e:
+            raise BadRequest(str(e))
+    else:
+        check_rate_limit(query, 1)
+        try:
+            with metrics.timer("stage_duration_seconds", labels + ("validation",)):
+                inputs = [input_model(**convert_args_to_input(input_model, request.args))]
+        except Exception as e:
+            raise BadRequest(str(e))
+
+    representation = "export;%s;%s" % (export_format, get_content_encoding())
+    etag = get_etag(query, get_response_key(query, inputs, source, paging, representation))
+    response = not_modified_response(query, etag)
+    if response is not None:
+        return response
+
+    try:
+        with metrics.timer("stage_duration_seconds", labels + ("fetch",)):
+            data, _ = fetch_results(query, inputs, source, **paging)
+            data, _, _ = paginate_results(query, data, paging, is_paging_requested(request.args))
+            if isinstance(data, (list, ColumnarResult)):
+                charge_rows(query, len(data))
+            data = start_results(data)
+    except ServiceUnavailable:
+        raise
+    except TimeoutError as err:
+        raise GatewayTimeout(str(err))
+    except Exception as err:
+        sentry_sdk.capture_exception(err)
+        print(traceback.format_exc())
+        raise InternalServerError(str(err))
+
+    columns = get_output_columns(query)
+    if isinstance(data, ColumnarResult):
+        data, columns = data.iter_rows(), data.column_names()
+    rows = (output_row_to_dict(row, columns) for row in data)
+    if not columns:
+        # queries with dynamic outputs export the columns of the first row
+        first = next(rows, None)
+        columns = list(first) if first is not None else []
+        rows = chain((first,), rows) if first is not None else iter(())
+
+    outputs = query.outputs()
+    model = outputs if isinstance(outputs, type) and issubclass(outputs, BaseModel) else None
+    writer = create_export_writer(export_format, columns, model, output_encoder.encode)
+    body = start_stream(export_rows(writer, rows, labels), writer.write_error)
+    response = Response(stream_with_context(body), mimetype=writer.mimetype)
+    response.vary.add("Accept")
+    response.headers["Content-Disposition"] = 'attachment; filename="%s.%s"' % (query.names()[0], writer.extension)
+    return set_cache_headers(response, query, etag)
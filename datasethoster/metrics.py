@@ -0,0 +1,162 @@
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2)
+
+METRIC_PREFIX = "datasethoster_"
+
+
+class MetricsRegistry:
+    """
+        A minimal registry of Prometheus style counters and histograms. Each process records its own
+        metrics in memory. If a directory is set, each process also writes its metrics to a file in that
+        directory every flush_interval seconds, and the metrics of all processes (e.g. all uWSGI workers)
+        are summed up when they are rendered.
+    """
+
+    def __init__(self, path=None, flush_interval=5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        # name -> {"type", "help", "labels", "buckets"}
+        self.definitions = {}
+        # name -> {label values tuple -> value (counter) or [bucket counts..., sum, count] (histogram)}
+        self.series = {}
+
+    def counter(self, name, help, labels):
+        self.definitions[name] = {"type": "counter", "help": help, "labels": labels}
+        self.series[name] = {}
+
+    def histogram(self, name, help, labels, buckets):
+        self.definitions[name] = {"type": "histogram", "help": help, "labels": labels, "buckets": buckets}
+        self.series[name] = {}
+
+    def inc(self, name, labels, amount=1):
+        with self.lock:
+            series = self.series[name]
+            series[labels] = series.get(labels, 0) + amount
+        self.maybe_flush()
+
+    def observe(self, name, labels, value):
+        buckets = self.definitions[name]["buckets"]
+        with self.lock:
+            series = self.series[name]
+            values = series.get(labels)
+            if values is None:
+                values = series[labels] = [0] * (len(buckets) + 2)
+            # counts are stored per bucket and made cumulative when rendered
+            index = bisect_left(buckets, value)
+            if index < len(buckets):
+                values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+        self.maybe_flush()
+
+    @contextmanager
+    def timer(self, name, labels):
+        """ Observe the time spent in the with block in the named histogram. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {name: [[list(labels), value] for labels, value in series.items()]
+                    for name, series in self.series.items()}
+
+    def maybe_flush(self):
+        if self.path and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Write the metrics of this process to its file in the metrics directory. """
+        self.last_flush = time.monotonic()
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=".metrics-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, os.path.join(self.path, "metrics-%d.json" % os.getpid()))
+
+    def collect(self):
+        """ Return the metrics of all processes, summed up per series. """
+        if not self.path:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush()
+            snapshots = []
+            for path in glob.glob(os.path.join(glob.escape(self.path), "metrics-*.json")):
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        collected = {name: {} for name in self.definitions}
+        for snapshot in snapshots:
+            for name, series in snapshot.items():
+                if name not in collected:
+                    continue
+                for labels, value in series:
+                    labels = tuple(labels)
+                    current = collected[name].get(labels)
+                    if current is None:
+                        collected[name][labels] = value
+                    elif isinstance(value, list):
+                        collected[name][labels] = [a + b for a, b in zip(current, value)]
+                    else:
+                        collected[name][labels] = current + value
+        return collected
+
+    def render(self):
+        """ Render the metrics in the Prometheus text exposition format. """
+        lines = []
+        for name, series in self.collect().items():
+            definition = self.definitions[name]
+            full_name = METRIC_PREFIX + name
+            lines.append("# HELP %s %s" % (full_name, definition["help"]))
+            lines.append("# TYPE %s %s" % (full_name, definition["type"]))
+            for labels, value in sorted(series.items()):
+                label_text = ",".join('%s="%s"' % (label, escape_label_value(v))
+                                      for label, v in zip(definition["labels"], labels))
+                if definition["type"] == "counter":
+                    lines.append("%s{%s} %s" % (full_name, label_text, value))
+                    continue
+
+                cumulative = 0
+                for bucket, count in zip(definition["buckets"], value):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (full_name, label_text, bucket, cumulative))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (full_name, label_text, value[-1]))
+                lines.append("%s_sum{%s} %s" % (full_name, label_text, value[-2]))
+                lines.append("%s_count{%s} %d" % (full_name, label_text, value[-1]))
+        return "\n".join(lines) + "\n"
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def create_metrics_registry(path=None):
+    """ Create the registry of the metrics recorded by the hoster. """
+    registry = MetricsRegistry(path)
+    registry.histogram("stage_duration_seconds",
+                       "Time spent per query in each stage of handling a request: validation, fetch, links, serialization",
+                       ("query", "source", "stage"), DURATION_BUCKETS)
+    registry.histogram("result_rows", "Number of rows returned per request", ("query", "source"), ROW_BUCKETS)
+    registry.histogram("response_bytes", "Size of the response body per request", ("query", "source"), BYTE_BUCKETS)
+    registry.counter("requests_total", "Number of requests per query and response status", ("query", "source", "status"))
+    registry.counter("cache_requests_total", "Number of result cache lookups per query and result", ("query", "result"))
+    registry.counter("coalesced_requests_total", "Number of requests served by the fetch call of an identical request",
+                     ("query",))
+    return registry
@@ -0,0 +1,178 @@
+import atexit
+import json
+import multiprocessing
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+from datasethoster import ResultPage, ColumnarResult, AsyncQuery, merge_results
+from datasethoster.eventloop import run_coroutine
+
+# The query object of the current pool worker process, set up once when the worker starts
+worker_query = None
+# The barrier that the workers of a pool that is being started wait at, once they have set up the query
+worker_barrier = None
+
+
+def init_worker(query, barrier=None):
+    """ Set up the query once in a newly started worker process, so that its data is reused by all fetches. """
+    global worker_query, worker_barrier
+    query.setup()
+    worker_query = query
+    worker_barrier = barrier
+
+
+def wait_for_workers():
+    """ Wait until all workers of the pool have set up the query. Each worker waits at the barrier, so each of
+        the pool's start tasks runs in a different worker. """
+    worker_barrier.wait()
+
+
+def fetch_in_worker(params, source, kwargs):
+    """ Run the fetch function of the worker's query. The inputs are passed as JSON compatible dicts because
+        the input models may not be picklable, and are validated again in the worker. """
+    input_model = worker_query.inputs()
+    inputs = [input_model(**param) for param in params]
+    if isinstance(worker_query, AsyncQuery):
+        results = run_coroutine(worker_query.fetch_all(inputs, source, **kwargs))
+    else:
+        results = worker_query.fetch(inputs, source, **kwargs)
+    if isinstance(results, ResultPage):
+        if not isinstance(results.results, (list, ColumnarResult)):
+            results = ResultPage(list(results.results), results.cursor)
+    elif not isinstance(results, (list, ColumnarResult)):
+        results = list(results)
+    return results
+
+
+class QueryProcessPool:
+    """ A pool of worker processes that run the fetch function of a single CPU bound query object. The pool is
+        started when the query is set up, a (uWSGI) worker process forked after that starts its own pool on first
+        use. Batches of inputs are split across the workers and the results are merged in input order. Once the
+        query object is replaced by a reload, the pool is retired: it shuts down as soon as no fetch runs on it. """
+
+    def __init__(self, query):
+        self.query = query
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+        self.active = 0
+        self.retired = False
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                workers = max(self.query.process_workers, 1)
+                self.executor = ProcessPoolExecutor(max_workers=workers,
+                                                    initializer=init_worker,
+                                                    initargs=(self.query, multiprocessing.Barrier(workers)))
+                self.pid = os.getpid()
+            return self.executor
+
+    def start(self):
+        """ Start the worker processes and wait until each of them has set up the query. Raises BrokenProcessPool
+            if the setup failed in a worker. """
+        executor = self.get_executor()
+        futures = [executor.submit(wait_for_workers) for _ in range(max(self.query.process_workers, 1))]
+        for future in futures:
+            future.result()
+
+    def shutdown(self, cancel=True):
+        """ Stop the worker processes, cancelling pending fetches unless cancel is False. """
+        with self.lock:
+            if self.executor is not None and self.pid == os.getpid():
+                self.executor.shutdown(wait=False, cancel_futures=cancel)
+            self.executor = None
+
+    def retire(self):
+        """ Shut the pool down once the fetches that still run on it have completed. """
+        with self.lock:
+            self.retired = True
+            idle = self.active == 0
+        if idle:
+            self.close()
+
+    def close(self):
+        self.shutdown(cancel=False)
+        with process_pools_lock:
+            if process_pools.get(id(self.query)) is self:
+                del process_pools[id(self.query)]
+
+    def fetch(self, inputs, source, offset=-1, count=-1, **kwargs):
+        with self.lock:
+            self.active += 1
+        try:
+            return self.fetch_in_workers(inputs, source, offset, count, **kwargs)
+        finally:
+            with self.lock:
+                self.active -= 1
+                idle = self.retired and self.active == 0
+            if idle:
+                self.close()
+
+    def fetch_in_workers(self, inputs, source, offset, count, **kwargs):
+        executor = self.get_executor()
+        params = [json.loads(x.json()) for x in inputs]
+        workers = self.query.process_workers
+        if len(params) <= 1 or workers <= 1 or self.query.supports_cursor:
+            return executor.submit(fetch_in_worker, params, source,
+                                   dict(kwargs, offset=offset, count=count)).result()
+
+        # each worker may need to return all rows up to the end of the requested page, the page
+        # itself is cut out of the merged results
+        stop = offset + count if offset >= 0 and count >= 0 else -1
+        chunk_args = dict(kwargs, offset=0 if stop >= 0 else -1, count=stop)
+        chunk_size = -(-len(params) // workers)
+        futures = [executor.submit(fetch_in_worker, params[i:i + chunk_size], source, chunk_args)
+                   for i in range(0, len(params), chunk_size)]
+        results = [future.result() for future in futures]
+        rows = merge_results([result.results if isinstance(result, ResultPage) else result for result in results])
+        # the hoster applies offset and count to the merged rows of queries that it pages
+        if stop < 0 or self.query.paged_by_hoster:
+            return rows
+        return rows.slice(offset, stop) if isinstance(rows, ColumnarResult) else rows[offset:stop]
+
+
+# The pools of the query objects that have been set up or used, by id of the query object
+process_pools = {}
+process_pools_lock = threading.Lock()
+# The query objects that were replaced by a reload, the pools created for them later on are retired right away
+retired_queries = weakref.WeakSet()
+
+
+def get_process_pool(query):
+    """ Return the process pool of the given query object, creating it if needed. Each query object has its own
+        pool, so that the requests still in progress on a query that was reloaded keep using its old data. """
+    with process_pools_lock:
+        pool = process_pools.get(id(query))
+        if pool is None:
+            pool = process_pools[id(query)] = QueryProcessPool(query)
+            pool.retired = query in retired_queries
+        return pool
+
+
+def start_process_pool(query):
+    """ Start the process pool of the query object, discarding it if the query fails to set up in its workers. """
+    pool = get_process_pool(query)
+    try:
+        pool.start()
+    except BaseException:
+        pool.shutdown()
+        pool.close()
+        raise
+
+
+def retire_process_pool(query):
+    """ Retire the process pool of a query object that has been replaced by a reload. """
+    retired_queries.add(query)
+    with process_pools_lock:
+        pool = process_pools.get(id(query))
+    if pool is not None:
+        pool.retire()
+
+
+@atexit.register
+def shutdown_process_pools():
+    for pool in list(process_pools.values()):
+        pool.shutdown()
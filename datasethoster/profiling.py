@@ -0,0 +1,114 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+# How often the stacks of slow requests are sampled, in seconds
+SAMPLE_INTERVAL = 0.005
+# Number of functions listed in the report of a deterministic profile
+PROFILE_REPORT_LINES = 60
+
+PROFILE_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+class ProfileStore:
+    """ Stores the text reports of profiled requests as files in a directory. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def new_id(self):
+        return uuid.uuid4().hex
+
+    def save(self, profile_id, text):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "%s.txt" % profile_id), "w") as f:
+            f.write(text)
+
+    def load(self, profile_id):
+        """ Return the report of the given profile, or None if there is no such profile. """
+        if not PROFILE_ID_RE.match(profile_id):
+            return None
+        try:
+            with open(os.path.join(self.path, "%s.txt" % profile_id)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+def run_with_profiler(func):
+    """ Run func under the deterministic profiler and return its result and the profile report,
+        sorted by cumulative time. """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func)
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_REPORT_LINES)
+    return result, stream.getvalue()
+
+
+def collapse_stack(frame):
+    """ Return the stack of the frame in the collapsed format used by flame graph tools. """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno or 0))
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class SlowRequestWatchdog:
+    """
+        Samples the stacks of requests that run longer than their query's threshold. A single background
+        thread checks the running requests every SAMPLE_INTERVAL seconds, so requests that finish within
+        their threshold cost no more than registering and unregistering themselves.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.thread = None
+        self.pid = None
+
+    def start_request(self, threshold):
+        """ Start watching the request running in the current thread, returns a token for end_request. """
+        token = object()
+        with self.lock:
+            self.requests[token] = (threading.get_ident(), time.monotonic(), threshold, Counter())
+            if self.thread is None or self.pid != os.getpid():
+                self.thread = threading.Thread(target=self.run, name="slow-request-watchdog", daemon=True)
+                self.pid = os.getpid()
+                self.thread.start()
+        return token
+
+    def end_request(self, token):
+        """ Stop watching the request. Returns its duration and the collapsed stack samples, or None
+            if the request finished within its threshold. """
+        with self.lock:
+            thread_id, start, threshold, samples = self.requests.pop(token)
+        if not samples:
+            return None
+        report = "\n".join("%s %d" % (stack, count) for stack, count in samples.most_common())
+        return time.monotonic() - start, report
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            with self.lock:
+                slow = [(thread_id, samples) for thread_id, start, threshold, samples in self.requests.values()
+                        if now - start >= threshold]
+            if not slow:
+                continue
+
+            frames = sys._current_frames()
+            for thread_id, samples in slow:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[collapse_stack(frame)] += 1
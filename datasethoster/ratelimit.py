@@ -0,0 +1,125 @@
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from abc import abstractmethod
+
+# Fraction of the updates that also drop the buckets that have refilled completely, as a missing bucket is full
+PRUNE_PROBABILITY = 0.001
+
+
+def refill(tokens, updated, now, rate, burst):
+    """ Return the number of tokens in a bucket last updated at the given time, refilled at rate tokens
+        per second up to burst tokens. """
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class RateLimiter:
+    """
+        Base class for token bucket rate limiters. Each client has a bucket per query that holds up to burst
+        tokens and is refilled at rate tokens per second. A request takes as many tokens as it costs, and is
+        rejected if the bucket holds fewer tokens than that. Requests that cost more than burst are admitted
+        when the bucket is full. These requests, and charges made after a request was admitted (e.g. for the
+        rows it returned), can take the bucket below zero, which delays the client's next requests.
+    """
+
+    @abstractmethod
+    def _update(self, key, rate, burst, update):
+        """ Atomically refill the bucket of the key and replace its tokens with update(tokens). """
+        pass
+
+    def acquire(self, key, cost, rate, burst):
+        """ Take cost tokens from the bucket of the key. Returns 0 if the tokens were taken, otherwise the
+            number of seconds after which the bucket will hold enough tokens. """
+
+        required = min(cost, burst)
+
+        def update(tokens):
+            return tokens - cost if tokens >= required else tokens
+
+        before, after = self._update(key, rate, burst, update)
+        if before != after or cost <= 0:
+            return 0
+        return (required - before) / rate
+
+    def charge(self, key, cost, rate, burst):
+        """ Take cost tokens from the bucket of the key, even if that leaves it below zero. """
+        self._update(key, rate, burst, lambda tokens: tokens - cost)
+
+
+class MemoryRateLimiter(RateLimiter):
+    """ Keeps the token buckets in memory. Each worker process has its own buckets. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def _update(self, key, rate, burst, update):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated, _ = self.buckets.get(key, (burst, now, now))
+            before = refill(tokens, updated, now, rate, burst)
+            after = update(before)
+            self.buckets[key] = (after, now, now + (burst - after) / rate)
+            if random.random() < PRUNE_PROBABILITY:
+                self.buckets = {k: bucket for k, bucket in self.buckets.items() if bucket[2] > now}
+        return before, after
+
+
+class SQLiteRateLimiter(RateLimiter):
+    """ Keeps the token buckets in a local SQLite file, so that the limits apply across all uWSGI workers
+        on a host. """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS rate_limit (
+                                key     TEXT NOT NULL PRIMARY KEY,
+                                tokens  REAL NOT NULL,
+                                updated REAL NOT NULL,
+                                full    REAL NOT NULL)""")
+
+    def _connection(self):
+        """ Return a connection for the current thread, reopening it after a fork. """
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    def _update(self, key, rate, burst, update):
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM rate_limit WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            before = refill(tokens, updated, now, rate, burst)
+            after = update(before)
+            conn.execute("INSERT OR REPLACE INTO rate_limit (key, tokens, updated, full) VALUES (?, ?, ?, ?)",
+                         (key, after, now, now + (burst - after) / rate))
+            if random.random() < PRUNE_PROBABILITY:
+                conn.execute("DELETE FROM rate_limit WHERE full < ?", (now,))
+        return before, after
+
+
+def create_rate_limiter(backend="memory", path=None):
+    """ Create a rate limiter backend by name: "memory" for limits per worker process or "sqlite" for
+        limits shared across the worker processes on this host. """
+    if backend == "memory":
+        return MemoryRateLimiter()
+    if backend == "sqlite":
+        if not path:
+            raise ValueError("The sqlite rate limiter requires a path")
+        return SQLiteRateLimiter(path)
+    raise ValueError("Unknown rate limiter backend '%s'" % backend)
+
+
+def format_retry_after(seconds):
+    """ Return the value of a Retry-After header, a whole number of seconds. """
+    return max(1, math.ceil(seconds))
@@ -0,0 +1,57 @@
+import threading
+
+
+class Flight:
+    """ A call in progress, which the threads making the same call wait for. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+        Coalesces concurrent calls with the same key: the first thread to make a call runs it, the threads
+        that make the same call while it is running wait for it and share its result, or its exception.
+        Calls made after it has completed run again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, func, timeout=None):
+        """
+            Run func, unless a call with the same key is in progress, in which case wait up to timeout seconds
+            for that call and return its result. Returns the result and whether it was shared with another call.
+            Raises the exception raised by func, or TimeoutError if the call in progress did not finish in time.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if leader:
+            try:
+                flight.result = func()
+            except BaseException as err:
+                flight.error = err
+                raise
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.done.set()
+            return flight.result, False
+
+        if not flight.done.wait(timeout):
+            raise TimeoutError("Timed out after %ss waiting for an identical request to complete" % timeout)
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, True
+
+    def in_flight(self):
+        """ Return the number of calls in progress. """
+        with self.lock:
+            return len(self.flights)
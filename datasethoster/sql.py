@@ -0,0 +1,187 @@
+import os
+import queue
+import threading
+from abc import abstractmethod
+from contextlib import contextmanager
+
+from datasethoster import Query
+
+
+class ConnectionPool:
+    """
+        A pool of up to size DB-API connections, opened with connect() as they are needed. Connections are not
+        shared between processes: after a fork the pool starts over with new connections, so each uWSGI worker
+        has its own pool. Requests wait for up to timeout seconds for a connection once all are in use.
+    """
+
+    def __init__(self, connect, size=4, timeout=30):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+
+    def _get(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._reset()
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            if self.opened < self.size:
+                self.opened += 1
+                opened = True
+            else:
+                opened = False
+
+        if opened:
+            try:
+                return self.connect()
+            except BaseException:
+                with self.lock:
+                    self.opened -= 1
+                raise
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError("Timed out waiting for a database connection")
+
+    def _put(self, connection, pid):
+        """ Return a connection to the pool, ending its transaction. Connections that fail are dropped. """
+        try:
+            connection.rollback()
+        except Exception:
+            self._discard(connection, pid)
+            return
+        with self.lock:
+            if pid == self.pid:
+                self.idle.put(connection)
+                return
+        connection.close()
+
+    def _discard(self, connection, pid):
+        with self.lock:
+            if pid == self.pid:
+                self.opened -= 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """ Borrow a connection from the pool for the duration of the with block. """
+        connection = self._get()
+        pid = self.pid
+        try:
+            yield connection
+        finally:
+            self._put(connection, pid)
+
+    def close(self):
+        """ Close the idle connections of this process. """
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(connection, self.pid)
+
+
+class SQLQuery(Query):
+    """
+        A query that looks up all the input items of a request in a database with a single statement. The
+        statement in sql selects from a relation named inputs that holds one row per input item: an
+        input_index column with the position of the item in the request, followed by a column for each field
+        of the inputs model, e.g.
+
+            SELECT r.mbid, r.name
+              FROM inputs
+              JOIN recording r
+                ON r.mbid = inputs.mbid::uuid
+          ORDER BY inputs.input_index
+
+        The statement should order the rows by input_index to return them in input order, and select the
+        columns in the order of the fields of the outputs model. The hoster applies offset and count to the
+        statement with LIMIT and OFFSET, and streams the rows to the client as they are fetched.
+
+        Implement connect to open a new DB-API connection. Connections are kept in a pool for each worker
+        process. The default placeholder suits the qmark paramstyle of sqlite3, set it to "%s" for psycopg2.
+        To fetch the rows with a server-side cursor, override cursor, e.g. to return
+        connection.cursor(name="fetch") with psycopg2.
+    """
+
+    sql = None
+    placeholder = "?"
+    # Maximum number of connections each worker process opens
+    pool_size = 4
+    # Number of rows read from the cursor at a time
+    fetch_size = 1000
+
+    def setup(self):
+        pass
+
+    @abstractmethod
+    def connect(self):
+        """ Return a new DB-API connection to the database. """
+        pass
+
+    def cursor(self, connection):
+        """ Return the cursor to run the statement with. """
+        return connection.cursor()
+
+    def pool(self) -> ConnectionPool:
+        """ Return the query's connection pool, creating it on first use. """
+        pool = self.__dict__.get("_pool")
+        if pool is None:
+            pool = self._pool = ConnectionPool(self.connect, self.pool_size)
+        return pool
+
+    def __getstate__(self):
+        # queries that run in a process pool are pickled, the workers open their own connections
+        state = self.__dict__.copy()
+        state.pop("_pool", None)
+        return state
+
+    def build_statement(self, params, offset=-1, count=-1):
+        """ Return the statement that looks up all params and its arguments, as a list. """
+        fields = list(self.inputs().__fields__)
+        row = "(%s)" % ", ".join([self.placeholder] * (len(fields) + 1))
+        statement = "WITH inputs (%s) AS (VALUES %s)\n%s" % (", ".join(["input_index"] + fields),
+                                                              ", ".join([row] * len(params)),
+                                                              self.sql)
+        args = []
+        for index, param in enumerate(params):
+            args.append(index)
+            args.extend(getattr(param, name) for name in fields)
+
+        if count >= 0:
+            statement += "\nLIMIT %s OFFSET %s" % (self.placeholder, self.placeholder)
+            args.extend([count, max(offset, 0)])
+        return statement, args
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        if not params:
+            return []
+        statement, args = self.build_statement(params, offset, count)
+        return self.stream_rows(statement, args)
+
+    def stream_rows(self, statement, args):
+        """ Run the statement and yield its rows, holding on to the connection until all rows have been read. """
+        with self.pool().connection() as connection:
+            cursor = self.cursor(connection)
+            try:
+                cursor.execute(statement, args)
+                while True:
+                    rows = cursor.fetchmany(self.fetch_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                cursor.close()
@@ -0,0 +1,225 @@
+import array
+import bisect
+import csv
+from typing import Optional
+
+from pydantic import create_model
+
+from datasethoster import Query, ColumnarResult
+
+# Largest code point, strings that start with a prefix sort before the prefix followed by it
+MAX_CHAR = "\U0010ffff"
+
+
+def parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "t", "yes", "y")
+    return bool(value)
+
+
+class StrColumn:
+    """ A column of strings stored as a single UTF-8 encoded blob and an array of the offsets of the strings,
+        which takes a fraction of the memory of a list of python strings. """
+
+    def __init__(self, values):
+        offsets = array.array("q", [0])
+        chunks = []
+        end = 0
+        for value in values:
+            encoded = value.encode("utf-8")
+            chunks.append(encoded)
+            end += len(encoded)
+            offsets.append(end)
+        self.data = b"".join(chunks)
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]].decode("utf-8")
+
+
+# The array typecode used to store the values of each column type, str columns use StrColumn
+ARRAY_TYPECODES = {int: "q", float: "d", bool: "b"}
+
+CONVERTERS = {int: int, float: float, bool: parse_bool, str: str}
+
+
+def make_column(type_, values):
+    """ Build the compact storage of a column of values of the given type. """
+    if type_ is str:
+        return StrColumn(values)
+    return array.array(ARRAY_TYPECODES[type_], values)
+
+
+class Table:
+    """
+        An immutable table stored column by column in arrays. The rows are sorted by the key columns, so that
+        the table itself serves as a sorted index on them, and a hash index maps each key to its run of rows.
+        All columns must have a value in each row. Columns are int, float, bool or str.
+    """
+
+    def __init__(self, columns: dict, key_columns: list, rows):
+        """ Build the table from an iterable of rows, each a dict or a tuple of values in the order of columns
+            (a dict of column name to type). Values are converted to the column types, e.g. from CSV strings. """
+        unknown = [name for name in key_columns if name not in columns]
+        if not key_columns or unknown:
+            raise ValueError("The key columns must be a non empty list of the columns of the table")
+        for type_ in columns.values():
+            if type_ not in CONVERTERS:
+                raise ValueError("Unsupported column type %s" % type_)
+
+        self.types = dict(columns)
+        self.key_columns = list(key_columns)
+        names = list(columns)
+        converters = [CONVERTERS[columns[name]] for name in names]
+        values = [[] for _ in names]
+        for row in rows:
+            if isinstance(row, dict):
+                row = [row[name] for name in names]
+            for column, converter, value in zip(values, converters, row):
+                column.append(converter(value))
+
+        key_values = [values[names.index(name)] for name in key_columns]
+        order = sorted(range(len(values[0])), key=self._row_key(key_values))
+        self.columns = {name: make_column(columns[name], (column[i] for i in order))
+                        for name, column in zip(names, values)}
+        self.length = len(order)
+        self._build_hash_index()
+
+    @staticmethod
+    def _row_key(key_values):
+        if len(key_values) == 1:
+            return key_values[0].__getitem__
+        return lambda i: tuple(column[i] for column in key_values)
+
+    def _build_hash_index(self):
+        """ Map each key to the index of its run of rows, and store where each run starts in an array. """
+        self.index = {}
+        self.starts = array.array("q")
+        get_key = self._row_key([self.columns[name] for name in self.key_columns])
+        previous = object()
+        for i in range(self.length):
+            key = get_key(i)
+            if key != previous:
+                self.index[key] = len(self.starts)
+                self.starts.append(i)
+                previous = key
+        self.starts.append(self.length)
+
+    def __len__(self):
+        return self.length
+
+    def lookup(self, keys):
+        """ Return the rows that match each of the keys exactly, in the order of the keys, as a list of row
+            numbers. Keys are values of the key column, or tuples of values for tables with several. """
+        index, starts = self.index, self.starts
+        rows = []
+        for key in keys:
+            run = index.get(key)
+            if run is not None:
+                rows.extend(range(starts[run], starts[run + 1]))
+        return rows
+
+    def lookup_range(self, ranges):
+        """ Return the rows whose first key column lies between low and high (both inclusive, None for no bound)
+            for each (low, high) pair, in the order of the pairs and the keys, as a list of row numbers. """
+        column = self.columns[self.key_columns[0]]
+        rows = []
+        for low, high in ranges:
+            start = 0 if low is None else bisect.bisect_left(column, low)
+            end = self.length if high is None else bisect.bisect_right(column, high)
+            rows.extend(range(start, end))
+        return rows
+
+    def lookup_prefix(self, prefixes):
+        """ Return the rows whose first key column, a str column, starts with each of the prefixes. """
+        return self.lookup_range((prefix, prefix + MAX_CHAR) for prefix in prefixes)
+
+    def select(self, rows, names=None):
+        """ Return the given rows, as a ColumnarResult of the named columns (all columns by default). """
+        names = list(self.columns) if names is None else names
+        result = {}
+        for name in names:
+            column = self.columns[name]
+            if self.types[name] is bool:
+                # bool columns are stored as bytes
+                result[name] = [bool(column[i]) for i in rows]
+            else:
+                result[name] = [column[i] for i in rows]
+        return ColumnarResult(result)
+
+
+class TableQuery(Query):
+    """
+        A query that loads a table into memory in setup and looks up the rows matching each input item in
+        fetch. Declare the columns of the table as a dict of column name to type (int, float, bool or str)
+        and the columns the table is looked up by in key_columns. The inputs and outputs models are derived
+        from these. Set lookup to choose how input items match rows:
+
+        * "exact": the input items hold a value for each key column and match the rows with those values.
+        * "prefix": the input items hold a prefix of the (single, str) key column.
+        * "range": the input items hold <key>_min and <key>_max, the inclusive bounds of the first key column.
+          Either bound may be omitted.
+
+        The table is read from the CSV file at path, with a header line naming the columns. Override load to
+        read it from somewhere else.
+    """
+
+    columns = {}
+    key_columns = []
+    lookup = "exact"
+    path = None
+    def setup(self):
+        if self.lookup not in ("exact", "prefix", "range"):
+            raise ValueError("Unknown lookup '%s'" % self.lookup)
+        if self.lookup == "prefix" and (len(self.key_columns) != 1 or self.columns[self.key_columns[0]] is not str):
+            raise ValueError("Prefix lookups need a single str key column")
+        self.table = Table(self.columns, self.key_columns, self.load())
+
+    def load(self):
+        """ Return an iterable of the rows of the table, as dicts or as tuples in the order of columns. """
+        with open(self.path, newline="") as f:
+            yield from csv.DictReader(f)
+
+    def inputs(self):
+        model = self.__dict__.get("_inputs")
+        if model is None:
+            slug = self.names()[0]
+            if self.lookup == "range":
+                key = self.key_columns[0]
+                type_ = self.columns[key]
+                fields = {key + "_min": (Optional[type_], None), key + "_max": (Optional[type_], None)}
+            else:
+                fields = {name: (self.columns[name], ...) for name in self.key_columns}
+            model = self._inputs = create_model("%sInput" % slug.title().replace("-", ""), **fields)
+        return model
+
+    def outputs(self):
+        model = self.__dict__.get("_outputs")
+        if model is None:
+            slug = self.names()[0]
+            fields = {name: (type_, ...) for name, type_ in self.columns.items()}
+            model = self._outputs = create_model("%sOutput" % slug.title().replace("-", ""), **fields)
+        return model
+
+    def find_rows(self, params):
+        """ Return the row numbers of the rows that match the input items, in input order. """
+        if self.lookup == "prefix":
+            key = self.key_columns[0]
+            return self.table.lookup_prefix(getattr(param, key) for param in params)
+        if self.lookup == "range":
+            key = self.key_columns[0]
+            return self.table.lookup_range((getattr(param, key + "_min"), getattr(param, key + "_max"))
+                                           for param in params)
+        if len(self.key_columns) == 1:
+            key = self.key_columns[0]
+            return self.table.lookup(getattr(param, key) for param in params)
+        return self.table.lookup(tuple(getattr(param, name) for name in self.key_columns) for param in params)
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        rows = self.find_rows(params)
+        if offset >= 0 and count >= 0:
+            rows = rows[offset:offset + count]
+        return self.table.select(rows)
@@ -0,0 +1,154 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import flask_testing
+from pydantic import BaseModel
+
+from datasethoster import Query, RequestSource
+from datasethoster.admission import AdmissionControl, QueueFull, GuardedRows
+from datasethoster.main import create_app, register_query, fetch_results, get_admission_control
+
+
+class SleepInput(BaseModel):
+    seconds: float
+
+
+class SleepOutput(BaseModel):
+    slept: float
+
+
+class TimeoutQuery(Query[SleepInput, SleepOutput]):
+
+    fetch_timeout = 0.2
+    supports_deadline = True
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "timeout", "fetch timeout test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return SleepInput
+
+    def outputs(self):
+        return SleepOutput
+
+    def fetch(self, params, source, offset=-1, count=-1, deadline=None):
+        self.deadline = deadline
+        for param in params:
+            time.sleep(param.seconds)
+        return [SleepOutput(slept=param.seconds) for param in params]
+
+
+class LimitedQuery(TimeoutQuery):
+
+    fetch_timeout = None
+    supports_deadline = False
+    max_concurrent_fetches = 1
+
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def names(self):
+        return "limited", "admission control test endpoint"
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        self.started.set()
+        self.release.wait(5)
+        return [SleepOutput(slept=0)]
+
+
+timeout_query = TimeoutQuery()
+limited_query = LimitedQuery()
+register_query(timeout_query)
+register_query(limited_query)
+
+
+class TestAdmissionControl(unittest.TestCase):
+
+    def test_queue(self):
+        control = AdmissionControl(1, max_queued=1, queue_timeout=5)
+        control.acquire()
+
+        with ThreadPoolExecutor(1) as executor:
+            waiter = executor.submit(control.acquire)
+            while control.queued == 0:
+                time.sleep(0.01)
+            # the queue is full
+            with self.assertRaises(QueueFull):
+                control.acquire()
+
+            control.release()
+            waiter.result(5)
+            self.assertEqual(control.active, 1)
+            control.release()
+        self.assertEqual((control.active, control.queued), (0, 0))
+
+    def test_queue_timeout(self):
+        control = AdmissionControl(1, max_queued=1, queue_timeout=0.01)
+        control.acquire()
+        with self.assertRaises(QueueFull):
+            control.acquire()
+        self.assertEqual(control.queued, 0)
+
+    def test_guarded_rows(self):
+        done = []
+
+        def rows():
+            yield 1
+            time.sleep(0.1)
+            yield 2
+            yield 3
+
+        guarded = GuardedRows(rows(), time.monotonic() + 0.05, lambda: done.append(True))
+        self.assertEqual(next(guarded), 1)
+        self.assertEqual(next(guarded), 2)
+        with self.assertRaises(TimeoutError):
+            next(guarded)
+        self.assertEqual(done, [True])
+
+        guarded = GuardedRows(rows(), None, lambda: done.append(True))
+        self.assertEqual(list(guarded), [1, 2, 3])
+        self.assertEqual(done, [True, True])
+
+
+class AdmissionTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        return create_app()
+
+    def test_fetch_timeout(self):
+        start = time.monotonic()
+        resp = self.client.get("/timeout/json?seconds=0")
+        self.assert200(resp)
+        self.assertEqual(resp.json, [{"slept": 0.0}])
+        self.assertGreater(timeout_query.deadline, start)
+
+        resp = self.client.get("/timeout/json?seconds=1")
+        self.assertEqual(resp.status_code, 504)
+        resp = self.client.get("/timeout?seconds=1")
+        self.assertEqual(resp.status_code, 504)
+
+    def test_concurrency_limit(self):
+        with ThreadPoolExecutor(1) as executor:
+            running = executor.submit(fetch_results, limited_query, [SleepInput(seconds=0)], RequestSource.json_get)
+            limited_query.started.wait(5)
+
+            resp = self.client.get("/limited/json?seconds=0")
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers["Retry-After"], "1")
+
+            limited_query.release.set()
+            running.result(5)
+
+        resp = self.client.get("/limited/json?seconds=0")
+        self.assertEqual(resp.json, [{"slept": 0.0}])
+        self.assertEqual(get_admission_control(limited_query).active, 0)
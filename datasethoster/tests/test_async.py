@@ -0,0 +1,175 @@
+import asyncio
+import time
+
+import flask_testing
+from pydantic import BaseModel
+
+from datasethoster import AsyncQuery, ColumnarResult, RequestSource
+from datasethoster.eventloop import run_coroutine
+from datasethoster.main import create_app, create_asgi_app, register_query, WsgiToAsgi
+
+# The simulated latency of the backend service each input is looked up in
+LOOKUP_DELAY = 0.05
+
+
+class LookupInput(BaseModel):
+    key: int
+
+
+class LookupOutput(BaseModel):
+    key: int
+    value: int
+
+
+class LookupQuery(AsyncQuery[LookupInput, LookupOutput]):
+
+    fan_out = True
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "async-lookup", "async lookup test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return LookupInput
+
+    def outputs(self):
+        return LookupOutput
+
+    async def fetch(self, params, source, offset=-1, count=-1):
+        rows = []
+        for param in params:
+            await asyncio.sleep(LOOKUP_DELAY)
+            rows.extend(LookupOutput(key=param.key, value=param.key * 10 + i) for i in range(2))
+        return rows
+
+
+class ColumnarLookupQuery(LookupQuery):
+
+    def names(self):
+        return "columnar-lookup", "columnar async lookup test endpoint"
+
+    async def fetch(self, params, source, offset=-1, count=-1):
+        await asyncio.sleep(0)
+        keys = [param.key for param in params for _ in range(2)]
+        return ColumnarResult({"key": keys, "value": [key * 10 + i % 2 for i, key in enumerate(keys)]})
+
+
+class SlowLookupQuery(LookupQuery):
+
+    fetch_timeout = 0.5
+
+    def names(self):
+        return "slow-lookup", "slow async lookup test endpoint"
+
+    async def fetch(self, params, source, offset=-1, count=-1):
+        await asyncio.sleep(float(params[0].key))
+        return await super().fetch(params, source, offset, count)
+
+
+class ClientLookupQuery(LookupQuery):
+
+    def names(self):
+        return "client-lookup", "loop bound client test endpoint"
+
+    def setup(self):
+        # clients such as aiohttp sessions are bound to the event loop they are created on
+        self.client_loop = run_coroutine(self.create_client())
+        self.fetch_loops = []
+
+    async def create_client(self):
+        return asyncio.get_running_loop()
+
+    async def fetch(self, params, source, offset=-1, count=-1):
+        self.fetch_loops.append(asyncio.get_running_loop())
+        return [LookupOutput(key=param.key, value=0) for param in params]
+
+
+class SequentialLookupQuery(LookupQuery):
+
+    fan_out = False
+
+    def names(self):
+        return "sequential-lookup", "sequential lookup test endpoint"
+
+
+register_query(LookupQuery())
+register_query(SequentialLookupQuery())
+register_query(ColumnarLookupQuery())
+register_query(SlowLookupQuery())
+client_query = ClientLookupQuery()
+register_query(client_query)
+
+
+class AsyncQueryTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        return create_app()
+
+    def test_fan_out_order_and_paging(self):
+        query = LookupQuery()
+        params = [LookupInput(key=k) for k in range(3)]
+        # queries that the hoster pages get all the merged rows
+        query.paged_by_hoster = True
+        rows = asyncio.run(query.fetch_all(params, RequestSource.json_post, offset=1, count=3))
+        self.assertEqual([row.value for row in rows], [0, 1, 10, 11, 20, 21])
+
+        # the page is cut out of the merged rows of queries that page themselves
+        query.paged_by_hoster = False
+        rows = asyncio.run(query.fetch_all(params, RequestSource.json_post, offset=1, count=3))
+        self.assertEqual([row.value for row in rows], [1, 10, 11])
+        rows = asyncio.run(query.fetch_all(params, RequestSource.json_post, offset=5, count=3))
+        self.assertEqual([row.value for row in rows], [21])
+
+        resp = self.client.post("/async-lookup/json?offset=1&count=3", json=[{"key": k} for k in range(3)])
+        self.assertEqual([row["value"] for row in resp.json], [1, 10, 11])
+        self.assertIn("offset=4", resp.headers["Link"])
+
+    def test_fan_out_columnar(self):
+        query = ColumnarLookupQuery()
+        params = [LookupInput(key=k) for k in range(3)]
+        result = asyncio.run(query.fetch_all(params, RequestSource.json_post, offset=1, count=3))
+        self.assertIsInstance(result, ColumnarResult)
+        self.assertEqual(result.to_lists(), {"key": [0, 1, 1], "value": [1, 10, 11]})
+
+        resp = self.client.post("/columnar-lookup/json", json=[{"key": k} for k in range(3)])
+        self.assert200(resp)
+        self.assertEqual([x["value"] for x in resp.json], [0, 1, 10, 11, 20, 21])
+
+    def test_fetch_timeout(self):
+        resp = self.client.get("/slow-lookup/json?key=0")
+        self.assert200(resp)
+        resp = self.client.get("/slow-lookup/json?key=5")
+        self.assertEqual(resp.status_code, 504)
+
+    def test_shared_event_loop(self):
+        for _ in range(2):
+            self.assert200(self.client.get("/client-lookup/json?key=1"))
+        self.assertEqual(client_query.fetch_loops, [client_query.client_loop] * 2)
+
+    def test_fan_out_is_concurrent(self):
+        items = [{"key": k} for k in range(10)]
+
+        start = time.monotonic()
+        resp = self.client.post("/sequential-lookup/json", json=items)
+        sequential = time.monotonic() - start
+        self.assert200(resp)
+        self.assertEqual(len(resp.json), 20)
+
+        start = time.monotonic()
+        resp = self.client.post("/async-lookup/json", json=items)
+        concurrent = time.monotonic() - start
+        self.assert200(resp)
+
+        self.assertEqual([x["value"] for x in resp.json], [k * 10 + i for k in range(10) for i in range(2)])
+        self.assertGreaterEqual(sequential, LOOKUP_DELAY * len(items))
+        self.assertLess(concurrent, sequential / 2)
+
+    def test_create_asgi_app(self):
+        if WsgiToAsgi is None:
+            self.skipTest("asgiref is not installed")
+        self.assertIsInstance(create_asgi_app(), WsgiToAsgi)
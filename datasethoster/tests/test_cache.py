@@ -0,0 +1,160 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from pydantic import BaseModel
+
+from datasethoster import Query, RequestSource
+from datasethoster.cache import MemoryResultCache, SQLiteResultCache, make_cache_key
+from datasethoster.main import fetch_results, paginate_results
+
+
+class CacheInput(BaseModel):
+    a: int
+    b: str
+
+
+class LookupInput(BaseModel):
+    key: int
+
+
+class LookupOutput(BaseModel):
+    key: int
+    value: int
+
+
+class LookupQuery(Query[LookupInput, LookupOutput]):
+
+    cache_ttl = 60
+    cache_per_input = True
+
+    def __init__(self):
+        super().__init__()
+        self.fetched = []
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "lookup", "per input cache test query"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return LookupInput
+
+    def outputs(self):
+        return LookupOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        self.fetched.append([param.key for param in params])
+        # key 0 has no rows, other keys have as many rows as their value, in any order
+        rows = [LookupOutput(key=param.key, value=i) for param in params for i in range(param.key)]
+        return sorted(rows, key=lambda row: row.value)
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_make_cache_key(self):
+        key = make_cache_key("test", [CacheInput(a=1, b="x")], RequestSource.json_post, 0, 10)
+        self.assertEqual(key, make_cache_key("test", [CacheInput(b="x", a=1)], RequestSource.json_post, 0, 10))
+        self.assertNotEqual(key, make_cache_key("test", [CacheInput(a=1, b="x")], RequestSource.json_post, 10, 10))
+        self.assertNotEqual(key, make_cache_key("test", [CacheInput(a=1, b="x")], RequestSource.json_get, 0, 10))
+        self.assertNotEqual(key, make_cache_key("other", [CacheInput(a=1, b="x")], RequestSource.json_post, 0, 10))
+
+    def check_backend(self, cache):
+        self.assertIsNone(cache.get("test", "k1"))
+        cache.set("test", "k1", [1], 60, 2)
+        cache.set("test", "k2", [2], 60, 2)
+        self.assertEqual(cache.get("test", "k1"), [1])
+
+        # k2 is now the least recently used entry and gets evicted
+        cache.set("test", "k3", [3], 60, 2)
+        self.assertIsNone(cache.get("test", "k2"))
+        self.assertEqual(cache.get("test", "k1"), [1])
+        self.assertEqual(cache.get("test", "k3"), [3])
+
+        # other namespaces have their own budget
+        cache.set("other", "k1", [4], 60, 1)
+        self.assertEqual(cache.get("test", "k1"), [1])
+        self.assertEqual(cache.get("other", "k1"), [4])
+
+        # empty results are cached, disabled ttl is not
+        cache.set("test", "k4", [], 60, 2)
+        self.assertEqual(cache.get("test", "k4"), [])
+        cache.set("test", "k5", [5], None, 2)
+        self.assertIsNone(cache.get("test", "k5"))
+
+        cache.clear("test")
+        self.assertIsNone(cache.get("test", "k1"))
+        self.assertEqual(cache.get("other", "k1"), [4])
+
+    def check_backend_many(self, cache):
+        self.assertEqual(cache.get_many("test", []), {})
+        self.assertEqual(cache.get_many("test", ["k1", "k2"]), {})
+
+        # a batch larger than the budget keeps its last entries
+        cache.set_many("test", {"k1": [1], "k2": [2], "k3": [], "k4": None}, 60, 3)
+        self.assertEqual(cache.get_many("test", ["k3", "k1", "k2", "k4", "k1"]), {"k1": [1], "k2": [2], "k3": []})
+        cache.set_many("test", {"k5": [5], "k6": [6]}, 60, 3)
+        self.assertEqual(len(cache.get_many("test", ["k1", "k2", "k3"])), 1)
+        self.assertEqual(cache.get_many("test", ["k4", "k5", "k6"]), {"k5": [5], "k6": [6]})
+
+        # looking keys up marks them as recently used
+        self.assertEqual(cache.get_many("test", ["k5"]), {"k5": [5]})
+        cache.set_many("test", {"k7": [7], "k8": [8]}, 60, 3)
+        self.assertEqual(cache.get_many("test", ["k5", "k6", "k7", "k8"]), {"k5": [5], "k7": [7], "k8": [8]})
+
+        cache.set_many("test", {"k9": [9]}, None, 3)
+        self.assertEqual(cache.get_many("test", ["k9"]), {})
+
+    def test_memory_cache(self):
+        self.check_backend(MemoryResultCache())
+        self.check_backend_many(MemoryResultCache())
+
+    def test_sqlite_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.check_backend(SQLiteResultCache(os.path.join(tmp, "cache.db")))
+            self.check_backend_many(SQLiteResultCache(os.path.join(tmp, "many.db")))
+
+    def test_memory_cache_expiry(self):
+        cache = MemoryResultCache()
+        with patch("datasethoster.cache.time.monotonic", return_value=100):
+            cache.set("test", "k1", [1], 10, 2)
+            self.assertEqual(cache.get("test", "k1"), [1])
+        with patch("datasethoster.cache.time.monotonic", return_value=111):
+            self.assertIsNone(cache.get("test", "k1"))
+
+    def test_sqlite_cache_expiry(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = SQLiteResultCache(os.path.join(tmp, "cache.db"))
+            with patch("datasethoster.cache.time.time", return_value=100):
+                cache.set("test", "k1", [1], 10, 2)
+                self.assertEqual(cache.get("test", "k1"), [1])
+            with patch("datasethoster.cache.time.time", return_value=111):
+                self.assertIsNone(cache.get("test", "k1"))
+
+    def test_per_input_cache(self):
+        query = LookupQuery()
+        inputs = [LookupInput(key=2), LookupInput(key=1)]
+        results, cached = fetch_results(query, inputs, RequestSource.json_post, offset=0, count=100)
+        self.assertFalse(cached)
+        self.assertEqual([(row.key, row.value) for row in results], [(2, 0), (2, 1), (1, 0)])
+
+        # only the items missing from the cache are fetched, duplicates once
+        inputs = [LookupInput(key=1), LookupInput(key=3), LookupInput(key=0), LookupInput(key=3), LookupInput(key=2)]
+        results, cached = fetch_results(query, inputs, RequestSource.json_post, offset=0, count=100)
+        self.assertFalse(cached)
+        self.assertEqual(query.fetched, [[2, 1], [3, 0]])
+        self.assertEqual([(row.key, row.value) for row in results],
+                         [(1, 0), (3, 0), (3, 1), (3, 2), (3, 0), (3, 1), (3, 2), (2, 0), (2, 1)])
+
+        # offset and count are applied to the merged rows
+        results, cached = fetch_results(query, inputs, RequestSource.json_post, offset=2, count=3)
+        self.assertTrue(cached)
+        results, _, more = paginate_results(query, results, {"offset": 2, "count": 3}, True)
+        self.assertEqual([(row.key, row.value) for row in results], [(3, 1), (3, 2), (3, 0)])
+        self.assertTrue(more)
+        self.assertEqual(len(query.fetched), 2)
@@ -0,0 +1,121 @@
+import gzip
+import json
+import unittest
+import zlib
+
+import flask_testing
+from pydantic import BaseModel
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+from datasethoster import Query
+from datasethoster.compression import compress, compress_chunks, negotiate_encoding
+from datasethoster.main import create_app, register_query, init_compression
+
+
+class TableInput(BaseModel):
+    num_lines: int
+
+
+class TableOutput(BaseModel):
+    number: int
+    name: str
+
+
+class CachedTableQuery(Query[TableInput, TableOutput]):
+
+    cache_ttl = 60
+
+    def __init__(self):
+        super().__init__()
+        self.fetches = 0
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "compressed-table", "compression test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return TableInput
+
+    def outputs(self):
+        return TableOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        self.fetches += 1
+        return [TableOutput(number=i, name="row %d" % i) for param in params for i in range(param.num_lines)]
+
+
+table_query = CachedTableQuery()
+register_query(table_query)
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_compress_chunks(self):
+        chunks = [b"[" + b"1, " * 1000, b"2, " * 1000, b"3]"]
+        compressed = list(compress_chunks(chunks, "gzip"))
+        self.assertEqual(gzip.decompress(b"".join(compressed)), b"".join(chunks))
+
+        # each chunk can be decompressed as soon as it is received
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(compressed[0]), chunks[0])
+
+        self.assertEqual(gzip.decompress(compress(b"data", "gzip")), b"data")
+        with self.assertRaises(ValueError):
+            compress(b"data", "unknown")
+
+    def test_negotiate_encoding(self):
+        accept = parse_accept_header("gzip;q=0.5, br", Accept)
+        self.assertEqual(negotiate_encoding(accept, ["br", "gzip"]), "br")
+        self.assertEqual(negotiate_encoding(accept, ["gzip"]), "gzip")
+        self.assertIsNone(negotiate_encoding(parse_accept_header("identity", Accept), ["gzip"]))
+
+
+class CompressionTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        app = create_app()
+        app.config["COMPRESSION_ENCODINGS"] = ["gzip"]
+        init_compression(app)
+        return app
+
+    def test_json_post_compressed(self):
+        headers = {"Accept-Encoding": "gzip"}
+        resp = self.client.post("/compressed-table/json?count=5000", json=[{"num_lines": 5000}], headers=headers)
+        self.assert200(resp)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertEqual(resp.headers["X-Cache"], "MISS")
+        data = json.loads(gzip.decompress(resp.data))
+        self.assertEqual(len(data), 5000)
+        self.assertEqual(data[4999], {"number": 4999, "name": "row 4999"})
+        fetches = table_query.fetches
+
+        # the compressed body is served from the cache
+        resp = self.client.post("/compressed-table/json?count=5000", json=[{"num_lines": 5000}], headers=headers)
+        self.assertEqual(resp.headers["X-Cache"], "HIT")
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(resp.data)), data)
+        self.assertEqual(table_query.fetches, fetches)
+
+        # clients that don't accept gzip get the plain response
+        resp = self.client.post("/compressed-table/json?count=5000", json=[{"num_lines": 5000}])
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.json, data)
+
+    def test_small_response_not_compressed(self):
+        resp = self.client.get("/compressed-table/json?num_lines=1", headers={"Accept-Encoding": "gzip"})
+        self.assert200(resp)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.json, [{"number": 0, "name": "row 0"}])
+
+    def test_web_compressed(self):
+        resp = self.client.get("/compressed-table?num_lines=50", headers={"Accept-Encoding": "gzip"})
+        self.assert200(resp)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn(b"row 49", gzip.decompress(resp.data))
@@ -0,0 +1,70 @@
+import array
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from datasethoster.dataset import DatasetStore
+
+
+class TestDatasetStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = DatasetStore(os.path.join(self.tmp.name, "store"))
+        self.builds = 0
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def build(self, f):
+        self.builds += 1
+        f.write(array.array("q", range(10)).tobytes())
+
+    def test_map_builds_once(self):
+        dataset = self.store.map("numbers", "1", self.build)
+        self.assertEqual(list(dataset.array("q")), list(range(10)))
+        self.assertEqual(list(dataset.array("q", 8 * 3, 2)), [3, 4])
+
+        # another process (or store object) maps the already built file
+        other = DatasetStore(self.store.directory).map("numbers", "1", self.build)
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(other.path, dataset.path)
+
+        # a new version is built and replaces the old file, the old mapping remains usable
+        new = self.store.map("numbers", "2", self.build)
+        self.assertEqual(self.builds, 2)
+        self.assertFalse(os.path.exists(dataset.path))
+        self.assertEqual(dataset.array("q")[9], 9)
+        self.assertEqual(new.array("q")[9], 9)
+
+    def test_failed_build(self):
+        def build(f):
+            f.write(b"partial")
+            raise ValueError("broken")
+
+        with self.assertRaises(ValueError):
+            self.store.map("broken", "1", build)
+        self.assertEqual(os.listdir(os.path.join(self.store.directory, "broken")), [".lock"])
+
+    def test_empty_dataset(self):
+        dataset = self.store.map("empty", "1", lambda f: None)
+        self.assertEqual(len(dataset), 0)
+
+    def test_watch(self):
+        source = os.path.join(self.tmp.name, "source.txt")
+        with open(source, "w") as f:
+            f.write("1,2,3")
+
+        def build(f):
+            with open(source) as src:
+                f.write(array.array("q", [int(x) for x in src.read().split(",")]).tobytes())
+
+        watched = self.store.watch("watched", source, build, check_interval=10)
+        self.assertEqual(list(watched.get().array("q")), [1, 2, 3])
+
+        with open(source, "w") as f:
+            f.write("4,5,6,7")
+        self.assertEqual(list(watched.get().array("q")), [1, 2, 3])
+        with patch("datasethoster.dataset.time.monotonic", return_value=watched.checked + 11):
+            self.assertEqual(list(watched.get().array("q")), [4, 5, 6, 7])
@@ -0,0 +1,199 @@
+import csv
+import io
+import json
+import unittest
+from typing import Optional
+from unittest.mock import patch
+
+import flask_testing
+from pydantic import BaseModel
+
+from datasethoster import Query
+from datasethoster.export import CSVWriter, NDJSONWriter, batch_rows, negotiate_format, pyarrow
+from datasethoster.main import create_app, register_query
+
+
+class ExportInput(BaseModel):
+    num_lines: int
+
+
+class ExportOutput(BaseModel):
+    number: int
+    name: str
+    tags: list[str]
+    score: Optional[float]
+
+
+class ExportQuery(Query[ExportInput, ExportOutput]):
+
+    paged_by_hoster = True
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "export", "export test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return ExportInput
+
+    def outputs(self):
+        return ExportOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        if any(param.num_lines < 0 for param in params):
+            raise RuntimeError("The backend failed")
+        return [ExportOutput(number=i, name="row, %d" % i, tags=["a", "b"][:i], score=i / 2 if i else None)
+                for param in params for i in range(param.num_lines)]
+
+
+class FailingExportQuery(ExportQuery):
+
+    def names(self):
+        return "failing-export", "failing export test endpoint"
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        for param in params:
+            for i in range(param.num_lines):
+                yield ExportOutput(number=i, name="row %d" % i, tags=[], score=None)
+        raise RuntimeError("The backend failed")
+
+
+register_query(ExportQuery())
+register_query(FailingExportQuery())
+
+
+def read_csv(data):
+    return list(csv.reader(io.StringIO(data.decode("utf-8"))))
+
+
+class TestExportWriters(unittest.TestCase):
+
+    def test_csv(self):
+        writer = CSVWriter(["a", "b"])
+        rows = [{"a": 1, "b": "x"}, {"a": None, "b": [1, 2]}, {"a": 3}]
+        chunks = list(writer.write(batch_rows(rows, 2)))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(read_csv(b"".join(chunks)), [["a", "b"], ["1", "x"], ["", "[1, 2]"], ["3", ""]])
+
+    def test_ndjson(self):
+        writer = NDJSONWriter(["a"])
+        data = b"".join(writer.write(batch_rows([{"a": 1}, {"a": 2}])))
+        self.assertEqual(data, b'{"a": 1}\n{"a": 2}\n')
+
+    def test_negotiate_format(self):
+        formats = ["csv", "ndjson"]
+        request = create_app().test_request_context(headers={"Accept": "application/x-ndjson"})
+        with request:
+            from flask import request as current_request
+            self.assertEqual(negotiate_format(None, current_request.accept_mimetypes, formats), "ndjson")
+            self.assertEqual(negotiate_format("csv", current_request.accept_mimetypes, formats), "csv")
+            self.assertIsNone(negotiate_format("xml", current_request.accept_mimetypes, formats))
+        with create_app().test_request_context():
+            self.assertEqual(negotiate_format(None, current_request.accept_mimetypes, formats), "csv")
+
+
+class ExportTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        return create_app()
+
+    def test_export_csv(self):
+        resp = self.client.get("/export/export?num_lines=3")
+        self.assert200(resp)
+        self.assertEqual(resp.mimetype, "text/csv")
+        self.assertEqual(resp.headers["Content-Disposition"], 'attachment; filename="export.csv"')
+        self.assertEqual(read_csv(resp.data), [["number", "name", "tags", "score"],
+                                               ["0", "row, 0", "[]", ""],
+                                               ["1", "row, 1", '["a"]', "0.5"],
+                                               ["2", "row, 2", '["a", "b"]', "1.0"]])
+        resp.close()
+
+    def test_export_ndjson(self):
+        resp = self.client.post("/export/export?count=2&offset=1", json=[{"num_lines": 2}, {"num_lines": 2}],
+                                headers={"Accept": "application/x-ndjson"})
+        self.assert200(resp)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([row["number"] for row in rows], [1, 0])
+        resp.close()
+
+    def test_export_many_rows(self):
+        # without a count, all rows are exported
+        with patch("datasethoster.export.EXPORT_BATCH_SIZE", 100):
+            resp = self.client.get("/export/export?num_lines=250&format=ndjson")
+            self.assertEqual(len(resp.data.splitlines()), 250)
+            resp.close()
+
+    def test_export_fetch_error(self):
+        resp = self.client.get("/export/export?num_lines=-1")
+        self.assertEqual(resp.status_code, 500)
+
+    def test_export_stream_error(self):
+        resp = self.client.get("/failing-export/export?num_lines=3")
+        self.assertEqual(resp.status_code, 500)
+
+        # once the export has started, the error is written at its end
+        with patch("datasethoster.main.batch_rows", lambda rows: batch_rows(rows, 100)), \
+                patch("datasethoster.main.STREAM_CHUNK_SIZE", 10):
+            resp = self.client.get("/failing-export/export?num_lines=250")
+            self.assert200(resp)
+            lines = read_csv(resp.data)
+            resp.close()
+            self.assertEqual(len(lines), 202)
+            self.assertEqual(lines[-1], ["#error", "The backend failed"])
+
+            resp = self.client.get("/failing-export/export?num_lines=250&format=ndjson")
+            lines = resp.data.splitlines()
+            resp.close()
+            self.assertEqual(len(lines), 201)
+            self.assertEqual(json.loads(lines[-1]), {"error": "The backend failed"})
+
+    def test_export_etag(self):
+        with patch.object(ExportQuery, "version", lambda self: "2024-01-01"):
+            resp = self.client.get("/export/export?num_lines=200")
+            plain_etag = resp.headers["ETag"]
+            resp.close()
+            resp = self.client.get("/export/export?num_lines=200", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            self.assertNotEqual(resp.headers["ETag"], plain_etag)
+            resp.close()
+
+            # the ETag of the plain body doesn't match the compressed one
+            resp = self.client.get("/export/export?num_lines=200",
+                                   headers={"Accept-Encoding": "gzip", "If-None-Match": plain_etag})
+            self.assert200(resp)
+            resp.close()
+            resp = self.client.get("/export/export?num_lines=200", headers={"If-None-Match": plain_etag})
+            self.assertEqual(resp.status_code, 304)
+
+    def test_export_unknown_format(self):
+        resp = self.client.get("/export/export?num_lines=3&format=xml")
+        self.assertEqual(resp.status_code, 406)
+        resp = self.client.get("/export/export?num_lines=3", headers={"Accept": "application/xml"})
+        self.assertEqual(resp.status_code, 406)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_export_arrow(self):
+        resp = self.client.get("/export/export?num_lines=3&format=arrow")
+        self.assert200(resp)
+        table = pyarrow.ipc.open_stream(resp.data).read_all()
+        self.assertEqual(table.column_names, ["number", "name", "tags", "score"])
+        self.assertEqual(table.column("tags").to_pylist(), [[], ["a"], ["a", "b"]])
+        resp.close()
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_export_parquet(self):
+        resp = self.client.get("/export/export?num_lines=3", headers={"Accept": "application/vnd.apache.parquet"})
+        self.assert200(resp)
+        table = pyarrow.parquet.read_table(pyarrow.BufferReader(resp.data))
+        self.assertEqual(table.column("number").to_pylist(), [0, 1, 2])
+        resp.close()
+
+    @unittest.skipIf(pyarrow is not None, "pyarrow is installed")
+    def test_export_arrow_unavailable(self):
+        resp = self.client.get("/export/export?num_lines=3&format=arrow")
+        self.assertEqual(resp.status_code, 406)
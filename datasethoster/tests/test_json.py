@@ -0,0 +1,443 @@
+import json
+import time
+from unittest.mock import patch
+
+import flask_testing
+from pydantic import BaseModel, Extra
+
+from datasethoster import Query, ColumnarResult, ResultPage
+from datasethoster.encoders import create_output_encoder
+from datasethoster.main import create_app, register_query, get_links_for_output, index_query_inputs
+
+
+class StreamInput(BaseModel):
+    num_lines: int
+
+
+class StreamOutput(BaseModel):
+    number: int
+    squared: int
+
+
+class StreamQuery(Query[StreamInput, StreamOutput]):
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "stream", "streaming test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return StreamInput
+
+    def outputs(self):
+        return StreamOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        for param in params:
+            for i in range(param.num_lines):
+                yield StreamOutput(number=i, squared=i * i)
+
+
+class PlainRowsQuery(StreamQuery):
+
+    paged_by_hoster = True
+
+    def names(self):
+        return "plain-rows", "plain rows test endpoint"
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        rows = []
+        for param in params:
+            for i in range(param.num_lines):
+                rows.append((i, i * i) if i % 2 else {"number": i, "squared": i * i})
+        return rows
+
+
+class ColumnarQuery(StreamQuery):
+
+    paged_by_hoster = True
+
+    def names(self):
+        return "columnar", "columnar test endpoint"
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        numbers = [i for param in params for i in range(param.num_lines)]
+        return ColumnarResult({"number": numbers, "squared": tuple(i * i for i in numbers)})
+
+
+class CursorQuery(StreamQuery):
+
+    supports_cursor = True
+
+    def names(self):
+        return "cursor", "cursor test endpoint"
+
+    def fetch(self, params, source, offset=-1, count=-1, cursor=None):
+        start = cursor or 0
+        stop = min(start + count, params[0].num_lines)
+        rows = [StreamOutput(number=i, squared=i * i) for i in range(start, stop)]
+        return ResultPage(rows, stop if stop < params[0].num_lines else None)
+
+
+class PagedRowsQuery(PlainRowsQuery):
+
+    paged_by_hoster = False
+
+    def names(self):
+        return "paged-rows", "paged rows test endpoint"
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        rows = super().fetch(params, source)
+        return rows[offset:offset + count] if count >= 0 else rows
+
+
+class StrictInput(BaseModel):
+    num_lines: int
+
+    class Config:
+        extra = Extra.forbid
+
+
+class StrictQuery(PagedRowsQuery):
+
+    def names(self):
+        return "strict", "strict inputs test endpoint"
+
+    def inputs(self):
+        return StrictInput
+
+
+class VersionedQuery(PlainRowsQuery):
+
+    http_max_age = 60
+
+    def __init__(self):
+        super().__init__()
+        self.fetches = 0
+
+    def names(self):
+        return "versioned-rows", "versioned rows test endpoint"
+
+    def version(self):
+        return "2024-01-01"
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        self.fetches += 1
+        return super().fetch(params, source, offset, count)
+
+
+class FailingStreamQuery(StreamQuery):
+
+    fetch_timeout = 0.3
+
+    def names(self):
+        return "failing-stream", "failing stream test endpoint"
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        # num_lines rows are produced, then fetch either fails or keeps producing rows slowly
+        for param in params:
+            for i in range(abs(param.num_lines)):
+                yield StreamOutput(number=i, squared=i * i)
+            if param.num_lines >= 0:
+                raise RuntimeError("The backend failed")
+            for i in range(10):
+                time.sleep(0.1)
+                yield StreamOutput(number=i, squared=i * i)
+
+
+versioned_query = VersionedQuery()
+
+# Queries must be registered before the blueprint is registered on an app
+register_query(versioned_query)
+register_query(StreamQuery())
+register_query(PlainRowsQuery())
+register_query(PagedRowsQuery())
+register_query(StrictQuery())
+register_query(ColumnarQuery())
+register_query(CursorQuery())
+register_query(FailingStreamQuery())
+
+
+class JSONTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        return create_app()
+
+    def test_json_post_stream(self):
+        resp = self.client.post("/stream/json", json=[{"num_lines": 3}, {"num_lines": 2}])
+        self.assert200(resp)
+        self.assertEqual(resp.mimetype, "application/json")
+        self.assertEqual([x["squared"] for x in resp.json], [0, 1, 4, 0, 1])
+
+    def test_json_post_stream_chunks(self):
+        with patch("datasethoster.main.STREAM_CHUNK_SIZE", 10):
+            resp = self.client.post("/stream/json", json=[{"num_lines": 50}])
+        self.assert200(resp)
+        self.assertEqual(len(resp.json), 50)
+        self.assertEqual(resp.json[49], {"number": 49, "squared": 2401})
+
+    def test_json_post_stream_empty(self):
+        resp = self.client.post("/stream/json", json=[{"num_lines": 0}])
+        self.assert200(resp)
+        self.assertEqual(resp.json, [])
+
+    def test_json_stream_error(self):
+        # errors raised before the first chunk is complete get an error status
+        resp = self.client.get("/failing-stream/json?num_lines=3")
+        self.assert500(resp)
+        resp = self.client.get("/failing-stream/json?num_lines=-3")
+        self.assertEqual(resp.status_code, 504)
+        resp = self.client.get("/failing-stream/json?num_lines=3&orient=columns")
+        self.assert500(resp)
+
+        # later errors end the body with an error line
+        with patch("datasethoster.main.STREAM_CHUNK_SIZE", 10):
+            resp = self.client.get("/failing-stream/json?num_lines=3")
+            self.assert200(resp)
+            lines = resp.data.decode("utf-8").splitlines()
+            resp.close()
+            self.assertEqual(json.loads(lines[-1]), {"error": "The backend failed"})
+            self.assertRaises(ValueError, json.loads, resp.data)
+
+            resp = self.client.get("/failing-stream/json?num_lines=-3", headers={"Accept": "application/x-ndjson"})
+            lines = resp.data.decode("utf-8").splitlines()
+            resp.close()
+            self.assertEqual([json.loads(line) for line in lines[:3]],
+                             [{"number": i, "squared": i * i} for i in range(3)])
+            self.assertLess(len(lines), 13)
+            self.assertIn("deadline", json.loads(lines[-1])["error"])
+
+    def test_json_get_ndjson(self):
+        resp = self.client.get("/stream/json?num_lines=3", headers={"Accept": "application/x-ndjson"})
+        self.assert200(resp)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.data.decode("utf-8").splitlines()
+        self.assertEqual([json.loads(line)["number"] for line in lines], [0, 1, 2])
+
+    def test_json_post_plain_rows(self):
+        for encoder in ["json", "orjson"]:
+            with patch("datasethoster.main.output_encoder", create_output_encoder(encoder)):
+                resp = self.client.post("/plain-rows/json", json=[{"num_lines": 3}])
+            self.assert200(resp)
+            self.assertEqual(resp.json, [{"number": 0, "squared": 0},
+                                         {"number": 1, "squared": 1},
+                                         {"number": 2, "squared": 4}])
+
+    def test_web_plain_rows(self):
+        resp = self.client.get("/plain-rows?num_lines=3")
+        self.assert200(resp)
+        self.assertIn(b"3 rows returned", resp.data)
+
+    def test_web_stream_chunks(self):
+        with patch("datasethoster.main.STREAM_CHUNK_SIZE", 1000):
+            resp = self.client.get("/plain-rows?num_lines=50")
+            self.assert200(resp)
+            self.assertTrue(resp.is_streamed)
+            chunks = list(resp.response)
+        self.assertGreater(len(chunks), 1)
+        self.assertIn(b"50 rows returned", b"".join(chunks))
+        self.assertTrue(b"".join(chunks).rstrip().endswith(b"</html>"))
+
+    def test_web_row_limit(self):
+        self.app.config["HTML_MAX_ROWS"] = 3
+        try:
+            resp = self.client.get("/plain-rows?num_lines=5&count=10")
+            self.assert200(resp)
+            self.assertIn(b"3 rows returned", resp.data)
+            self.assertIn(b"This page shows at most 3 rows", resp.data)
+            self.assertIn(b"offset=3", resp.data)
+            self.assertIn(b"/plain-rows/json?num_lines=5&amp;count=10", resp.data)
+
+            resp = self.client.get("/plain-rows?num_lines=2")
+            self.assertNotIn(b"This page shows at most", resp.data)
+        finally:
+            del self.app.config["HTML_MAX_ROWS"]
+
+    def test_json_columnar(self):
+        resp = self.client.post("/columnar/json", json=[{"num_lines": 3}])
+        self.assert200(resp)
+        self.assertEqual(resp.json, [{"number": 0, "squared": 0},
+                                     {"number": 1, "squared": 1},
+                                     {"number": 2, "squared": 4}])
+
+        resp = self.client.get("/columnar/json?num_lines=3&orient=columns")
+        self.assert200(resp)
+        self.assertEqual(resp.json, {"number": [0, 1, 2], "squared": [0, 1, 4]})
+
+        resp = self.client.get("/columnar/json?num_lines=3&orient=diagonal")
+        self.assert400(resp)
+
+    def test_json_rows_as_columns(self):
+        resp = self.client.post("/stream/json?orient=columns", json=[{"num_lines": 3}])
+        self.assert200(resp)
+        self.assertEqual(resp.json, {"number": [0, 1, 2], "squared": [0, 1, 4]})
+
+        resp = self.client.post("/stream/json?orient=columns", json=[{"num_lines": 0}])
+        self.assertEqual(resp.json, {"number": [], "squared": []})
+
+    def test_web_columnar(self):
+        resp = self.client.get("/columnar?num_lines=3")
+        self.assert200(resp)
+        self.assertIn(b"3 rows returned", resp.data)
+
+    def test_columnar_result(self):
+        result = ColumnarResult({"a": [1, 2, 3], "b": ["x", "y", "z"]})
+        self.assertEqual(len(result), 3)
+        self.assertEqual(list(result.iter_rows()), [(1, "x"), (2, "y"), (3, "z")])
+        self.assertEqual(result.slice(1, 2).to_dicts(), [{"a": 2, "b": "y"}])
+        with self.assertRaises(ValueError):
+            ColumnarResult({"a": [1, 2], "b": [1]})
+
+        merged = ColumnarResult.concat([result, ColumnarResult({"a": (4,), "b": ("w",)})])
+        self.assertEqual(merged.to_lists(), {"a": [1, 2, 3, 4], "b": ["x", "y", "z", "w"]})
+        with self.assertRaises(ValueError):
+            ColumnarResult.concat([result, ColumnarResult({"a": [4]})])
+
+    def test_json_paging(self):
+        resp = self.client.post("/plain-rows/json?offset=1&count=2", json=[{"num_lines": 5}])
+        self.assert200(resp)
+        self.assertEqual([x["number"] for x in resp.json], [1, 2])
+        self.assertEqual(resp.headers["Link"], '</plain-rows/json?offset=3&count=2>; rel="next"')
+
+        resp = self.client.get("/columnar/json?num_lines=5&offset=3&count=2")
+        self.assertEqual([x["number"] for x in resp.json], [3, 4])
+
+        resp = self.client.get("/columnar/json?num_lines=5&offset=4&count=2")
+        self.assertEqual([x["number"] for x in resp.json], [4])
+        self.assertNotIn("Link", resp.headers)
+
+        resp = self.client.get("/columnar/json?num_lines=5&offset=-1")
+        self.assert400(resp)
+        resp = self.client.get("/columnar/json?num_lines=5&cursor=abc")
+        self.assert400(resp)
+
+    def test_json_paging_full_page(self):
+        # the hoster pages the rows itself, so it knows that a full page is the last one
+        resp = self.client.post("/plain-rows/json?count=5", json=[{"num_lines": 5}])
+        self.assertEqual(len(resp.json), 5)
+        self.assertNotIn("Link", resp.headers)
+        resp = self.client.post("/plain-rows/json?offset=2&count=3", json=[{"num_lines": 5}])
+        self.assertEqual([x["number"] for x in resp.json], [2, 3, 4])
+        self.assertNotIn("Link", resp.headers)
+
+        # a full page of a query that applies paging itself may be followed by another
+        resp = self.client.post("/paged-rows/json?offset=2&count=3", json=[{"num_lines": 5}])
+        self.assertEqual([x["number"] for x in resp.json], [2, 3, 4])
+        self.assertEqual(resp.headers["Link"], '</paged-rows/json?offset=5&count=3>; rel="next"')
+        resp = self.client.post("/paged-rows/json?offset=5&count=3", json=[{"num_lines": 5}])
+        self.assertEqual(resp.json, [])
+        self.assertNotIn("Link", resp.headers)
+
+        # streamed rows are paged as they are produced
+        with patch.object(StreamQuery, "paged_by_hoster", True):
+            resp = self.client.post("/stream/json?offset=1&count=2", json=[{"num_lines": 5}])
+            self.assertEqual([x["number"] for x in resp.json], [1, 2])
+            resp.close()
+
+    def test_json_paging_not_requested(self):
+        # results are returned as fetch returns them unless the client asks for a page
+        resp = self.client.post("/plain-rows/json", json=[{"num_lines": 300}])
+        self.assertEqual(len(resp.json), 300)
+        self.assertNotIn("Link", resp.headers)
+        resp = self.client.get("/columnar/json?num_lines=300")
+        self.assertEqual(len(resp.json), 300)
+        self.assertNotIn("Link", resp.headers)
+
+        # POST requests pass the default count to fetch, queries that page themselves are not paged again
+        resp = self.client.post("/paged-rows/json", json=[{"num_lines": 300}])
+        self.assertEqual(len(resp.json), 100)
+        self.assertNotIn("Link", resp.headers)
+        resp = self.client.post("/paged-rows/json?offset=10&count=5", json=[{"num_lines": 300}])
+        self.assertEqual([x["number"] for x in resp.json], [10, 11, 12, 13, 14])
+
+    def test_reserved_arguments(self):
+        # the arguments that control the hoster are not passed to the input model
+        resp = self.client.get("/strict/json?num_lines=3&count=2&offset=0&orient=columns")
+        self.assert200(resp)
+        self.assertEqual(resp.json, {"number": [0, 1], "squared": [0, 1]})
+        resp = self.client.get("/strict/export?num_lines=3&format=csv")
+        self.assert200(resp)
+        resp.close()
+        resp = self.client.get("/strict?num_lines=3&count=2")
+        self.assert200(resp)
+        self.assertIn(b"2 rows returned", resp.data)
+        resp = self.client.get("/strict/json?num_lines=3&other=1")
+        self.assert400(resp)
+
+    def test_json_cursor(self):
+        numbers = []
+        resp = self.client.post("/cursor/json?count=2", json=[{"num_lines": 5}])
+        while True:
+            self.assert200(resp)
+            numbers.extend(x["number"] for x in resp.json)
+            if "X-Next-Cursor" not in resp.headers:
+                break
+            resp = self.client.post("/cursor/json?count=2&cursor=" + resp.headers["X-Next-Cursor"],
+                                    json=[{"num_lines": 5}])
+        self.assertEqual(numbers, [0, 1, 2, 3, 4])
+
+        resp = self.client.post("/cursor/json?cursor=invalid", json=[{"num_lines": 5}])
+        self.assert400(resp)
+
+    def test_web_paging(self):
+        resp = self.client.get("/plain-rows?num_lines=5&count=2&offset=2")
+        self.assert200(resp)
+        self.assertIn(b"2 rows returned", resp.data)
+        self.assertIn(b"/plain-rows?num_lines=5&amp;offset=0&amp;count=2", resp.data)
+        self.assertIn(b"/plain-rows?num_lines=5&amp;offset=4&amp;count=2", resp.data)
+
+    def test_links_for_output(self):
+        index_query_inputs(StreamQuery())
+        links = get_links_for_output(["num_lines", "other"])
+        self.assertEqual(list(links), ["num_lines"])
+        stream_links = [link for link in links["num_lines"] if link["slug"] == "stream"]
+        self.assertEqual(stream_links, [{"name": "streaming test endpoint", "slug": "stream", "columns": ["num_lines"]}])
+
+    def test_json_etag(self):
+        resp = self.client.get("/plain-rows/json?num_lines=2")
+        self.assertEqual(len(resp.json), 2)
+        self.assertIsNone(resp.headers.get("ETag"))
+
+        resp = self.client.get("/versioned-rows/json?num_lines=2")
+        self.assertEqual(len(resp.json), 2)
+        etag = resp.headers["ETag"]
+        self.assertEqual(resp.headers["Cache-Control"], "public, max-age=60")
+        self.assertEqual(versioned_query.fetches, 1)
+
+        # the same inputs with a different serialization give the same ETag, other inputs a different one
+        resp = self.client.get("/versioned-rows/json?num_lines=02")
+        self.assertEqual(resp.headers["ETag"], etag)
+        resp.close()
+        resp = self.client.get("/versioned-rows/json?num_lines=3")
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        resp.close()
+        resp = self.client.get("/versioned-rows/json?num_lines=2", headers={"Accept": "application/x-ndjson"})
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        resp.close()
+        fetches = versioned_query.fetches
+
+        resp = self.client.get("/versioned-rows/json?num_lines=2", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(versioned_query.fetches, fetches)
+
+        # POST responses carry the ETag but are not conditional
+        resp = self.client.post("/versioned-rows/json", json=[{"num_lines": 2}], headers={"If-None-Match": "*"})
+        self.assert200(resp)
+        self.assertEqual(len(resp.json), 2)
+        self.assertIn("ETag", resp.headers)
+
+    def test_web_etag(self):
+        resp = self.client.get("/versioned-rows?num_lines=2")
+        self.assert200(resp)
+        etag = resp.headers["ETag"]
+        fetches = versioned_query.fetches
+
+        resp = self.client.get("/versioned-rows?num_lines=2", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(versioned_query.fetches, fetches)
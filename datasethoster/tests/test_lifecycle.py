@@ -0,0 +1,179 @@
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+import flask_testing
+from pydantic import BaseModel
+
+import datasethoster.main
+from datasethoster import Query
+from datasethoster.lifecycle import QuerySetup, ReloadMarkers, SetupStatus
+from datasethoster.main import create_app, register_query, query_setups, SetupMode, init_reload_markers
+
+
+class EchoInput(BaseModel):
+    value: str
+
+
+class EchoOutput(BaseModel):
+    value: str
+
+
+class EchoQuery(Query[EchoInput, EchoOutput]):
+
+    def __init__(self, slug):
+        Query.__init__(self)
+        self.slug = slug
+        self.setup_calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def setup(self):
+        self.started.set()
+        self.release.wait()
+        self.setup_calls += 1
+
+    def names(self):
+        return self.slug, "setup test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return EchoInput
+
+    def outputs(self):
+        return EchoOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        return [EchoOutput(value=param.value) for param in params]
+
+
+background_query = EchoQuery("background")
+lazy_query = EchoQuery("lazy")
+lazy_query.release.set()
+# the background setup is started by the test, so that it doesn't depend on when the test runs
+with patch.object(QuerySetup, "run_in_background") as run_in_background:
+    register_query(background_query, setup_mode=SetupMode.background)
+run_in_background.assert_called_once_with()
+register_query(lazy_query, setup_mode=SetupMode.lazy)
+
+
+class LifecycleTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        return create_app()
+
+    def tearDown(self):
+        background_query.release.set()
+
+    def test_background_and_lazy_setup(self):
+        self.assertEqual(query_setups["lazy"].status, SetupStatus.pending)
+        self.assertEqual(query_setups["background"].status, SetupStatus.pending)
+
+        # the background query is blocked in setup until it is released
+        query_setups["background"].run_in_background()
+        self.assertTrue(background_query.started.wait(5))
+        resp = self.client.get("/health/background")
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.json["background"]["status"], "loading")
+        resp = self.client.get("/background/json?value=x")
+        self.assertEqual(resp.status_code, 503)
+        resp = self.client.get("/background?value=x")
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn(b"background", self.client.get("/").data)
+
+        background_query.release.set()
+        query_setups["background"].run()
+        self.assertEqual(background_query.setup_calls, 1)
+        resp = self.client.get("/health/background")
+        self.assert200(resp)
+        resp = self.client.get("/background/json?value=x")
+        self.assertEqual(resp.json, [{"value": "x"}])
+
+        # the lazy query is set up by its first request
+        resp = self.client.get("/lazy/json?value=y")
+        self.assertEqual(resp.json, [{"value": "y"}])
+        self.client.get("/lazy/json?value=y")
+        self.assertEqual(lazy_query.setup_calls, 1)
+        self.assert200(self.client.get("/health/lazy"))
+
+        self.assert404(self.client.get("/health/unknown"))
+
+
+class VersionedQuery(EchoQuery):
+
+    def __init__(self):
+        EchoQuery.__init__(self, "versioned")
+        self.release.set()
+        self.data_version = 0
+
+    def setup(self):
+        self.data_version += 1
+
+    def version(self):
+        return str(self.data_version)
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        return [EchoOutput(value="%s-%d" % (param.value, self.data_version)) for param in params]
+
+
+versioned_query = VersionedQuery()
+register_query(versioned_query)
+
+
+class ReloadTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        self.marker_dir = tempfile.TemporaryDirectory()
+        app = create_app()
+        app.config["ADMIN_TOKEN"] = "secret"
+        app.config["RELOAD_MARKER_PATH"] = self.marker_dir.name
+        init_reload_markers(app)
+        return app
+
+    def tearDown(self):
+        self.marker_dir.cleanup()
+
+    def wait_for_reload(self, query):
+        deadline = time.monotonic() + 5
+        while query_setups["versioned"].query is query and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_reload(self):
+        resp = self.client.get("/versioned/json?value=x")
+        self.assertEqual(resp.json, [{"value": "x-1"}])
+
+        resp = self.client.post("/reload/versioned")
+        self.assert403(resp)
+        resp = self.client.post("/reload/versioned", headers={"Authorization": "Token wrong"})
+        self.assert403(resp)
+        resp = self.client.post("/reload/unknown", headers={"Authorization": "Token secret"})
+        self.assert404(resp)
+
+        resp = self.client.post("/reload/versioned", headers={"Authorization": "Token secret"})
+        self.assertEqual(resp.status_code, 202)
+        self.wait_for_reload(versioned_query)
+
+        # the new version is served, the old object is left untouched for requests still using it
+        resp = self.client.get("/versioned/json?value=x")
+        self.assertEqual(resp.json, [{"value": "x-2"}])
+        self.assertEqual(versioned_query.data_version, 1)
+        resp = self.client.get("/health/versioned")
+        self.assertEqual(resp.json["versioned"]["version"], "2")
+        self.assertEqual(resp.json["versioned"]["reloads"], 1)
+
+        # the worker that handled the request doesn't reload the query again
+        self.assertEqual(datasethoster.main.reload_markers.pending(), [])
+
+        # a reload requested through another worker process is picked up by the next request
+        ReloadMarkers(self.marker_dir.name).request("versioned")
+        reloaded_query = query_setups["versioned"].query
+        with patch("datasethoster.main.RELOAD_CHECK_INTERVAL", 0):
+            self.client.get("/health/versioned")
+        self.wait_for_reload(reloaded_query)
+        resp = self.client.get("/health/versioned")
+        self.assertEqual(resp.json["versioned"]["version"], "3")
+        self.assertEqual(resp.json["versioned"]["reloads"], 2)
+        self.assertEqual(datasethoster.main.reload_markers.pending(), [])
@@ -0,0 +1,104 @@
+import os
+import tempfile
+import unittest
+
+import flask_testing
+from pydantic import BaseModel
+
+from datasethoster import Query
+from datasethoster.main import create_app, register_query
+from datasethoster.metrics import MetricsRegistry
+
+
+class CountInput(BaseModel):
+    num_lines: int
+
+
+class CountOutput(BaseModel):
+    number: int
+
+
+class CountQuery(Query[CountInput, CountOutput]):
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "metrics-count", "metrics test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return CountInput
+
+    def outputs(self):
+        return CountOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        return [CountOutput(number=i) for param in params for i in range(param.num_lines)]
+
+
+register_query(CountQuery())
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def create_registry(self, path=None):
+        registry = MetricsRegistry(path)
+        registry.histogram("duration_seconds", "Duration", ("query",), (0.1, 1))
+        registry.counter("requests_total", "Requests", ("query",))
+        return registry
+
+    def test_render(self):
+        registry = self.create_registry()
+        registry.observe("duration_seconds", ("a",), 0.05)
+        registry.observe("duration_seconds", ("a",), 0.5)
+        registry.observe("duration_seconds", ("a",), 5)
+        registry.inc("requests_total", ("a",))
+        registry.inc("requests_total", ('b"',), 2)
+
+        lines = registry.render().splitlines()
+        self.assertIn('datasethoster_duration_seconds_bucket{query="a",le="0.1"} 1', lines)
+        self.assertIn('datasethoster_duration_seconds_bucket{query="a",le="1"} 2', lines)
+        self.assertIn('datasethoster_duration_seconds_bucket{query="a",le="+Inf"} 3', lines)
+        self.assertIn('datasethoster_duration_seconds_sum{query="a"} 5.55', lines)
+        self.assertIn('datasethoster_duration_seconds_count{query="a"} 3', lines)
+        self.assertIn('datasethoster_requests_total{query="a"} 1', lines)
+        self.assertIn('datasethoster_requests_total{query="b\\""} 2', lines)
+
+    def test_collect_across_processes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # simulate another worker process that flushed its metrics earlier
+            other = self.create_registry(tmp)
+            other.inc("requests_total", ("a",), 3)
+            other.observe("duration_seconds", ("a",), 0.05)
+            other.flush()
+            os.rename(os.path.join(tmp, "metrics-%d.json" % os.getpid()), os.path.join(tmp, "metrics-1.json"))
+
+            registry = self.create_registry(tmp)
+            registry.inc("requests_total", ("a",))
+            registry.observe("duration_seconds", ("a",), 0.5)
+            collected = registry.collect()
+            self.assertEqual(collected["requests_total"][("a",)], 4)
+            self.assertEqual(collected["duration_seconds"][("a",)], [1, 1, 0.55, 2])
+
+
+class MetricsEndpointTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        return create_app()
+
+    def test_metrics_endpoint(self):
+        resp = self.client.post("/metrics-count/json", json=[{"num_lines": 3}])
+        self.assertEqual(len(resp.json), 3)
+        self.client.get("/metrics-count?num_lines=2")
+
+        resp = self.client.get("/metrics")
+        self.assert200(resp)
+        text = resp.data.decode("utf-8")
+        for stage in ("validation", "fetch", "serialization"):
+            self.assertIn('stage_duration_seconds_count{query="metrics-count",source="json_post",stage="%s"} 1' % stage, text)
+        self.assertIn('stage_duration_seconds_count{query="metrics-count",source="web",stage="links"} 1', text)
+        self.assertIn('result_rows_sum{query="metrics-count",source="json_post"} 3', text)
+        self.assertIn('requests_total{query="metrics-count",source="json_post",status="200"} 1', text)
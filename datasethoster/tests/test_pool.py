@@ -0,0 +1,175 @@
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import flask_testing
+from pydantic import BaseModel
+
+from datasethoster import ColumnarResult, Query, RequestSource
+from datasethoster.lifecycle import QuerySetup, SetupStatus
+from datasethoster.main import create_app, register_query, reload_query, registered_queries, query_setups
+from datasethoster.pool import get_process_pool, process_pools
+
+
+class ScoreInput(BaseModel):
+    number: int
+
+
+class ScoreOutput(BaseModel):
+    number: int
+    score: int
+    pid: int
+    setup_pid: int
+
+
+class ScoreQuery(Query[ScoreInput, ScoreOutput]):
+
+    process_workers = 2
+
+    def __init__(self):
+        Query.__init__(self)
+        self.setup_pid = None
+
+    def setup(self):
+        self.setup_pid = os.getpid()
+
+    def names(self):
+        return "score", "process pool test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return ScoreInput
+
+    def outputs(self):
+        return ScoreOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        rows = []
+        for param in params:
+            for i in range(2):
+                rows.append(ScoreOutput(number=param.number, score=sum(range(param.number * 1000)) + i,
+                                        pid=os.getpid(), setup_pid=self.setup_pid))
+        return rows
+
+
+class ColumnarScoreQuery(ScoreQuery):
+
+    def names(self):
+        return "columnar-score", "columnar process pool test endpoint"
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        numbers = [param.number for param in params for _ in range(2)]
+        return ColumnarResult({"number": numbers, "score": [n * 10 for n in numbers],
+                               "pid": [os.getpid()] * len(numbers), "setup_pid": [self.setup_pid] * len(numbers)})
+
+
+class ReloadScoreQuery(ScoreQuery):
+
+    def names(self):
+        return "reload-score", "reloaded process pool test endpoint"
+
+
+class BrokenScoreQuery(ScoreQuery):
+
+    def setup(self):
+        raise RuntimeError("The data could not be loaded")
+
+    def names(self):
+        return "broken-score", "broken process pool test endpoint"
+
+
+score_query = ScoreQuery()
+register_query(score_query)
+columnar_score_query = ColumnarScoreQuery()
+register_query(columnar_score_query)
+reload_score_query = ReloadScoreQuery()
+register_query(reload_score_query)
+
+
+class ProcessPoolTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        return create_app()
+
+    @classmethod
+    def tearDownClass(cls):
+        get_process_pool(score_query).shutdown()
+        get_process_pool(columnar_score_query).shutdown()
+        get_process_pool(registered_queries["reload-score"]).shutdown()
+
+    def test_started_during_setup(self):
+        self.assertIsNotNone(get_process_pool(score_query).executor)
+
+        query_setup = QuerySetup(BrokenScoreQuery())
+        with self.assertRaises(BrokenProcessPool):
+            query_setup.run()
+        self.assertEqual(query_setup.status, SetupStatus.failed)
+        self.assertNotIn(id(query_setup.query), process_pools)
+
+    def test_reload(self):
+        old_pool = get_process_pool(reload_score_query)
+        self.assertTrue(reload_query("reload-score"))
+        for _ in range(100):
+            if old_pool.retired:
+                break
+            time.sleep(0.1)
+
+        # the new query object has its own pool, started before it was swapped in
+        query = registered_queries["reload-score"]
+        self.assertIsNot(query, reload_score_query)
+        self.assertEqual(query_setups["reload-score"].reloads, 1)
+        new_pool = get_process_pool(query)
+        self.assertIsNot(new_pool, old_pool)
+        self.assertIsNotNone(new_pool.executor)
+        self.assertIs(get_process_pool(query), new_pool)
+
+        # the old pool was idle and has shut down, a request still holding the old query gets a pool that
+        # shuts down once its fetch is done
+        self.assertIsNone(old_pool.executor)
+        pool = get_process_pool(reload_score_query)
+        self.assertIsNot(pool, new_pool)
+        self.assertEqual(len(pool.fetch([ScoreInput(number=1)], RequestSource.json_post)), 2)
+        self.assertIsNone(pool.executor)
+        self.assertNotIn(id(reload_score_query), process_pools)
+
+        resp = self.client.post("/reload-score/json", json=[{"number": 1}])
+        self.assert200(resp)
+        self.assertEqual(len(resp.json), 2)
+
+    def test_setup_in_workers(self):
+        # the query is set up in the worker processes, not in the process hosting the app
+        self.assertIsNone(score_query.setup_pid)
+
+        resp = self.client.post("/score/json?count=1000", json=[{"number": n} for n in range(8)])
+        self.assert200(resp)
+        self.assertEqual([x["number"] for x in resp.json], [n for n in range(8) for _ in range(2)])
+        for row in resp.json:
+            self.assertNotEqual(row["pid"], os.getpid())
+            self.assertEqual(row["pid"], row["setup_pid"])
+
+    def test_paging_across_workers(self):
+        pool = get_process_pool(score_query)
+        inputs = [ScoreInput(number=n) for n in range(5)]
+        rows = pool.fetch(inputs, RequestSource.json_post, offset=3, count=4)
+        self.assertEqual([(row.number, row.score % 2) for row in rows], [(1, 1), (2, 0), (2, 1), (3, 0)])
+        resp = self.client.post("/score/json?offset=3&count=4", json=[{"number": n} for n in range(5)])
+        self.assertEqual([(x["number"], x["score"] % 2) for x in resp.json], [(1, 1), (2, 0), (2, 1), (3, 0)])
+
+        # the hoster applies offset and count to the merged rows of queries that it pages
+        score_query.paged_by_hoster = True
+        try:
+            rows = pool.fetch(inputs, RequestSource.json_post, offset=3, count=4)
+            self.assertEqual(len(rows), 10)
+            resp = self.client.post("/score/json?offset=3&count=4", json=[{"number": n} for n in range(5)])
+            self.assertEqual([(x["number"], x["score"] % 2) for x in resp.json],
+                             [(1, 1), (2, 0), (2, 1), (3, 0)])
+        finally:
+            del score_query.paged_by_hoster
+
+    def test_columnar_across_workers(self):
+        resp = self.client.post("/columnar-score/json", json=[{"number": n} for n in range(5)])
+        self.assert200(resp)
+        self.assertEqual([x["score"] for x in resp.json], [n * 10 for n in range(5) for _ in range(2)])
+        self.assertNotIn(os.getpid(), {x["pid"] for x in resp.json})
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import time
+import unittest
+
+import flask_testing
+from pydantic import BaseModel
+
+from datasethoster import Query
+import datasethoster.main
+from datasethoster.main import create_app, register_query, init_profiling
+from datasethoster.profiling import SlowRequestWatchdog
+
+
+class SleepInput(BaseModel):
+    seconds: float
+
+
+class SleepOutput(BaseModel):
+    slept: float
+
+
+def sleep_for(seconds):
+    time.sleep(seconds)
+
+
+class SleepQuery(Query[SleepInput, SleepOutput]):
+
+    profile_threshold = 0.05
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "profiled-sleep", "profiling test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return SleepInput
+
+    def outputs(self):
+        return SleepOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        for param in params:
+            sleep_for(param.seconds)
+        return [SleepOutput(slept=param.seconds) for param in params]
+
+
+register_query(SleepQuery())
+
+
+class TestSlowRequestWatchdog(unittest.TestCase):
+
+    def test_samples_slow_requests_only(self):
+        watchdog = SlowRequestWatchdog(interval=0.005)
+        token = watchdog.start_request(10)
+        self.assertIsNone(watchdog.end_request(token))
+
+        token = watchdog.start_request(0.01)
+        sleep_for(0.1)
+        duration, report = watchdog.end_request(token)
+        self.assertGreaterEqual(duration, 0.1)
+        self.assertIn("sleep_for", report)
+
+
+class ProfilingTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        self.profile_path = tempfile.mkdtemp()
+        app = create_app()
+        app.config["ADMIN_TOKEN"] = "secret"
+        app.config["PROFILING_ENABLED"] = True
+        app.config["PROFILE_PATH"] = self.profile_path
+        init_profiling(app)
+        return app
+
+    def tearDown(self):
+        datasethoster.main.profile_store = None
+
+    def test_profile_request(self):
+        resp = self.client.get("/profiled-sleep/json?seconds=0&profile=1")
+        self.assert403(resp)
+
+        headers = {"Authorization": "Token secret"}
+        resp = self.client.get("/profiled-sleep/json?seconds=0&profile=1", headers=headers)
+        self.assert200(resp)
+        self.assertEqual(resp.json, [{"slept": 0.0}])
+        profile_url = resp.headers["X-Profile-URL"]
+
+        resp = self.client.get(profile_url)
+        self.assert403(resp)
+        resp = self.client.get(profile_url, headers=headers)
+        self.assert200(resp)
+        self.assertIn("serialize_rows", resp.data.decode("utf-8"))
+
+        resp = self.client.get("/profiles/unknown", headers=headers)
+        self.assert404(resp)
+
+    def test_slow_request(self):
+        resp = self.client.get("/profiled-sleep/json?seconds=0")
+        self.assertEqual(resp.json, [{"slept": 0.0}])
+        resp.close()
+        self.assertEqual(os.listdir(self.profile_path), [])
+
+        resp = self.client.get("/profiled-sleep/json?seconds=0.2")
+        self.assertEqual(resp.json, [{"slept": 0.2}])
+        resp.close()
+        profiles = datasethoster.main.profile_store
+        ids = [name[:-4] for name in os.listdir(self.profile_path)]
+        self.assertEqual(len(ids), 1)
+        self.assertIn("sleep_for", profiles.load(ids[0]))
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+
+import flask_testing
+from pydantic import BaseModel
+
+from datasethoster import Query
+from datasethoster.main import create_app, register_query
+from datasethoster.ratelimit import MemoryRateLimiter, SQLiteRateLimiter
+
+
+class LimitedInput(BaseModel):
+    value: int
+
+
+class LimitedOutput(BaseModel):
+    value: int
+
+
+class LimitedQuery(Query[LimitedInput, LimitedOutput]):
+
+    rate_limit = 0.01
+    rate_limit_burst = 5
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "rate-limited", "rate limit test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return LimitedInput
+
+    def outputs(self):
+        return LimitedOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        return [LimitedOutput(value=param.value) for param in params]
+
+
+register_query(LimitedQuery())
+
+
+class RateLimiterTests:
+
+    def create_limiter(self):
+        raise NotImplementedError
+
+    def test_acquire(self):
+        limiter = self.create_limiter()
+        self.assertEqual(limiter.acquire("a", 3, 1, 5), 0)
+        self.assertEqual(limiter.acquire("a", 2, 1, 5), 0)
+        retry_after = limiter.acquire("a", 2, 1, 5)
+        self.assertGreater(retry_after, 1.9)
+        self.assertLessEqual(retry_after, 2)
+        # other keys have their own buckets
+        self.assertEqual(limiter.acquire("b", 5, 1, 5), 0)
+
+    def test_large_requests(self):
+        limiter = self.create_limiter()
+        # requests larger than the burst are admitted with a full bucket and leave the bucket in debt
+        self.assertEqual(limiter.acquire("a", 10, 1, 5), 0)
+        self.assertGreater(limiter.acquire("a", 1, 1, 5), 5)
+
+    def test_charge(self):
+        limiter = self.create_limiter()
+        limiter.charge("a", 5, 1, 5)
+        self.assertGreater(limiter.acquire("a", 1, 1, 5), 0.9)
+
+
+class TestMemoryRateLimiter(RateLimiterTests, unittest.TestCase):
+
+    def create_limiter(self):
+        return MemoryRateLimiter()
+
+
+class TestSQLiteRateLimiter(RateLimiterTests, unittest.TestCase):
+
+    def create_limiter(self):
+        return SQLiteRateLimiter(os.path.join(tempfile.mkdtemp(), "ratelimit.db"))
+
+
+class RateLimitTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        app = create_app()
+        app.config["API_KEYS"] = {"key-1": "client-1"}
+        return app
+
+    def test_rate_limit(self):
+        resp = self.client.post("/rate-limited/json", json=[{"value": 1}, {"value": 2}, {"value": 3}])
+        self.assert200(resp)
+        self.assertEqual(len(resp.json), 3)
+        resp = self.client.get("/rate-limited/json?value=1")
+        self.assert200(resp)
+        resp.close()
+
+        resp = self.client.post("/rate-limited/json", json=[{"value": 1}, {"value": 2}])
+        self.assertEqual(resp.status_code, 429)
+        self.assertGreater(int(resp.headers["Retry-After"]), 1)
+        # the last token is left for a single item
+        resp = self.client.get("/rate-limited?value=1")
+        self.assert200(resp)
+        resp = self.client.get("/rate-limited?value=1")
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn("Retry-After", resp.headers)
+
+        # clients with an API key have their own limit
+        resp = self.client.get("/rate-limited/json?value=1", headers={"Authorization": "Token key-1"})
+        self.assert200(resp)
+        resp.close()
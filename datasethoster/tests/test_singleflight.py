@@ -0,0 +1,136 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import BaseModel
+
+from datasethoster import Query, RequestSource
+from datasethoster.main import fetch_results, fetch_flights
+from datasethoster.singleflight import SingleFlight
+
+
+class SlowInput(BaseModel):
+    value: int
+
+
+class SlowOutput(BaseModel):
+    value: int
+
+
+class SlowQuery(Query[SlowInput, SlowOutput]):
+
+    single_flight = True
+    single_flight_timeout = 5
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+        self.fetches = 0
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "single-flight", "single flight test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return SlowInput
+
+    def outputs(self):
+        return SlowOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        self.fetches += 1
+        self.release.wait(5)
+        if params[0].value < 0:
+            raise ValueError("negative value")
+        return (SlowOutput(value=param.value) for param in params)
+
+
+def wait_for_flights(count):
+    while fetch_flights.in_flight() < count:
+        time.sleep(0.01)
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_do(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return "result"
+
+        with ThreadPoolExecutor(4) as executor:
+            leader = executor.submit(flights.do, "key", slow)
+            started.wait(5)
+            waiters = [executor.submit(flights.do, "key", lambda: "other") for _ in range(3)]
+            other = flights.do("other key", lambda: "other")
+            release.set()
+
+            self.assertEqual(leader.result(), ("result", False))
+            for waiter in waiters:
+                self.assertEqual(waiter.result(), ("result", True))
+        self.assertEqual(other, ("other", False))
+        self.assertEqual(flights.in_flight(), 0)
+
+        # once the call completed, the next call runs again
+        self.assertEqual(flights.do("key", lambda: "again"), ("again", False))
+
+    def test_timeout(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+
+        with ThreadPoolExecutor(1) as executor:
+            executor.submit(flights.do, "key", slow)
+            started.wait(5)
+            with self.assertRaises(TimeoutError):
+                flights.do("key", lambda: None, timeout=0.01)
+            release.set()
+
+    def test_fetch_results(self):
+        query = SlowQuery()
+        inputs = [SlowInput(value=1), SlowInput(value=2)]
+        with ThreadPoolExecutor(4) as executor:
+            leader = executor.submit(fetch_results, query, inputs, RequestSource.json_post, offset=0, count=10)
+            wait_for_flights(1)
+            waiters = [executor.submit(fetch_results, query, inputs, RequestSource.json_post, offset=0, count=10)
+                       for _ in range(3)]
+            # give the waiters time to join the fetch in progress
+            time.sleep(0.1)
+            query.release.set()
+            results = [future.result()[0] for future in [leader] + waiters]
+
+        self.assertEqual(query.fetches, 1)
+        for result in results:
+            self.assertEqual(result, [SlowOutput(value=1), SlowOutput(value=2)])
+
+        # a request with other paging arguments is not coalesced
+        fetch_results(query, inputs, RequestSource.json_post, offset=0, count=1)
+        self.assertEqual(query.fetches, 2)
+
+    def test_fetch_results_error(self):
+        query = SlowQuery()
+        inputs = [SlowInput(value=-1)]
+        with ThreadPoolExecutor(3) as executor:
+            leader = executor.submit(fetch_results, query, inputs, RequestSource.json_post)
+            wait_for_flights(1)
+            waiters = [executor.submit(fetch_results, query, inputs, RequestSource.json_post) for _ in range(2)]
+            # give the waiters time to join the fetch in progress
+            time.sleep(0.1)
+            query.release.set()
+
+            for future in [leader] + waiters:
+                with self.assertRaises(ValueError):
+                    future.result()
+        self.assertEqual(query.fetches, 1)
@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import flask_testing
+from pydantic import BaseModel
+
+from datasethoster import RequestSource
+from datasethoster.main import create_app, register_query
+from datasethoster.sql import ConnectionPool, SQLQuery
+
+
+class RecordingInput(BaseModel):
+    recording_id: int
+
+
+class RecordingOutput(BaseModel):
+    recording_id: int
+    name: str
+
+
+class RecordingQuery(SQLQuery):
+
+    sql = """SELECT recording.id, recording.name
+               FROM inputs
+               JOIN recording
+                 ON recording.id = inputs.recording_id
+           ORDER BY inputs.input_index"""
+    fetch_size = 2
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.statements = []
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.set_trace_callback(self.statements.append)
+        return connection
+
+    def names(self):
+        return "sql-recording", "sql query test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return RecordingInput
+
+    def outputs(self):
+        return RecordingOutput
+
+
+tmp = tempfile.TemporaryDirectory()
+db_path = os.path.join(tmp.name, "recordings.db")
+with sqlite3.connect(db_path) as conn:
+    conn.execute("CREATE TABLE recording (id INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+    conn.executemany("INSERT INTO recording (id, name) VALUES (?, ?)", [(i, "recording %d" % i) for i in range(10)])
+conn.close()
+register_query(RecordingQuery(db_path))
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_reuse(self):
+        opened = []
+
+        def connect():
+            opened.append(sqlite3.connect(":memory:", check_same_thread=False))
+            return opened[-1]
+
+        pool = ConnectionPool(connect, size=2, timeout=0.01)
+        with pool.connection() as first:
+            with pool.connection() as second:
+                self.assertIsNot(first, second)
+                with self.assertRaises(TimeoutError):
+                    with pool.connection():
+                        pass
+        with pool.connection() as third:
+            self.assertIn(third, (first, second))
+        self.assertEqual(len(opened), 2)
+        pool.close()
+        self.assertEqual(pool.opened, 0)
+
+
+class TestSQLQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.query = RecordingQuery(db_path)
+
+    def test_batched_lookup(self):
+        inputs = [RecordingInput(recording_id=i) for i in (7, 3, 42, 5)]
+        rows = self.query.fetch(inputs, RequestSource.json_post)
+        self.assertEqual(list(rows), [(7, "recording 7"), (3, "recording 3"), (5, "recording 5")])
+        # all the inputs are looked up with a single statement
+        self.assertEqual(len([sql for sql in self.query.statements if sql.startswith("WITH")]), 1)
+
+    def test_offset_count(self):
+        inputs = [RecordingInput(recording_id=i) for i in range(10)]
+        rows = self.query.fetch(inputs, RequestSource.json_post, offset=2, count=3)
+        self.assertEqual([row[0] for row in rows], [2, 3, 4])
+        self.assertIn("LIMIT", self.query.statements[-1])
+
+    def test_connection_reuse(self):
+        rows = self.query.fetch([RecordingInput(recording_id=1)], RequestSource.json_post)
+        next(rows)
+        # the connection is returned to the pool once the rows are closed
+        rows.close()
+        list(self.query.fetch([RecordingInput(recording_id=2)], RequestSource.json_post))
+        self.assertEqual(self.query.pool().opened, 1)
+        self.assertEqual(self.query.fetch([], RequestSource.json_post), [])
+
+
+class SQLQueryTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        return create_app()
+
+    def test_post(self):
+        resp = self.client.post("/sql-recording/json?count=2", json=[{"recording_id": 4}, {"recording_id": 1},
+                                                                     {"recording_id": 8}])
+        self.assert200(resp)
+        self.assertEqual(resp.json, [{"recording_id": 4, "name": "recording 4"},
+                                     {"recording_id": 1, "name": "recording 1"}])
+        resp.close()
@@ -0,0 +1,136 @@
+import os
+import tempfile
+import unittest
+
+import flask_testing
+
+from datasethoster.main import create_app, register_query
+from datasethoster.table import Table, TableQuery
+
+ARTISTS = [
+    (3, "Portishead", 1991, 4.5),
+    (1, "Massive Attack", 1988, 4.25),
+    (2, "Tricky", 1995, 3.5),
+    (4, "Massive Attack", 2003, 2.0),
+]
+
+CSV = """id,name,year,rating
+3,Portishead,1991,4.5
+1,Massive Attack,1988,4.25
+2,Tricky,1995,3.5
+"""
+
+
+class ArtistQuery(TableQuery):
+
+    columns = {"id": int, "name": str, "year": int, "rating": float}
+    key_columns = ["id"]
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def names(self):
+        return "artist-table", "table query test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+
+tmp = tempfile.TemporaryDirectory()
+csv_path = os.path.join(tmp.name, "artists.csv")
+with open(csv_path, "w") as f:
+    f.write(CSV)
+register_query(ArtistQuery(csv_path))
+
+
+class NameQuery(TableQuery):
+
+    columns = {"name": str, "year": int, "id": int, "rating": float}
+    key_columns = ["name"]
+
+    def load(self):
+        return [(name, year, id_, rating) for id_, name, year, rating in ARTISTS]
+
+    def names(self):
+        return "artist-name", "artist name test query"
+
+    def introduction(self):
+        return "intro"
+
+
+class TestTable(unittest.TestCase):
+
+    def setUp(self):
+        self.columns = {"id": int, "name": str, "year": int, "rating": float}
+        self.table = Table(self.columns, ["name", "year"], ARTISTS)
+
+    def test_lookup(self):
+        table = Table(self.columns, ["name"], ARTISTS)
+        result = table.select(table.lookup(["Tricky", "Massive Attack", "Unknown"]), ["id"])
+        self.assertEqual(result.to_lists(), {"id": [2, 1, 4]})
+
+    def test_multi_key_lookup(self):
+        rows = self.table.lookup([("Massive Attack", 2003), ("Portishead", 1991), ("Tricky", 1991)])
+        self.assertEqual(self.table.select(rows, ["id", "rating"]).to_lists(), {"id": [4, 3], "rating": [2.0, 4.5]})
+
+    def test_range_and_prefix(self):
+        rows = self.table.lookup_range([("N", "Tricky"), (None, "N")])
+        self.assertEqual(self.table.select(rows, ["id"]).to_lists(), {"id": [3, 2, 1, 4]})
+        rows = self.table.lookup_prefix(["Mass", "T", "X"])
+        self.assertEqual(self.table.select(rows, ["id"]).to_lists(), {"id": [1, 4, 2]})
+
+    def test_bool_column(self):
+        table = Table({"name": str, "active": bool}, ["name"], [("a", "true"), ("b", "0"), ("c", True)])
+        result = table.select(table.lookup(["c", "b", "a"]))
+        self.assertEqual(result.to_lists(), {"name": ["c", "b", "a"], "active": [True, False, True]})
+        self.assertIs(result.to_lists()["active"][0], True)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            Table(self.columns, ["missing"], ARTISTS)
+        with self.assertRaises(ValueError):
+            Table({"id": int, "tags": list}, ["id"], [])
+
+    def test_query_models(self):
+        query = NameQuery()
+        query.setup()
+        self.assertEqual(list(query.inputs().__fields__), ["name"])
+        self.assertEqual(list(query.outputs().__fields__), ["name", "year", "id", "rating"])
+        self.assertIs(query.inputs(), query.inputs())
+
+        query.lookup = "range"
+        query._inputs = None
+        self.assertEqual(list(query.inputs().__fields__), ["name_min", "name_max"])
+
+    def test_query_lookups(self):
+        query = NameQuery()
+        query.setup()
+        inputs = query.inputs()
+        result = query.fetch([inputs(name="Massive Attack"), inputs(name="Tricky")], None)
+        self.assertEqual(result.to_lists()["id"], [1, 4, 2])
+        result = query.fetch([inputs(name="Massive Attack"), inputs(name="Tricky")], None, offset=1, count=1)
+        self.assertEqual(result.to_lists()["id"], [4])
+
+        query = NameQuery()
+        query.lookup = "prefix"
+        query.setup()
+        result = query.fetch([query.inputs()(name="P")], None)
+        self.assertEqual(result.to_lists()["name"], ["Portishead"])
+
+
+class TableQueryTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        return create_app()
+
+    def test_post(self):
+        resp = self.client.post("/artist-table/json", json=[{"id": 2}, {"id": 5}, {"id": 3}])
+        self.assert200(resp)
+        self.assertEqual(resp.json, [
+            {"id": 2, "name": "Tricky", "year": 1995, "rating": 3.5},
+            {"id": 3, "name": "Portishead", "year": 1991, "rating": 4.5},
+        ])
+
+        resp = self.client.post("/artist-table/json", json=[{"id": "x"}])
+        self.assert400(resp)
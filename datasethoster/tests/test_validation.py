@@ -0,0 +1,136 @@
+import unittest
+from typing import Optional
+
+import flask_testing
+from pydantic import BaseModel, validator
+
+from datasethoster import Query
+from datasethoster.main import create_app, register_query
+from datasethoster.validation import BatchValidator
+
+
+class BatchInput(BaseModel):
+    value: int
+    name: str = "unnamed"
+    tags: list[str] = []
+    score: Optional[float]
+
+
+class ValidatedInput(BaseModel):
+    value: int
+
+    @validator("value")
+    def check_value(cls, value):
+        if value < 0:
+            raise ValueError("value must not be negative")
+        return value
+
+
+class BatchOutput(BaseModel):
+    value: int
+    name: str
+
+
+class BatchQuery(Query[BatchInput, BatchOutput]):
+
+    max_batch_size = 3
+
+    def setup(self):
+        pass
+
+    def names(self):
+        return "batch", "batch test endpoint"
+
+    def introduction(self):
+        return "intro"
+
+    def inputs(self):
+        return BatchInput
+
+    def outputs(self):
+        return BatchOutput
+
+    def fetch(self, params, source, offset=-1, count=-1):
+        return [BatchOutput(value=param.value, name=param.name) for param in params]
+
+
+register_query(BatchQuery())
+
+
+class TestBatchValidator(unittest.TestCase):
+
+    def test_fast_path(self):
+        batch_validator = BatchValidator(BatchInput)
+        self.assertIsNotNone(batch_validator.fields)
+
+        items = [{"value": 1}, {"value": 2, "name": "two", "tags": ["a"], "score": 0.5}, {"value": 3, "score": None}]
+        inputs = batch_validator.validate(items)
+        self.assertEqual(inputs, [BatchInput(**item) for item in items])
+        self.assertEqual(inputs[0].__fields_set__, {"value"})
+        # defaults are not shared between items
+        self.assertIsNot(inputs[0].tags, inputs[2].tags)
+
+    def test_fallback(self):
+        batch_validator = BatchValidator(BatchInput)
+        # values that pydantic converts are validated by pydantic
+        inputs = batch_validator.validate([{"value": "1", "score": 2}])
+        self.assertEqual(inputs[0].value, 1)
+        self.assertEqual(inputs[0].score, 2.0)
+        self.assertIsInstance(inputs[0].score, float)
+
+    def test_invalid(self):
+        batch_validator = BatchValidator(BatchInput)
+        with self.assertRaisesRegex(ValueError, "item 1"):
+            batch_validator.validate([{"value": 1}, {"value": "one"}])
+        with self.assertRaisesRegex(ValueError, "item 0"):
+            batch_validator.validate([{"name": "missing value"}])
+        with self.assertRaisesRegex(ValueError, "item 0"):
+            batch_validator.validate([[1]])
+        with self.assertRaises(ValueError):
+            batch_validator.validate({"value": 1})
+
+    def test_validators(self):
+        # models with validators are always validated by pydantic
+        batch_validator = BatchValidator(ValidatedInput)
+        self.assertIsNone(batch_validator.fields)
+        with self.assertRaisesRegex(ValueError, "must not be negative"):
+            batch_validator.validate([{"value": -1}])
+
+    def test_trusted(self):
+        batch_validator = BatchValidator(ValidatedInput)
+        inputs = batch_validator.validate([{"value": -1}], trusted=True)
+        self.assertEqual(inputs[0].value, -1)
+
+
+class BatchTestCase(flask_testing.TestCase):
+
+    def create_app(self):
+        app = create_app()
+        app.config["API_KEYS"] = {"key-1": "internal", "key-2": "external"}
+        app.config["TRUSTED_CLIENTS"] = ["internal"]
+        return app
+
+    def test_post(self):
+        resp = self.client.post("/batch/json", json=[{"value": 1}, {"value": "2", "name": "two"}])
+        self.assert200(resp)
+        self.assertEqual(resp.json, [{"value": 1, "name": "unnamed"}, {"value": 2, "name": "two"}])
+
+        resp = self.client.post("/batch/json", json=[{"value": 1}, {"value": "two"}])
+        self.assert400(resp)
+        self.assertIn("item 1", resp.text)
+
+        resp = self.client.post("/batch/json", data="[{", content_type="application/json")
+        self.assert400(resp)
+
+    def test_max_batch_size(self):
+        resp = self.client.post("/batch/json", json=[{"value": i} for i in range(4)])
+        self.assertEqual(resp.status_code, 413)
+        self.assertIn("at most 3", resp.text)
+
+    def test_trusted_clients(self):
+        resp = self.client.post("/batch/json", json=[{"value": 1}], headers={"Authorization": "Token key-1"})
+        self.assert200(resp)
+        self.assertEqual(resp.json, [{"value": 1, "name": "unnamed"}])
+
+        resp = self.client.post("/batch/json", json=[{"value": "one"}], headers={"Authorization": "Token key-2"})
+        self.assert400(resp)
@@ -3,11 +3,16 @@ from unittest.mock import patch, call
 
 import flask_testing
 from flask import current_app, url_for
+from pydantic import BaseModel
 
 from datasethoster import Query
 from datasethoster.main import create_app, dataset_bp, register_query, web_query_handler, json_query_handler
 
 
+class SampleInputModel(BaseModel):
+    in_0: str
+
+
 class SampleQuery(Query):
 
     def __init__(self):
@@ -0,0 +1,137 @@
+import json
+
+from pydantic import Extra
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Field types that the fast path checks itself. Values of these types are accepted as they are by pydantic.
+SIMPLE_TYPES = (int, float, str, bool)
+
+MISSING = object()
+
+
+def parse_json(data: bytes):
+    """ Parse a JSON request body, with orjson if it is installed. """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def compile_field(field):
+    """ Return a function that checks a value of the field and returns it if it has exactly the field's type
+        (e.g. an int for an int field), so that pydantic would accept it unchanged, or MISSING otherwise.
+        Returns None if the field can't be checked by the fast path. """
+    if field.type_ not in SIMPLE_TYPES or field.sub_fields and field.shape != SHAPE_LIST:
+        return None
+    if field.pre_validators or field.post_validators or field.class_validators:
+        return None
+
+    type_, allow_none = field.type_, field.allow_none
+    if field.shape == SHAPE_SINGLETON:
+        def check(value):
+            if type(value) is type_ or (value is None and allow_none):
+                return value
+            return MISSING
+    elif field.shape == SHAPE_LIST:
+        def check(value):
+            if type(value) is list and all(type(x) is type_ for x in value):
+                return value
+            if value is None and allow_none:
+                return value
+            return MISSING
+    else:
+        return None
+    return check
+
+
+class BatchValidator:
+    """
+        Validates the input items of a batch request. Items whose values already have the exact types of the
+        model's fields, as parsed from JSON, are checked by a fast path and the model is constructed without
+        running pydantic's validation. All other items are validated by pydantic as usual, so the result is
+        the same either way. Models with types, validators or config that the fast path doesn't support are
+        always validated by pydantic.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.fields = self.compile(model)
+
+    @staticmethod
+    def compile(model):
+        config = model.__config__
+        if model.__pre_root_validators__ or model.__post_root_validators__ or config.extra == Extra.forbid:
+            return None
+        if config.anystr_strip_whitespace or config.anystr_lower or config.anystr_upper or \
+                config.min_anystr_length or config.max_anystr_length is not None:
+            return None
+
+        fields = []
+        for name, field in model.__fields__.items():
+            check = compile_field(field)
+            if check is None or field.alias != name:
+                return None
+            fields.append((name, check, field.required, field.get_default))
+        return fields
+
+    def validate_item(self, item):
+        if self.fields is not None and type(item) is dict:
+            values, fields_set = {}, set()
+            for name, check, required, get_default in self.fields:
+                value = item.get(name, MISSING)
+                if value is MISSING:
+                    if required:
+                        break
+                    values[name] = get_default()
+                    continue
+                value = check(value)
+                if value is MISSING:
+                    break
+                values[name] = value
+                fields_set.add(name)
+            else:
+                return self.model.construct(fields_set, **values)
+
+        if not isinstance(item, dict):
+            raise ValueError("input items must be JSON objects")
+        return self.model(**item)
+
+    def validate(self, items, trusted=False):
+        """
+            Validate a list of input items and return the list of models. Items of trusted clients are not
+            validated at all, the models are constructed from the items as they are. Raises ValueError with
+            the index of the first invalid item.
+        """
+        if not isinstance(items, list):
+            raise ValueError("The request body must be a JSON list of input items")
+
+        if trusted:
+            construct = self.model.construct
+            try:
+                return [construct(**item) for item in items]
+            except TypeError:
+                raise ValueError("input items must be JSON objects")
+
+        validate_item = self.validate_item
+        inputs = []
+        for index, item in enumerate(items):
+            try:
+                inputs.append(validate_item(item))
+            except (ValueError, TypeError) as err:
+                raise ValueError("Invalid input item %d: %s" % (index, err))
+        return inputs
+
+
+validators = {}
+
+
+def get_batch_validator(model) -> BatchValidator:
+    """ Return the batch validator of an input model, compiled on first use. """
+    validator = validators.get(model)
+    if validator is None:
+        validator = validators[model] = BatchValidator(model)
+    return validator
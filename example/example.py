@@ -25,6 +25,8 @@ class ExampleOutput2(BaseModel):
 
 class ExampleQuery(Query[BaseModel, ExampleOutput]):
 
+    paged_by_hoster = True
+
     def setup(self):
         pass
 
@@ -63,6 +65,8 @@ class ExampleQuery(Query[BaseModel, ExampleOutput]):
 
 class ExampleQuery2(Query[ExampleInput2, ExampleOutput2]):
 
+    paged_by_hoster = True
+
     def setup(self):
         pass
 
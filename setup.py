@@ -14,4 +14,11 @@ setup(name='datasethoster',
       install_requires=[
           'Flask>=2.1.3', 'six', 'sentry-sdk[flask]>=0.19.3'
       ],
+      extras_require={
+          'orjson': ['orjson'],
+          'asgi': ['asgiref'],
+          'brotli': ['brotli'],
+          'zstd': ['zstandard'],
+          'arrow': ['pyarrow'],
+      },
       zip_safe=False)